@@ -0,0 +1,496 @@
+"""
+EcoShower - Lightweight Instrumentation
+Per-invocation stage timings and AWS call accounting, emitted as one
+CloudWatch Embedded Metric Format (EMF) log line.
+
+    tracer = Tracer('process_telemetry')
+    table = tracer.instrument(dynamodb.Table('X'), 'dynamodb')
+
+    tracer.begin()
+    with tracer.stage('store_telemetry'):
+        table.put_item(...)
+    tracer.end()
+
+With TRACING_ENABLED=false nothing is wrapped and stage() returns a shared
+no-op context, so the disabled cost is one attribute check per stage.
+
+Only sampled invocations are traced, but every DynamoDB call on a wrapped
+object asks for ReturnConsumedCapacity (the response just grows by a few
+bytes). Each invocation's RCUs, WCUs and readings go into Tracer.usage, and a
+warm container emits their sums as one totals line per function every
+USAGE_METRICS_INTERVAL_SECONDS - exact figures, where the per-stage split in
+the trace lines is a sample. tools/project_cost.py turns the totals into a
+monthly cost.
+
+The API lambda does not log a line per request. RouteMetrics folds each
+request (and its usage) into a per-route latency histogram and emits one EMF
+line per route every ROUTE_METRICS_INTERVAL_SECONDS; server_timing() formats
+the same data as a Server-Timing response header.
+"""
+
+import bisect
+import json
+import os
+import random
+import threading
+import time
+
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'true').lower() == 'true'
+# Fraction of invocations that are traced and logged
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.1'))
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'EcoShower')
+# How often a warm container emits its per-route histograms
+ROUTE_METRICS_INTERVAL_SECONDS = float(os.environ.get('ROUTE_METRICS_INTERVAL_SECONDS', '60'))
+# How often a warm container emits its capacity totals
+USAGE_METRICS_INTERVAL_SECONDS = float(os.environ.get('USAGE_METRICS_INTERVAL_SECONDS', '60'))
+
+# Latency histogram upper bounds in ms; one more open-ended bucket follows the last
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+CALL_SERVICES = ('dynamodb', 'iot', 'sns', 'cognito', 'lambda')
+
+# Operations that are counted; anything else on a wrapped object passes straight through
+COUNTED_OPERATIONS = {
+    'get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan',
+    'batch_get_item', 'batch_write_item', 'transact_write_items',
+    'publish', 'invoke', 'create_topic', 'subscribe',
+    'admin_delete_user', 'admin_update_user_attributes',
+    'admin_add_user_to_group', 'admin_remove_user_from_group'
+}
+CAPACITY_OPERATIONS = {
+    'get_item', 'put_item', 'update_item', 'delete_item', 'query', 'scan',
+    'batch_get_item', 'batch_write_item', 'transact_write_items'
+}
+# Their consumed units are RCUs; every other capacity operation consumes WCUs
+READ_OPERATIONS = {'get_item', 'query', 'scan', 'batch_get_item'}
+# Units consumed outside any stage are attributed to this one
+NO_STAGE = 'other'
+
+
+class _NoopStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+class _Stage:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        with self.trace._lock:
+            self.trace.active.append(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        with self.trace._lock:
+            self.trace.active.remove(self.name)
+        self.trace.add_time(self.name, (time.monotonic() - self.started) * 1000)
+        return False
+
+
+class Trace:
+    """Timings and call counts collected during one sampled invocation"""
+
+    def __init__(self, function: str = None):
+        self.function = function
+        self.started = time.monotonic()
+        self.stages = {}
+        self.calls = {}
+        self.capacity = {}
+        # {stage: {'rcu': units, 'wcu': units}} - consumed capacity by the innermost open stage
+        self.units = {}
+        self.active = []
+        self.properties = {}
+        self.readings = 0
+        self._lock = threading.Lock()
+
+    def add_time(self, stage: str, elapsed_ms: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + elapsed_ms
+
+    def add_call(self, service: str, operation: str, capacity: float = None):
+        key = f"{service}.{operation}"
+        with self._lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            if capacity:
+                self.capacity[key] = self.capacity.get(key, 0.0) + capacity
+                stage = self.units.setdefault(self.active[-1] if self.active else NO_STAGE,
+                                              {'rcu': 0.0, 'wcu': 0.0})
+                stage['rcu' if operation in READ_OPERATIONS else 'wcu'] += capacity
+
+    def read_units(self) -> float:
+        return sum(stage['rcu'] for stage in self.units.values())
+
+    def write_units(self) -> float:
+        return sum(stage['wcu'] for stage in self.units.values())
+
+
+class Usage:
+    """Consumed capacity and readings of one invocation, sampled or not"""
+
+    def __init__(self, function: str = None, source: str = None):
+        self.function = function
+        self.source = source
+        self.readings = 0
+        self.rcu = 0.0
+        self.wcu = 0.0
+        self._lock = threading.Lock()
+
+    def add_units(self, operation: str, capacity: float):
+        with self._lock:
+            if operation in READ_OPERATIONS:
+                self.rcu += capacity
+            else:
+                self.wcu += capacity
+
+
+class _Instrumented:
+    """Proxy that counts calls (and DynamoDB consumed capacity) on a client, resource or table"""
+
+    def __init__(self, tracer, target, service: str):
+        self._tracer = tracer
+        self._target = target
+        self._service = service
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name not in COUNTED_OPERATIONS or not callable(attr):
+            return attr
+        tracer = self._tracer
+        service = self._service
+
+        track_capacity = service == 'dynamodb' and name in CAPACITY_OPERATIONS
+
+        def counted(*args, **kwargs):
+            trace = tracer.current
+            if trace is None and not track_capacity:
+                return attr(*args, **kwargs)
+            if track_capacity:
+                kwargs.setdefault('ReturnConsumedCapacity', 'TOTAL')
+            capacity = None
+            try:
+                response = attr(*args, **kwargs)
+                if track_capacity:
+                    capacity = consumed_units(response)
+                    tracer.usage.add_units(name, capacity)
+                return response
+            finally:
+                if trace is not None:
+                    trace.add_call(service, name, capacity)
+
+        return counted
+
+
+def consumed_units(response) -> float:
+    """Sum CapacityUnits from a response (single dict or per-table list)"""
+    consumed = response.get('ConsumedCapacity') if isinstance(response, dict) else None
+    if not consumed:
+        return 0.0
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    return float(sum(entry.get('CapacityUnits', 0) for entry in consumed))
+
+
+class Tracer:
+    """Owns the current trace and usage for one function and emits them as EMF"""
+
+    def __init__(self, function: str, enabled: bool = TRACING_ENABLED,
+                 sample_rate: float = TRACE_SAMPLE_RATE,
+                 interval: float = USAGE_METRICS_INTERVAL_SECONDS):
+        self.function = function
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.current = None
+        self.usage = Usage()
+        # {(function, source): {'invocations', 'readings', 'rcu', 'wcu'}} since the last flush
+        self.totals = {}
+        self.last_flush = time.monotonic()
+
+    def instrument(self, target, service: str):
+        """Wrap a boto3 client/resource/table for call counting (unchanged when disabled)"""
+        if not self.enabled:
+            return target
+        return _Instrumented(self, target, service)
+
+    def begin(self, function: str = None, source: str = None):
+        """
+        Start this invocation's usage, and its trace if it is sampled. function
+        overrides the Function dimension; source is logged with both (project_cost
+        counts the readings of source 'stream' invocations only once, at ingest).
+        """
+        self.usage = Usage(function, source)
+        if self.enabled and random.random() < self.sample_rate:
+            self.current = Trace(function)
+            if source is not None:
+                self.current.properties['source'] = source
+        else:
+            self.current = None
+
+    def stage(self, name: str):
+        """Context manager timing one stage; stages with the same name accumulate"""
+        trace = self.current
+        if trace is None:
+            return _NOOP_STAGE
+        return _Stage(trace, name)
+
+    def add_readings(self, count: int):
+        """Count readings handled, the denominator of the per-reading metrics"""
+        self.usage.readings += count
+        if self.current is not None:
+            self.current.readings += count
+
+    def set_property(self, name: str, value):
+        """Attach extra context (not a metric) to the current trace"""
+        if self.current is not None:
+            self.current.properties[name] = value
+
+    def end(self, emit: bool = True):
+        """
+        Clear the current trace and return it. Unless emit=False (the caller
+        reports tracer.usage itself, as the API does through RouteMetrics) the
+        trace is logged as one EMF line and the usage is added to the totals.
+        """
+        trace = self.current
+        self.current = None
+        if emit and self.enabled:
+            if trace is not None:
+                print(json.dumps(self.to_emf(trace)))
+            self.add_usage(self.usage)
+        return trace
+
+    def add_usage(self, usage: Usage):
+        """Add one invocation to the totals; emits them once the interval has passed"""
+        totals = self.totals.setdefault((usage.function or self.function, usage.source),
+                                        {'invocations': 0, 'readings': 0, 'rcu': 0.0, 'wcu': 0.0})
+        totals['invocations'] += 1
+        totals['readings'] += usage.readings
+        totals['rcu'] += usage.rcu
+        totals['wcu'] += usage.wcu
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Log one EMF totals line per function and source, and start new totals"""
+        totals, self.totals = self.totals, {}
+        self.last_flush = time.monotonic()
+        for (function, source), sums in sorted(totals.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            print(json.dumps(self.totals_emf(function, source, sums)))
+
+    def totals_emf(self, function: str, source: str, sums: dict) -> dict:
+        metrics = {
+            'Invocations': (sums['invocations'], 'Count'),
+            'TotalReadings': (sums['readings'], 'Count'),
+            'TotalRCU': (round(sums['rcu'], 3), 'None'),
+            'TotalWCU': (round(sums['wcu'], 3), 'None')
+        }
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+                }]
+            },
+            'Function': function
+        }
+        if source is not None:
+            record['source'] = source
+        for name, (value, _) in metrics.items():
+            record[name] = value
+        return record
+
+    def to_emf(self, trace: Trace) -> dict:
+        readings = max(trace.readings, 1)
+        metrics = {
+            'TotalMs': (round((time.monotonic() - trace.started) * 1000, 2), 'Milliseconds'),
+            'Readings': (trace.readings, 'Count')
+        }
+        for stage, elapsed_ms in trace.stages.items():
+            metrics[f"{stage}Ms"] = (round(elapsed_ms, 2), 'Milliseconds')
+
+        for service in ('dynamodb', 'iot', 'sns'):
+            count = sum(n for key, n in trace.calls.items() if key.startswith(service + '.'))
+            metrics[f"{service}Calls"] = (count, 'Count')
+            metrics[f"{service}CallsPerReading"] = (round(count / readings, 3), 'None')
+        capacity = sum(trace.capacity.values())
+        metrics['ConsumedCapacity'] = (round(capacity, 2), 'None')
+        metrics['ConsumedCapacityPerReading'] = (round(capacity / readings, 3), 'None')
+        metrics['ReadCapacity'] = (round(trace.read_units(), 2), 'None')
+        metrics['WriteCapacity'] = (round(trace.write_units(), 2), 'None')
+        metrics['ReadCapacityPerReading'] = (round(trace.read_units() / readings, 3), 'None')
+        metrics['WriteCapacityPerReading'] = (round(trace.write_units() / readings, 3), 'None')
+
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+                }]
+            },
+            'Function': trace.function or self.function,
+            'calls': trace.calls,
+            'capacity': {key: round(units, 2) for key, units in trace.capacity.items()},
+            'stage_capacity': stage_units(trace),
+            **trace.properties
+        }
+        for name, (value, _) in metrics.items():
+            record[name] = value
+        return record
+
+
+# ============= ROUTE METRICS =============
+
+def service_calls(trace: Trace) -> dict:
+    """{service: call count} for a trace"""
+    counts = {}
+    for key, count in trace.calls.items():
+        service = key.split('.', 1)[0]
+        counts[service] = counts.get(service, 0) + count
+    return counts
+
+
+def stage_units(trace: Trace) -> dict:
+    """{stage: {'rcu', 'wcu'}} rounded for logging"""
+    return {stage: {kind: round(units, 3) for kind, units in counts.items()}
+            for stage, counts in sorted(trace.units.items())}
+
+
+class RouteStats:
+    """One route's requests since the last flush"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.traced = 0
+        self.calls = {}
+        self.rcu = 0.0
+        self.wcu = 0.0
+
+    def add(self, elapsed_ms: float, status_code: int, trace: Trace = None, usage: Usage = None):
+        self.count += 1
+        if status_code >= 500:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        if trace is not None:
+            self.traced += 1
+            for service, count in service_calls(trace).items():
+                self.calls[service] = self.calls.get(service, 0) + count
+        if usage is not None:
+            self.rcu += usage.rcu
+            self.wcu += usage.wcu
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the percentile (never above the max seen)"""
+        rank = max(1, int(fraction * self.count + 0.999999))
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                bound = LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+                return round(min(bound, self.max_ms), 2)
+        return round(self.max_ms, 2)
+
+
+class RouteMetrics:
+    """Per-route latency histograms and call counts for one warm container, emitted as EMF"""
+
+    def __init__(self, function: str, enabled: bool = TRACING_ENABLED,
+                 interval: float = ROUTE_METRICS_INTERVAL_SECONDS):
+        self.function = function
+        self.enabled = enabled
+        self.interval = interval
+        self.routes = {}
+        self.last_flush = time.monotonic()
+
+    def record(self, route: str, elapsed_ms: float, status_code: int, trace: Trace = None,
+               usage: Usage = None):
+        """Add one request (usage: its Tracer.usage); emits everything collected once the interval has passed"""
+        if not self.enabled:
+            return
+        stats = self.routes.get(route)
+        if stats is None:
+            stats = self.routes[route] = RouteStats()
+        stats.add(elapsed_ms, status_code, trace, usage)
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Log one EMF line per route and start new histograms"""
+        routes, self.routes = self.routes, {}
+        self.last_flush = time.monotonic()
+        for route, stats in sorted(routes.items()):
+            print(json.dumps(self.to_emf(route, stats)))
+
+    def to_emf(self, route: str, stats: RouteStats) -> dict:
+        metrics = {
+            'Requests': (stats.count, 'Count'),
+            'Errors': (stats.errors, 'Count'),
+            'LatencyAvgMs': (round(stats.total_ms / stats.count, 2), 'Milliseconds'),
+            'LatencyP50Ms': (stats.percentile(0.5), 'Milliseconds'),
+            'LatencyP95Ms': (stats.percentile(0.95), 'Milliseconds'),
+            'LatencyP99Ms': (stats.percentile(0.99), 'Milliseconds'),
+            'LatencyMaxMs': (round(stats.max_ms, 2), 'Milliseconds'),
+            # Every request's capacity, not only the traced ones'
+            'RCUPerRequest': (round(stats.rcu / stats.count, 3), 'None'),
+            'WCUPerRequest': (round(stats.wcu / stats.count, 3), 'None')
+        }
+        if stats.traced:
+            for service in CALL_SERVICES:
+                metrics[f"{service}CallsPerRequest"] = (
+                    round(stats.calls.get(service, 0) / stats.traced, 2), 'None')
+
+        bounds = [f"le_{bound}" for bound in LATENCY_BUCKETS_MS] + ['le_inf']
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function', 'Route']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+                }]
+            },
+            'Function': self.function,
+            'Route': route,
+            # Bucket counts for Logs Insights; the EMF percentiles are bucket upper bounds
+            'histogram': {bound: count for bound, count in zip(bounds, stats.buckets) if count},
+            # Sums behind the per-request averages, so tools/project_cost.py can combine lines
+            # exactly: call counts are over the traced requests, rcu/wcu over all Requests
+            'traced': stats.traced,
+            'rcu': round(stats.rcu, 3),
+            'wcu': round(stats.wcu, 3)
+        }
+        for name, (value, _) in metrics.items():
+            record[name] = value
+        return record
+
+
+def server_timing(total_ms: float, trace: Trace = None) -> str:
+    """Server-Timing header value: total, each stage, and per-service call counts"""
+    entries = [f"total;dur={total_ms:.1f}"]
+    if trace is not None:
+        for stage, elapsed_ms in trace.stages.items():
+            entries.append(f"{stage};dur={elapsed_ms:.1f}")
+        for service, count in sorted(service_calls(trace).items()):
+            detail = f"{count} calls"
+            if service == 'dynamodb':
+                detail += f" {trace.read_units():g} RCU {trace.write_units():g} WCU"
+            entries.append(f'{service};desc="{detail}"')
+    return ', '.join(entries)
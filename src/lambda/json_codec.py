@@ -0,0 +1,55 @@
+"""
+EcoShower - JSON encoding for API responses
+DynamoDB returns every number as a Decimal, which no JSON encoder handles
+natively; both backends here turn them into floats through a default() hook,
+as the old DecimalEncoder did.
+
+dumps() uses orjson when it is packaged with the function - it calls the hook
+from C and encodes the admin and dashboard payloads 2-3x faster - and the
+stdlib encoder otherwise.
+
+    body = dumps({'devices': devices})    # str, compact, non-ASCII kept
+
+tools/bench_json.py measures the backends on admin-sized payloads. Converting
+the item tree to plain floats in one pass before encoding was measured there
+too: it only pays off on all-numeric lists and is slower on user and device
+lists, so the stdlib path keeps the hook.
+"""
+
+import json
+import os
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError:
+    # Optional - add it to the deployment package (or a layer) for faster encoding
+    orjson = None
+
+# 'auto' (orjson when installed) or 'stdlib'
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def default(value):
+    """Decimal -> float, DynamoDB sets -> lists; anything else is an error"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def backend() -> str:
+    """Encoder dumps() uses: 'orjson' or 'stdlib'"""
+    if JSON_BACKEND == 'stdlib' or orjson is None:
+        return 'stdlib'
+    return 'orjson'
+
+
+def dumps(value, backend_name: str = None) -> str:
+    """Encode a response body (compact separators, UTF-8 text kept as is)"""
+    if (backend_name or backend()) == 'orjson':
+        return orjson.dumps(value, default=default, option=_ORJSON_OPTIONS).decode()
+    return json.dumps(value, default=default, ensure_ascii=False, separators=(',', ':'))
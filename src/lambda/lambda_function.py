@@ -3,44 +3,154 @@ EcoShower - API Lambda
 Handles all REST API requests for users, devices, and dashboard
 """
 
+import base64
+import gzip
+import heapq
 import json
-import boto3
 import os
+import queue
+import random
+import re
+import threading
+import time
 import uuid
-from datetime import datetime, timedelta
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import chain, islice
 from decimal import Decimal
 from boto3.dynamodb.conditions import Key
-
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
-iot_client = boto3.client('iot-data')
+from botocore.exceptions import ClientError
+import json_codec
+from telemetry_codec import decode_chunk
+from instrumentation import RouteMetrics, Tracer, server_timing
+from aws_clients import TTLCache, lazy_client, lazy_resource, lazy_table
+from local_time import local_date
+
+# Per-route timings and AWS call counts (see instrumentation.py). Counting is cheap next to
+# the calls themselves, so the API traces every request unless TRACE_SAMPLE_RATE says otherwise;
+# consumed capacity is counted on every request either way.
+tracer = Tracer('api', sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', '1')))
+route_metrics = RouteMetrics('api')
+
+# Initialize AWS clients - created on first use, so each route only pays for what it touches
+dynamodb = tracer.instrument(lazy_resource('dynamodb'), 'dynamodb')
+iot_client = tracer.instrument(lazy_client('iot-data'), 'iot')
+lambda_client = tracer.instrument(lazy_client('lambda'), 'lambda')
 
 # Environment variables
 USERS_TABLE = os.environ.get('USERS_TABLE', 'EcoShower-Users')
 DEVICES_TABLE = os.environ.get('DEVICES_TABLE', 'EcoShower-Devices')
 SESSIONS_TABLE = os.environ.get('SESSIONS_TABLE', 'EcoShower-Sessions')
 TELEMETRY_TABLE = os.environ.get('TELEMETRY_TABLE', 'EcoShower-Telemetry')
+ROLLUPS_TABLE = os.environ.get('ROLLUPS_TABLE', 'EcoShower-TelemetryRollups')
+TELEMETRY_CHUNKS_TABLE = os.environ.get('TELEMETRY_CHUNKS_TABLE', 'EcoShower-TelemetryChunks')
+USER_STATS_TABLE = os.environ.get('USER_STATS_TABLE', 'EcoShower-UserStats')
+# Admin dashboard counters maintained by stats_materializer
+STATS_TABLE = os.environ.get('STATS_TABLE', 'EcoShower-SystemStats')
+JOBS_TABLE = os.environ.get('JOBS_TABLE', 'EcoShower-Jobs')
+# Must match the telemetry lambda: 'items' or 'chunked'
+TELEMETRY_STORAGE_MODE = os.environ.get('TELEMETRY_STORAGE_MODE', 'items')
+TELEMETRY_CHUNK_SECONDS = int(os.environ.get('TELEMETRY_CHUNK_SECONDS', '3600'))
+# Add Server-Timing headers (total, handler, per-service call counts) to every response
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'false').lower() == 'true'
+# Gzip/deflate response bodies of at least this many bytes when the client accepts it; 0 disables.
+# Needs binaryMediaTypes */* on the REST API, or clients receive the base64 text.
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '0'))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '5'))
+# Log the whole API Gateway event instead of one line per request
+LOG_REQUEST_EVENTS = os.environ.get('LOG_REQUEST_EVENTS', 'false').lower() == 'true'
 
 
 # initialize sns and cognito
-sns_client = boto3.client('sns')
-cognito_client = boto3.client('cognito-idp')
+sns_client = tracer.instrument(lazy_client('sns'), 'sns')
+cognito_client = tracer.instrument(lazy_client('cognito-idp'), 'cognito')
 USER_POOL_ID = os.environ.get('USER_POOL_ID', 'eu-north-1_q1X9yXVs5')
 
 
 # Tables
-users_table = dynamodb.Table(USERS_TABLE)
-devices_table = dynamodb.Table(DEVICES_TABLE)
-sessions_table = dynamodb.Table(SESSIONS_TABLE)
-telemetry_table = dynamodb.Table(TELEMETRY_TABLE)
-
-
-class DecimalEncoder(json.JSONEncoder):
-    """Custom JSON encoder for Decimal types"""
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super().default(obj)
+users_table = tracer.instrument(lazy_table(dynamodb, USERS_TABLE), 'dynamodb')
+devices_table = tracer.instrument(lazy_table(dynamodb, DEVICES_TABLE), 'dynamodb')
+sessions_table = tracer.instrument(lazy_table(dynamodb, SESSIONS_TABLE), 'dynamodb')
+telemetry_table = tracer.instrument(lazy_table(dynamodb, TELEMETRY_TABLE), 'dynamodb')
+rollups_table = tracer.instrument(lazy_table(dynamodb, ROLLUPS_TABLE), 'dynamodb')
+chunks_table = tracer.instrument(lazy_table(dynamodb, TELEMETRY_CHUNKS_TABLE), 'dynamodb')
+user_stats_table = tracer.instrument(lazy_table(dynamodb, USER_STATS_TABLE), 'dynamodb')
+stats_table = tracer.instrument(lazy_table(dynamodb, STATS_TABLE), 'dynamodb')
+jobs_table = tracer.instrument(lazy_table(dynamodb, JOBS_TABLE), 'dynamodb')
+
+# Admin scans run as DynamoDB parallel scans with this many segments (threads); 1 = sequential
+SCAN_SEGMENTS = int(os.environ.get('SCAN_SEGMENTS', '4'))
+
+# Cascade deletes (device/user history): batched, (device, table) pairs in parallel.
+# Deletes of more sessions than the threshold - or that do not finish inline - run as async jobs.
+CASCADE_KINDS = ('sessions', 'telemetry', 'rollups', 'chunks')
+BATCH_WRITE_LIMIT = 25
+CASCADE_MAX_WORKERS = int(os.environ.get('CASCADE_MAX_WORKERS', '8'))
+CASCADE_MAX_RETRIES = int(os.environ.get('CASCADE_MAX_RETRIES', '8'))
+CASCADE_RETRY_BASE_SECONDS = float(os.environ.get('CASCADE_RETRY_BASE_SECONDS', '0.05'))
+CASCADE_ASYNC_THRESHOLD = int(os.environ.get('CASCADE_ASYNC_THRESHOLD', '200'))
+CASCADE_SYNC_SECONDS = float(os.environ.get('CASCADE_SYNC_SECONDS', '10'))
+JOB_EVENT_SOURCE = 'ecoshower.jobs'
+JOB_FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'EcoShower-API')
+JOB_TIME_MARGIN_SECONDS = float(os.environ.get('JOB_TIME_MARGIN_SECONDS', '5'))
+JOB_MAX_RUNS = int(os.environ.get('JOB_MAX_RUNS', '50'))
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', '7'))
+# A job still queued this long after it was saved is invoked again when its status is read
+JOB_STALL_SECONDS = float(os.environ.get('JOB_STALL_SECONDS', '60'))
+
+# GET /devices?verify=true recomputes stats with this many concurrent session queries
+VERIFY_MAX_WORKERS = int(os.environ.get('VERIFY_MAX_WORKERS', '8'))
+
+# Dashboard days are Israel local dates (see local_time); the user aggregate keeps this many daily buckets
+USER_STATS_DAILY_DAYS = int(os.environ.get('USER_STATS_DAILY_DAYS', '400'))
+# Passes rebuild_user_stats makes before leaving an aggregate build to the next request
+USER_STATS_BUILD_ATTEMPTS = 3
+
+# GET /dashboard/history page size cap and per-device query sizes for the merge
+HISTORY_MAX_LIMIT = int(os.environ.get('HISTORY_MAX_LIMIT', '100'))
+HISTORY_MIN_FETCH = int(os.environ.get('HISTORY_MIN_FETCH', '5'))
+HISTORY_MAX_FETCH = int(os.environ.get('HISTORY_MAX_FETCH', '100'))
+
+# Sessions GSI keyed by user_id / start_time. Unset (the default) merges the per-device
+# device-index queries; set it to 'user-start-index' once the index is ACTIVE and
+# tools/backfill_session_index.py has run.
+SESSIONS_USER_INDEX = os.environ.get('SESSIONS_USER_INDEX', '')
+
+# User settings (water price, units, language, SNS topic) cached across warm invocations.
+# The telemetry lambda keeps its own copy and picks up changes within the same window.
+CONFIG_CACHE_TTL_SECONDS = float(os.environ.get('CONFIG_CACHE_TTL_SECONDS', '30'))
+CONFIG_CACHE_MAX_ITEMS = int(os.environ.get('CONFIG_CACHE_MAX_ITEMS', '1024'))
+
+# Device -> owner cached across warm invocations for ownership checks. A device's owner never
+# changes after add_device; deletes drop the entry here, other containers see them within the TTL.
+OWNER_CACHE_TTL_SECONDS = float(os.environ.get('OWNER_CACHE_TTL_SECONDS', '60'))
+OWNER_CACHE_MAX_ITEMS = int(os.environ.get('OWNER_CACHE_MAX_ITEMS', '4096'))
+
+user_cache = TTLCache(CONFIG_CACHE_MAX_ITEMS, CONFIG_CACHE_TTL_SECONDS)
+owner_cache = TTLCache(OWNER_CACHE_MAX_ITEMS, OWNER_CACHE_TTL_SECONDS)
+
+# Device items read by the current request: device_id -> (consistent, item or None).
+# Cleared by lambda_handler, so one request never reads the same device twice.
+request_devices = {}
+
+
+def get_user_settings(user_id: str) -> dict:
+    """Get a user item for read-only settings lookups (cached)"""
+    if not user_id:
+        return {}
+    user = user_cache.get(user_id)
+    if user is None:
+        result = users_table.get_item(Key={'user_id': user_id})
+        user = result.get('Item')
+        if user:
+            user_cache.set(user_id, user)
+    return user or {}
+
+
+def invalidate_user_settings(user_id: str):
+    """Invalidation hook - call after any write to a user's settings"""
+    user_cache.invalidate(user_id)
 
 
 def response(status_code: int, body: dict) -> dict:
@@ -53,36 +163,203 @@ def response(status_code: int, body: dict) -> dict:
             'Access-Control-Allow-Headers': 'Content-Type,Authorization,X-Amz-Date,X-Api-Key,X-Amz-Security-Token',
             'Access-Control-Allow-Methods': 'GET,POST,PUT,DELETE,OPTIONS'
         },
-        'body': json.dumps(body, cls=DecimalEncoder, ensure_ascii=False)
+        'body': json_codec.dumps(body)
     }
 
 
+def accepted_encoding(headers: dict) -> str:
+    """'gzip', 'deflate' or None from the request's Accept-Encoding (gzip wins ties, q=0 excluded)"""
+    value = next((v for k, v in (headers or {}).items() if k.lower() == 'accept-encoding'), None) or ''
+    weights = {}
+    for part in value.split(','):
+        name, _, params = part.partition(';')
+        weight = 1.0
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    
+    best, best_weight = None, 0.0
+    for encoding in ('gzip', 'deflate'):
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress_response(result: dict, encoding: str, min_bytes: int = None, level: int = None) -> dict:
+    """Compress a large response body in place, base64-encoded as API Gateway expects binary bodies"""
+    min_bytes = COMPRESSION_MIN_BYTES if min_bytes is None else min_bytes
+    level = COMPRESSION_LEVEL if level is None else level
+    body = result.get('body')
+    if min_bytes <= 0 or not body or result.get('isBase64Encoded'):
+        return result
+    raw = body.encode('utf-8')
+    if len(raw) < min_bytes:
+        return result
+    
+    # Caches must not hand a compressed body to a client that did not ask for one
+    result['headers']['Vary'] = 'Accept-Encoding'
+    if encoding == 'gzip':
+        packed = gzip.compress(raw, compresslevel=level, mtime=0)
+    elif encoding == 'deflate':
+        packed = zlib.compress(raw, level)
+    else:
+        return result
+    if len(packed) >= len(raw):
+        return result
+    
+    result['body'] = base64.b64encode(packed).decode('ascii')
+    result['isBase64Encoded'] = True
+    result['headers']['Content-Encoding'] = encoding
+    return result
+
+
+# ============= ROUTES =============
+
+# (method, path template, route name, handler). Handlers take the parsed request dict:
+# method, path, params, query, body, user_id, role, email, name
+ROUTES = [
+    ('GET', '/devices', 'devices.list',
+     lambda r: list_devices(r['user_id'], verify=str(r['query'].get('verify', '')).lower() == 'true')),
+    ('POST', '/devices', 'devices.add', lambda r: add_device(r['body'], r['user_id'])),
+    ('GET', '/devices/{device_id}', 'devices.get',
+     lambda r: get_device(r['params']['device_id'], r['user_id'], r['role'])),
+    ('PUT', '/devices/{device_id}', 'devices.update',
+     lambda r: update_device(r['params']['device_id'], r['body'], r['user_id'], r['role'])),
+    ('DELETE', '/devices/{device_id}', 'devices.delete',
+     lambda r: delete_device(r['params']['device_id'], r['user_id'], r['role'])),
+    ('POST', '/devices/{device_id}/command', 'devices.command',
+     lambda r: send_command(r['params']['device_id'], r['body'], r['user_id'], r['role'])),
+    ('POST', '/devices/{device_id}/start', 'devices.start',
+     lambda r: start_session(r['params']['device_id'], r['body'], r['user_id'], r['role'])),
+    ('POST', '/devices/{device_id}/stop', 'devices.stop',
+     lambda r: stop_session(r['params']['device_id'], r['body'], r['user_id'], r['role'])),
+    # Mark water as ready (Mock)
+    ('POST', '/devices/{device_id}/ready', 'devices.ready',
+     lambda r: mark_water_ready(r['params']['device_id'], r['user_id'], r['role'])),
+    
+    ('GET', '/dashboard/summary', 'dashboard.summary', lambda r: get_summary(r['user_id'])),
+    ('GET', '/dashboard/history', 'dashboard.history', lambda r: dashboard_history(r['query'], r['user_id'])),
+    ('GET', '/dashboard/realtime/{device_id}', 'dashboard.realtime',
+     lambda r: get_realtime(r['params']['device_id'], r['user_id'])),
+    ('GET', '/dashboard/trends/{device_id}', 'dashboard.trends',
+     lambda r: dashboard_trends(r['params']['device_id'], r['query'], r['user_id'])),
+    
+    ('DELETE', '/sessions/{session_id}', 'sessions.delete',
+     lambda r: delete_session(r['params']['session_id'], r['user_id'])),
+    
+    ('GET', '/users', 'users.get', lambda r: get_user_profile(r['user_id'], r['email'], r['name'])),
+    ('GET', '/users/me', 'users.get', lambda r: get_user_profile(r['user_id'], r['email'], r['name'])),
+    ('PUT', '/users', 'users.update', lambda r: update_user_profile(r['user_id'], r['body'])),
+    ('PUT', '/users/me', 'users.update', lambda r: update_user_profile(r['user_id'], r['body'])),
+    
+    ('GET', '/settings', 'settings.get', lambda r: get_settings(r['user_id'])),
+    ('PUT', '/settings', 'settings.update', lambda r: update_settings(r['user_id'], r['body'])),
+    
+    # Everything under /admin also requires the admin role (checked in handle_request)
+    ('GET', '/admin/stats', 'admin.stats', lambda r: get_system_stats(r['query'].get('userId'))),
+    ('GET', '/admin/users', 'admin.users', lambda r: list_all_users()),
+    ('DELETE', '/admin/users/{user_id}', 'admin.delete_user',
+     lambda r: delete_user_admin(r['params']['user_id'])),
+    ('POST', '/admin/users/{user_id}/role', 'admin.update_role',
+     lambda r: admin_update_role(r['params']['user_id'], r['body'])),
+    ('GET', '/admin/devices', 'admin.devices', lambda r: list_all_devices()),
+    
+    # Background job status
+    ('GET', '/jobs/{job_id}', 'jobs.get', lambda r: get_job(r['params']['job_id'], r['user_id'], r['role']))
+]
+
+# Templates compiled once per container: {name} matches one path segment
+ROUTE_TABLE = [
+    (method, re.compile('^' + re.sub(r'\{(\w+)\}', r'(?P<\1>[^/]+)', template) + '/?$'), name, handler)
+    for method, template, name, handler in ROUTES
+]
+
+
+def resolve_route(method: str, path: str):
+    """
+    (route name, handler, path params) for a request. Unknown paths resolve to
+    'not_found' and known paths with another method to 'method_not_allowed',
+    both with handler None.
+    """
+    path_known = False
+    for route_method, pattern, name, handler in ROUTE_TABLE:
+        match = pattern.match(path)
+        if match:
+            if route_method == method:
+                return name, handler, match.groupdict()
+            path_known = True
+    return ('method_not_allowed' if path_known else 'not_found'), None, {}
+
+
 def lambda_handler(event, context):
     """Main handler for API requests"""
+    request_devices.clear()
+    
+    # Background cascade jobs invoke this function directly
+    if event.get('source') == JOB_EVENT_SOURCE:
+        return run_job(event['job_id'], context)
+    
+    started = time.monotonic()
+    tracer.begin()
+    route, result = handle_request(event)
+    if COMPRESSION_MIN_BYTES > 0:
+        with tracer.stage('compress'):
+            compress_response(result, accepted_encoding(event.get('headers')))
+    elapsed_ms = (time.monotonic() - started) * 1000
+    trace = tracer.end(emit=False)
+    
+    route_metrics.record(route, elapsed_ms, result['statusCode'], trace, tracer.usage)
+    print(f"{event.get('httpMethod')} {event.get('path')} -> {route} {result['statusCode']} ({elapsed_ms:.1f} ms)")
+    if SERVER_TIMING_ENABLED:
+        result['headers'].update({
+            'Server-Timing': server_timing(elapsed_ms, trace),
+            # Lets the dashboard read the header cross-origin (fetch and Resource Timing)
+            'Access-Control-Expose-Headers': 'Server-Timing',
+            'Timing-Allow-Origin': '*'
+        })
+    return result
+
+
+def handle_request(event: dict) -> tuple:
+    """Parse and route one API Gateway request -> (route name, response)"""
+    route = 'not_found'
     try:
-        print(f"Received event: {json.dumps(event)}")
+        if LOG_REQUEST_EVENTS:
+            print(f"Received event: {json.dumps(event)}")
         
         # Handle CORS preflight
         if event.get('httpMethod') == 'OPTIONS':
-            return response(200, {'message': 'OK'})
+            return 'options', response(200, {'message': 'OK'})
         
         # Get request info
         http_method = event.get('httpMethod', '')
         path = event.get('path', '')
-        path_params = event.get('pathParameters') or {}
+        route, handler, route_params = resolve_route(http_method, path)
+        path_params = {**(event.get('pathParameters') or {}), **route_params}
         query_params = event.get('queryStringParameters') or {}
         
-        # Parse body if present
+        # Parse body if present. With binaryMediaTypes */* (for compressed responses)
+        # API Gateway hands request bodies over base64-encoded as well.
         body = {}
         if event.get('body'):
             try:
-                body = json.loads(event['body'])
-            except json.JSONDecodeError:
-                return response(400, {'error': 'Invalid JSON body'})
+                raw_body = event['body']
+                if event.get('isBase64Encoded'):
+                    raw_body = base64.b64decode(raw_body, validate=True)
+                body = json.loads(raw_body)
+            except ValueError:
+                return route, response(400, {'error': 'Invalid JSON body'})
         
         # Get user info from authorizer
         user_id = None
         user_role = 'user'
+        user_email = None
+        user_name = None
         
         auth_context = event.get('requestContext', {}).get('authorizer')
         if auth_context:
@@ -130,93 +407,74 @@ def lambda_handler(event, context):
             # Note: We continue, but downstream will fail with 403.
 
         
-        # Route the request
-        # Device routes
-        if path.startswith('/devices'):
-            return handle_devices(http_method, path, path_params, body, user_id, user_role)
-        
-        # Dashboard routes
-        elif path.startswith('/dashboard'):
-            return handle_dashboard(http_method, path, path_params, query_params, user_id)
-
-        # Session routes
-        elif path.startswith('/sessions'):
-            if http_method == 'DELETE':
-                # DELETE /sessions/{sessionId}
-                parts = path.split('/')
-                if len(parts) >= 3:
-                     # Add extra debug
-                     print(f"Routing DELETE session {parts[2]} for user {user_id}")
-                     return delete_session(parts[2], user_id)
-            return response(405, {'error': 'Method not allowed'})
-        
-        # User profile routes
-        elif path.startswith('/users'):
-            return handle_users(http_method, path, path_params, body, user_id, user_role, user_email, user_name)
+        if path.startswith('/admin') and user_role != 'admin':
+            return route, response(403, {'error': 'Admin access required'})
+        if handler is None:
+            if route == 'method_not_allowed':
+                return route, response(405, {'error': 'Method not allowed'})
+            return route, response(404, {'error': 'Route not found'})
         
-        # Admin routes
-        elif path.startswith('/admin'):
-            if user_role != 'admin':
-                return response(403, {'error': 'Admin access required'})
-            return handle_admin(http_method, path, path_params, query_params, body)
-        
-        # Settings routes
-        elif path.startswith('/settings'):
-            return handle_settings(http_method, body, user_id)
-        
-        else:
-            return response(404, {'error': 'Route not found'})
+        request = {
+            'method': http_method, 'path': path, 'params': path_params, 'query': query_params,
+            'body': body, 'user_id': user_id, 'role': user_role, 'email': user_email, 'name': user_name
+        }
+        with tracer.stage('handler'):
+            return route, handler(request)
             
     except Exception as e:
         print(f"CRITICAL LAMBDA ERROR: {str(e)}")
         # Return 500 with headers to avoid CORS error on client
-        return response(500, {'error': f"Internal Server Error: {str(e)}"})
+        return route, response(500, {'error': f"Internal Server Error: {str(e)}"})
 
 
 # ============= DEVICES =============
 
-def handle_devices(method: str, path: str, params: dict, body: dict, 
-                   user_id: str, role: str) -> dict:
-    """Handle device-related requests"""
-    device_id = params.get('device_id')
-    
-    # GET /devices - List user's devices
-    if method == 'GET' and not device_id:
-        return list_devices(user_id)
-    
-    # GET /devices/{id} - Get device details
-    elif method == 'GET' and device_id:
-        return get_device(device_id, user_id, role)
-    
-    # POST /devices - Add new device
-    elif method == 'POST' and not device_id:
-        return add_device(body, user_id)
-    
-    # PUT /devices/{id} - Update device
-    elif method == 'PUT' and device_id:
-        return update_device(device_id, body, user_id, role)
-    
-    # DELETE /devices/{id} - Delete device
-    elif method == 'DELETE' and device_id:
-        return delete_device(device_id, user_id, role)
-    
-    # POST /devices/{id}/command - Send command
-    elif method == 'POST' and '/command' in path:
-        return send_command(device_id, body, user_id, role)
-    
-    # POST /devices/{id}/start - Start shower session
-    elif method == 'POST' and '/start' in path:
-        return start_session(device_id, body, user_id, role)
+def load_device(device_id: str, consistent: bool = False) -> dict:
+    """
+    Get a device item, at most once per request. A consistent read is only
+    answered from the request's earlier read if that one was consistent too.
+    """
+    seen = request_devices.get(device_id)
+    if seen and (seen[0] or not consistent):
+        return seen[1]
+    
+    get_kwargs = {'Key': {'device_id': device_id}}
+    if consistent:
+        get_kwargs['ConsistentRead'] = True
+    device = devices_table.get_item(**get_kwargs).get('Item')
+    request_devices[device_id] = (consistent, device)
+    if device and device.get('user_id'):
+        owner_cache.set(device_id, device['user_id'])
+    else:
+        owner_cache.invalidate(device_id)
+    return device
 
-    # POST /devices/{id}/stop - Stop shower session
-    elif method == 'POST' and '/stop' in path:
-        return stop_session(device_id, body, user_id, role)
 
-    # POST /devices/{id}/ready - Mark water as ready (Mock)
-    elif method == 'POST' and '/ready' in path:
-        return mark_water_ready(device_id, user_id, role)
-    
-    return response(404, {'error': 'Device route not found'})
+def device_owner(device_id: str) -> str:
+    """Owner user_id of a device, None if it does not exist (cached across warm invocations)"""
+    seen = request_devices.get(device_id)
+    if seen:
+        return (seen[1] or {}).get('user_id')
+    owner = owner_cache.get(device_id)
+    if owner is None:
+        owner = (load_device(device_id) or {}).get('user_id')
+    return owner
+
+
+def check_device_access(device_id: str, user_id: str, role: str) -> dict:
+    """None if the caller may use the device, otherwise the 404/403 response"""
+    owner = device_owner(device_id)
+    if owner is None:
+        return response(404, {'error': 'Device not found'})
+    if role != 'admin' and owner != user_id:
+        return response(403, {'error': 'Access denied'})
+    return None
+
+
+def forget_device(device_id: str):
+    """Invalidation hook - call after deleting a device or changing its owner"""
+    request_devices.pop(device_id, None)
+    owner_cache.invalidate(device_id)
 
 
 # Helper to ensure user has a private topic
@@ -248,8 +506,7 @@ def ensure_user_topic(user_id: str, email: str = None) -> str:
 def mark_water_ready(device_id: str, user_id: str, role: str) -> dict:
     """Mark device as ready and send notification"""
     # Check device ownership
-    result = devices_table.get_item(Key={'device_id': device_id})
-    device = result.get('Item')
+    device = load_device(device_id)
     
     if not device:
         return response(404, {'error': 'Device not found'})
@@ -269,8 +526,7 @@ def mark_water_ready(device_id: str, user_id: str, role: str) -> dict:
     try:
         # Get user profile for topic ARN
         owner_id = device.get('user_id')
-        user_result = users_table.get_item(Key={'user_id': owner_id})
-        user = user_result.get('Item', {})
+        user = get_user_settings(owner_id)
         
         target_temp = device.get('target_temp', 38)
         
@@ -322,6 +578,7 @@ def mark_water_ready(device_id: str, user_id: str, role: str) -> dict:
                             UpdateExpression='SET sns_topic_arn = :arn',
                             ExpressionAttributeValues={':arn': topic_arn}
                         )
+                        invalidate_user_settings(owner_id)
 
             if topic_arn:
                 sns_client.publish(
@@ -342,45 +599,73 @@ def mark_water_ready(device_id: str, user_id: str, role: str) -> dict:
 
 
 
-def list_devices(user_id: str) -> dict:
-    """List all devices for a user with dynamic stats"""
-    result = devices_table.query(
+def list_devices(user_id: str, verify: bool = False) -> dict:
+    """
+    List all devices for a user.
+    
+    Stats come from the total_sessions / total_water_saved counters that
+    stop_session and delete_session keep on the device item. With verify=True
+    they are recomputed from the sessions table instead (one paginated query
+    per device, run concurrently) and any drift is logged.
+    """
+    devices = query_all_items(
+        devices_table,
         IndexName='user-index',
         KeyConditionExpression=Key('user_id').eq(user_id)
     )
-    devices = result.get('Items', [])
     
-    # Calculate true stats from sessions table
     for device in devices:
-        try:
-            device_id = device.get('device_id')
-            session_result = sessions_table.query(
-                IndexName='device-index',
-                KeyConditionExpression=Key('device_id').eq(device_id),
-                Select='SPECIFIC_ATTRIBUTES',
-                ProjectionExpression='water_saved'
-            )
-            
-            sessions = session_result.get('Items', [])
-            count = len(sessions)
-            total_water = sum(Decimal(str(s.get('water_saved', 0))) for s in sessions)
-            
-            # Override stored values with calculated ones
+        # The client's next calls are usually about these devices
+        owner_cache.set(device['device_id'], user_id)
+        device['total_sessions'] = device.get('total_sessions', 0)
+        device['total_water_saved'] = device.get('total_water_saved', Decimal('0'))
+    
+    if verify and devices:
+        with ThreadPoolExecutor(max_workers=min(len(devices), VERIFY_MAX_WORKERS)) as pool:
+            totals = list(pool.map(compute_device_totals, [d['device_id'] for d in devices]))
+        
+        for device, (count, water) in zip(devices, totals):
+            if count != device['total_sessions'] or water != device['total_water_saved']:
+                print(f"Stats drift on device {device['device_id']}: stored "
+                      f"{device['total_sessions']}/{device['total_water_saved']}, actual {count}/{water}")
             device['total_sessions'] = count
-            device['total_water_saved'] = total_water
-            
-        except Exception as e:
-            print(f"Error calculating stats for device {device.get('device_id')}: {e}")
-            # Fallback to stored values if calculation fails
-            pass
+            device['total_water_saved'] = water
 
     return response(200, {'devices': devices})
 
 
+def iter_query(table, **kwargs):
+    """Yield a query's items page by page, following LastEvaluatedKey to the end"""
+    while True:
+        result = table.query(**kwargs)
+        yield from result.get('Items', [])
+        if 'LastEvaluatedKey' not in result:
+            return
+        kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
+
+
+def query_all_items(table, **kwargs) -> list:
+    """Run a query and follow LastEvaluatedKey to the end"""
+    return list(iter_query(table, **kwargs))
+
+
+def compute_device_totals(device_id: str) -> tuple:
+    """(completed session count, water saved) for a device, straight from its sessions"""
+    sessions = query_all_items(
+        sessions_table,
+        IndexName='device-index',
+        KeyConditionExpression=Key('device_id').eq(device_id),
+        ProjectionExpression='water_saved, #s',
+        ExpressionAttributeNames={'#s': 'status'}
+    )
+    # Matches the counters: a session is counted when it is stopped
+    completed = [s for s in sessions if s.get('status') != 'active']
+    return len(completed), sum(Decimal(str(s.get('water_saved', 0))) for s in completed)
+
+
 def get_device(device_id: str, user_id: str, role: str) -> dict:
     """Get device details"""
-    result = devices_table.get_item(Key={'device_id': device_id})
-    device = result.get('Item')
+    device = load_device(device_id)
     
     if not device:
         return response(404, {'error': 'Device not found'})
@@ -421,20 +706,16 @@ def add_device(body: dict, user_id: str) -> dict:
     }
     
     devices_table.put_item(Item=device)
+    owner_cache.set(device_id, user_id)
     return response(210, {'device': device})
 
 
 def update_device(device_id: str, body: dict, user_id: str, role: str) -> dict:
     """Update device settings"""
     # Check ownership
-    result = devices_table.get_item(Key={'device_id': device_id})
-    device = result.get('Item')
-    
-    if not device:
-        return response(404, {'error': 'Device not found'})
-    
-    if role != 'admin' and device.get('user_id') != user_id:
-        return response(403, {'error': 'Access denied'})
+    denied = check_device_access(device_id, user_id, role)
+    if denied:
+        return denied
     
     # Build update expression
     update_expr = 'SET updated_at = :updated'
@@ -463,6 +744,8 @@ def update_device(device_id: str, body: dict, user_id: str, role: str) -> dict:
     update_kwargs = {
         'Key': {'device_id': device_id},
         'UpdateExpression': update_expr,
+        # The owner may come from the cache - never recreate a device deleted meanwhile
+        'ConditionExpression': 'attribute_exists(device_id)',
         'ExpressionAttributeValues': expr_values,
         'ReturnValues': 'UPDATED_NEW'
     }
@@ -470,7 +753,13 @@ def update_device(device_id: str, body: dict, user_id: str, role: str) -> dict:
     if expr_names:
         update_kwargs['ExpressionAttributeNames'] = expr_names
     
-    devices_table.update_item(**update_kwargs)
+    try:
+        devices_table.update_item(**update_kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        forget_device(device_id)
+        return response(404, {'error': 'Device not found'})
 
     
     return response(200, {'message': 'Device updated'})
@@ -478,8 +767,7 @@ def update_device(device_id: str, body: dict, user_id: str, role: str) -> dict:
 
 def delete_device(device_id: str, user_id: str, role: str) -> dict:
     """Delete a device"""
-    result = devices_table.get_item(Key={'device_id': device_id})
-    device = result.get('Item')
+    device = load_device(device_id)
     
     if not device:
         return response(404, {'error': 'Device not found'})
@@ -488,26 +776,20 @@ def delete_device(device_id: str, user_id: str, role: str) -> dict:
         return response(403, {'error': 'Access denied'})
     
     try:
-        # Delete all sessions associated with this device first
-        session_response = sessions_table.query(
-            IndexName='device-index',
-            KeyConditionExpression=Key('device_id').eq(device_id)
-        )
-        
-        for session in session_response.get('Items', []):
-            try:
-                sessions_table.delete_item(Key={'session_id': session['session_id']})
-                print(f"Deleted cascaded session {session['session_id']}")
-            except Exception as e:
-                print(f"Failed to delete session {session.get('session_id')}: {e}")
-                
-        # Now delete the device
+        # The job is recorded before anything is deleted, so the history is purged
+        # even if this request fails once the device is gone. The device goes
+        # first so it disappears at once; its sessions and telemetry follow (and
+        # leave the owner's dashboard aggregate)
+        job = create_job('delete_device', device_id, [device_id], user_id, owner_id=device.get('user_id'))
         devices_table.delete_item(Key={'device_id': device_id})
-        return response(200, {'message': 'Device and history deleted'})
+        forget_device(device_id)
         
     except Exception as e:
         print(f"Error deleting device: {e}")
         return response(500, {'error': 'Failed to delete device'})
+    
+    job = cascade_delete(job, int(device.get('total_sessions', 0)))
+    return cascade_response(job, 'Device and history deleted')
 
 
 def send_command(device_id: str, body: dict, user_id: str, role: str) -> dict:
@@ -520,15 +802,10 @@ def send_command(device_id: str, body: dict, user_id: str, role: str) -> dict:
     if command not in valid_commands:
         return response(400, {'error': f'Invalid command. Valid: {valid_commands}'})
     
-    # Check ownership
-    result = devices_table.get_item(Key={'device_id': device_id})
-    device = result.get('Item')
-    
-    if not device:
-        return response(404, {'error': 'Device not found'})
-    
-    if role != 'admin' and device.get('user_id') != user_id:
-        return response(403, {'error': 'Access denied'})
+    # Check ownership (start/stop_session have already read the device in this request)
+    denied = check_device_access(device_id, user_id, role)
+    if denied:
+        return denied
     
     # Publish to IoT
     topic = f'ecoshower/{device_id}/commands'
@@ -549,6 +826,7 @@ def send_command(device_id: str, body: dict, user_id: str, role: str) -> dict:
             devices_table.update_item(
                 Key={'device_id': device_id},
                 UpdateExpression='SET #s = :r',
+                ConditionExpression='attribute_exists(device_id)',
                 ExpressionAttributeNames={'#s': 'status'},
                 ExpressionAttributeValues={':r': 'ready'}
             )
@@ -561,8 +839,7 @@ def send_command(device_id: str, body: dict, user_id: str, role: str) -> dict:
 def start_session(device_id: str, body: dict, user_id: str, role: str = 'user') -> dict:
     """Start a new shower session"""
     # Check device ownership
-    result = devices_table.get_item(Key={'device_id': device_id})
-    device = result.get('Item')
+    device = load_device(device_id, consistent=True)
     
     if not device:
          return response(404, {'error': 'Device not found'})
@@ -570,17 +847,28 @@ def start_session(device_id: str, body: dict, user_id: str, role: str = 'user')
     if role != 'admin' and device.get('user_id') != user_id:
         return response(403, {'error': f'Access denied. User: {user_id}, Owner: {device.get("user_id")}'})
     
+    # A device runs at most one session at a time - resume it instead of opening another
+    active_session_id = device.get('active_session_id')
+    if active_session_id:
+        existing = sessions_table.get_item(
+            Key={'session_id': active_session_id}, ConsistentRead=True
+        ).get('Item')
+        if existing and existing.get('status') == 'active':
+            return response(200, {'session': existing, 'resumed': True})
+    
     # Create session
     session_id = str(uuid.uuid4())
     target_temp = Decimal(str(body.get('target_temp', device.get('target_temp', 38))))
     planned_duration = int(body.get('duration', 10))
+    start_time = datetime.utcnow().isoformat() + 'Z'
     
     session = {
         'session_id': session_id,
         'device_id': device_id,
         'device_name': device.get('name', 'Unknown Device'),
-        'user_id': user_id,
-        'start_time': datetime.utcnow().isoformat() + 'Z',
+        # The owner's, also when an admin starts it - history is read by user_id
+        'user_id': device.get('user_id', user_id),
+        'start_time': start_time,
         'status': 'active',
         'target_temp': target_temp,
         'planned_duration': planned_duration,
@@ -590,16 +878,29 @@ def start_session(device_id: str, body: dict, user_id: str, role: str = 'user')
     
     sessions_table.put_item(Item=session)
     
-    # Update device target temp and status
-    devices_table.update_item(
-        Key={'device_id': device_id},
-        UpdateExpression='SET target_temp = :t, #s = :s',
-        ExpressionAttributeNames={'#s': 'status'},
-        ExpressionAttributeValues={
-            ':t': target_temp,
-            ':s': 'heating'
-        }
-    )
+    # Claim the device: record the active session pointer, target temp and status.
+    # Conditional so two concurrent starts cannot both win.
+    pointer_condition = 'attribute_not_exists(active_session_id)'
+    pointer_values = {':t': target_temp, ':s': 'heating', ':sid': session_id, ':st': start_time}
+    if active_session_id:
+        # Stale pointer (session missing or already completed) - take it over
+        pointer_condition = 'active_session_id = :old'
+        pointer_values[':old'] = active_session_id
+    
+    try:
+        devices_table.update_item(
+            Key={'device_id': device_id},
+            UpdateExpression='SET target_temp = :t, #s = :s, active_session_id = :sid, active_session_start = :st',
+            ConditionExpression=pointer_condition,
+            ExpressionAttributeNames={'#s': 'status'},
+            ExpressionAttributeValues=pointer_values
+        )
+    except ClientError as e:
+        # Lost the race - drop the session we just wrote
+        sessions_table.delete_item(Key={'session_id': session_id})
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return response(409, {'error': 'Another session was started on this device'})
+        raise
     
     # Send start command
     send_command(device_id, {'command': 'START_HEATING'}, user_id, role)
@@ -607,61 +908,58 @@ def start_session(device_id: str, body: dict, user_id: str, role: str = 'user')
     return response(210, {'session': session})
 
 
+def clear_active_session(device_id: str, session_id: str) -> bool:
+    """Remove the active session pointer if it still points at session_id"""
+    try:
+        devices_table.update_item(
+            Key={'device_id': device_id},
+            UpdateExpression='REMOVE active_session_id, active_session_start',
+            ConditionExpression='active_session_id = :sid',
+            ExpressionAttributeValues={':sid': session_id}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
 def stop_session(device_id: str, body: dict, user_id: str, role: str = 'user') -> dict:
     """Stop the current shower session"""
     # Check device ownership
-    result = devices_table.get_item(Key={'device_id': device_id})
-    device = result.get('Item')
+    device = load_device(device_id, consistent=True)
     
     if not device:
         return response(404, {'error': 'Device not found'})
 
     if role != 'admin' and device.get('user_id') != user_id:
         return response(403, {'error': f'Access denied. User: {user_id}, Owner: {device.get("user_id")}'})
-        
-    # Try direct session update if ID provided (Strongly Consistent)
+    
+    # The device item points at its active session (set by start_session)
+    active_session_id = device.get('active_session_id')
     session_id = body.get('session_id')
     active_session = None
     
-    if session_id:
-        print(f"Stopping session by ID: {session_id}")
+    # Sessions started before the pointer existed can still be stopped by ID
+    lookup_id = active_session_id or session_id
+    if lookup_id:
         try:
-            result = sessions_table.get_item(Key={'session_id': session_id})
+            result = sessions_table.get_item(Key={'session_id': lookup_id}, ConsistentRead=True)
             item = result.get('Item')
-            if item and item.get('status') == 'active':
+            if item and item.get('status') == 'active' and item.get('device_id') == device_id:
                 active_session = item
         except Exception as e:
-            print(f"Error fetching session by ID: {e}")
-
-    # Fallback to GSI query (Eventual Consistency)
-    if not active_session:
-        print("Fallback to GSI query for active session")
-        response_scan = sessions_table.query(
-            IndexName='device-index',
-            KeyConditionExpression=Key('device_id').eq(device_id),
-            FilterExpression=Key('status').eq('active'),
-            Limit=5,
-            ScanIndexForward=False
-        )
-        if response_scan.get('Items'):
-             active_session = response_scan['Items'][0]
-
-    # Fallback to Full Table Scan (Ultimate consistency check)
-    if not active_session:
-        print("Fallback to Full Table Scan for active session")
-        scan_response = sessions_table.scan(
-             FilterExpression=Key('device_id').eq(device_id) & Key('status').eq('active')
-        )
-        if scan_response.get('Items'):
-             active_session = scan_response['Items'][0]
-
+            print(f"Error fetching session {lookup_id}: {e}")
+    
     if not active_session:
+        if active_session_id:
+            # Pointer left behind by a session that is already closed
+            clear_active_session(device_id, active_session_id)
         # Just stop heating if no session found
         send_command(device_id, {'command': 'STOP_HEATING'}, user_id, role)
         return response(200, {
             'message': 'Heating stopped (no active session found)',
-            'debug_session_id_provided': session_id,
-            'debug_gsi_fallback': True
+            'debug_session_id_provided': session_id
         })
         
     # Calculate final stats
@@ -682,8 +980,7 @@ def stop_session(device_id: str, body: dict, user_id: str, role: str = 'user') -
     # Fetch water price from user settings
     water_cost_per_liter = Decimal('0.008') # Default
     try:
-        user_res = users_table.get_item(Key={'user_id': user_id})
-        user_item = user_res.get('Item', {})
+        user_item = get_user_settings(user_id)
         system_settings = user_item.get('system', {})
         price_setting = system_settings.get('water_price_per_liter') or system_settings.get('waterPricePerLiter')
         if price_setting:
@@ -698,35 +995,58 @@ def stop_session(device_id: str, body: dict, user_id: str, role: str = 'user') -
     water_used = elapsed_seconds * LITERS_PER_SECOND
     money_saved = water_used * water_cost_per_liter
     
-    # Update session
-    sessions_table.update_item(
-        Key={'session_id': active_session['session_id']},
-        UpdateExpression='SET #status = :status, end_time = :end, water_saved = :water, money_saved = :money, #d = :duration',
-        ExpressionAttributeNames={'#status': 'status', '#d': 'duration'},
-        ExpressionAttributeValues={
-            ':status': 'completed',
-            ':end': datetime.utcnow().isoformat() + 'Z',
-            ':water': water_used,
-            ':money': money_saved,
-            ':duration': elapsed_seconds
-        }
-    )
-    
-    # Update device totals
+    # Update session (only the first concurrent stop completes it)
     try:
-        devices_table.update_item(
-            Key={'device_id': device_id},
-            UpdateExpression='SET #s = :r ADD total_water_saved :w, total_sessions :i',
-            ExpressionAttributeNames={'#s': 'status'},
+        sessions_table.update_item(
+            Key={'session_id': active_session['session_id']},
+            UpdateExpression='SET #status = :status, end_time = :end, water_saved = :water, money_saved = :money, #d = :duration',
+            ConditionExpression='#status = :active',
+            ExpressionAttributeNames={'#status': 'status', '#d': 'duration'},
             ExpressionAttributeValues={
+                ':status': 'completed',
+                ':active': 'active',
+                ':end': datetime.utcnow().isoformat() + 'Z',
+                ':water': water_used,
+                ':money': money_saved,
+                ':duration': elapsed_seconds
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return response(200, {'message': 'Session already stopped'})
+    
+    # Update device totals and clear the active session pointer in the same write
+    try:
+        update_kwargs = {
+            'Key': {'device_id': device_id},
+            'UpdateExpression': 'SET #s = :r ADD total_water_saved :w, total_sessions :i',
+            'ConditionExpression': 'attribute_exists(device_id)',
+            'ExpressionAttributeNames': {'#s': 'status'},
+            'ExpressionAttributeValues': {
                 ':w': water_used,
                 ':i': 1,
                 ':r': 'ready'
             }
-        )
+        }
+        if active_session_id == active_session['session_id']:
+            update_kwargs['UpdateExpression'] += ' REMOVE active_session_id, active_session_start'
+        devices_table.update_item(**update_kwargs)
+    except ClientError as e:
+        # Device deleted meanwhile - nothing to update
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f"Failed to update device stats: {e}")
     except Exception as e:
         print(f"Failed to update device stats: {e}")
     
+    # Dashboard aggregate for the session's owner
+    try:
+        record_user_stats(active_session.get('user_id') or device.get('user_id'),
+                          active_session.get('start_time'), water_used, money_saved,
+                          session_ids=[active_session['session_id']])
+    except Exception as e:
+        print(f"Failed to update user stats: {e}")
+    
     # Send stop command
     send_command(device_id, {'command': 'STOP_HEATING'}, user_id, 'user')
     
@@ -741,89 +1061,557 @@ def stop_session(device_id: str, body: dict, user_id: str, role: str = 'user') -
     })
 
 
-# ============= DASHBOARD =============
+# ============= CASCADE DELETE =============
 
-def handle_dashboard(method: str, path: str, params: dict, 
-                     query: dict, user_id: str) -> dict:
-    """Handle dashboard requests"""
-    
-    if '/summary' in path:
-        return get_summary(user_id)
+def cascade_sources() -> dict:
+    """kind -> (table, index, key attributes, extra attributes read) of a device's history"""
+    return {
+        'sessions': (sessions_table, 'device-index', ('session_id',),
+                     ('status', 'start_time', 'water_saved', 'money_saved')),
+        'telemetry': (telemetry_table, None, ('device_id', 'timestamp'), ()),
+        'rollups': (rollups_table, None, ('device_id', 'bucket'), ()),
+        'chunks': (chunks_table, None, ('device_id', 'chunk_start'), ())
+    }
+
+
+def batch_delete_keys(table, keys: list, on_deleted=None) -> int:
+    """
+    BatchWriteItem deletes, 25 per request, retrying unprocessed items with backoff.
+    on_deleted(keys) is called after every request with the keys it deleted, so
+    bookkeeping for them is done even if a later request fails.
+    """
+    for start in range(0, len(keys), BATCH_WRITE_LIMIT):
+        pending = [{'DeleteRequest': {'Key': key}} for key in keys[start:start + BATCH_WRITE_LIMIT]]
+        attempt = 0
+        while pending:
+            result = dynamodb.batch_write_item(RequestItems={table.table_name: pending})
+            sent = pending
+            pending = result.get('UnprocessedItems', {}).get(table.table_name, [])
+            if on_deleted:
+                left = {tuple(sorted(request['DeleteRequest']['Key'].items())) for request in pending}
+                deleted = [request['DeleteRequest']['Key'] for request in sent
+                           if tuple(sorted(request['DeleteRequest']['Key'].items())) not in left]
+                if deleted:
+                    on_deleted(deleted)
+            if pending:
+                attempt += 1
+                if attempt > CASCADE_MAX_RETRIES:
+                    raise RuntimeError(f"{len(pending)} deletes still unprocessed in {table.table_name}")
+                # Full jitter: throttled workers should not retry in lockstep
+                time.sleep(random.uniform(0, min(CASCADE_RETRY_BASE_SECONDS * 2 ** attempt, 2.0)))
+    return len(keys)
+
+
+def purge_device_items(kind: str, device_id: str, state: dict, deadline: float,
+                       owner_id: str = None) -> dict:
+    """
+    Delete one kind of a device's history page by page. state ({'cursor',
+    'deleted', 'done'}) is updated after every page, so a later run resumes
+    after the last deleted page instead of re-reading it from the index.
+    Deleted completed sessions are taken out of owner_id's dashboard aggregate.
+    """
+    table, index, key_names, extra = cascade_sources()[kind]
+    names = {f"#a{i}": name for i, name in enumerate(key_names + extra)}
+    query_kwargs = {
+        'KeyConditionExpression': Key('device_id').eq(device_id),
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names
+    }
+    if index:
+        query_kwargs['IndexName'] = index
     
-    elif '/history' in path:
+    while not state.get('done') and time.monotonic() < deadline:
+        if state.get('cursor'):
+            query_kwargs['ExclusiveStartKey'] = state['cursor']
         try:
-            limit = int(query.get('limit', 50))
-        except (ValueError, TypeError):
-            print(f"Invalid limit parameter: {query.get('limit')}, defaulting to 50")
-            limit = 50
-        return get_history(user_id, limit)
-    
-    elif '/realtime' in path:
-        device_id = params.get('device_id')
-        return get_realtime(device_id, user_id)
-    
-    return response(404, {'error': 'Dashboard route not found'})
+            result = table.query(**query_kwargs)
+        except ClientError as e:
+            # Chunks table only exists where chunked storage was set up
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            state['done'] = True
+            break
+        items = result.get('Items', [])
+        on_deleted = None
+        if kind == 'sessions' and owner_id:
+            # Subtracted per request: a page that fails halfway is re-queried
+            # without the sessions already deleted
+            by_id = {item['session_id']: item for item in items}
+            
+            def on_deleted(keys):
+                remove_sessions_from_user_stats(owner_id, [by_id[key['session_id']] for key in keys])
+        batch_delete_keys(table, [{name: item[name] for name in key_names} for item in items], on_deleted)
+        state['deleted'] = state.get('deleted', 0) + len(items)
+        state['cursor'] = result.get('LastEvaluatedKey')
+        state['done'] = state['cursor'] is None
+    return state
 
 
-def get_summary(user_id: str) -> dict:
-    """Get dashboard summary for user"""
-    # Get user's devices
-    devices_result = devices_table.query(
-        IndexName='user-index',
-        KeyConditionExpression=Key('user_id').eq(user_id)
+def run_cascade(device_ids: list, progress: dict, deadline: float, owner_id: str = None) -> bool:
+    """
+    Purge the history of every device, all (device, kind) pairs in parallel.
+    progress maps device_id -> kind -> state. True once everything is deleted.
+    """
+    tasks = []
+    for device_id in device_ids:
+        for kind in CASCADE_KINDS:
+            state = progress.setdefault(device_id, {}).setdefault(kind, {})
+            if not state.get('done'):
+                tasks.append((kind, device_id, state))
+    if tasks:
+        with ThreadPoolExecutor(max_workers=min(CASCADE_MAX_WORKERS, len(tasks))) as pool:
+            futures = [pool.submit(purge_device_items, kind, device_id, state, deadline, owner_id)
+                       for kind, device_id, state in tasks]
+            for future in futures:
+                future.result()
+    return all(state.get('done') for kinds in progress.values() for state in kinds.values())
+
+
+def cascade_delete(job: dict, estimate: int):
+    """
+    Delete the history of a recorded job's devices inline when it is small and
+    finishes within CASCADE_SYNC_SECONDS; otherwise run the job asynchronously
+    from where the inline run stopped. Never raises - the devices are already
+    gone, and a job that could not be started is retried by GET /jobs/{id}.
+    Returns None when done inline, else the job item.
+    """
+    if estimate <= CASCADE_ASYNC_THRESHOLD:
+        try:
+            if run_cascade(job['device_ids'], job['progress'], time.monotonic() + CASCADE_SYNC_SECONDS,
+                           job.get('owner_id')):
+                finish_job(job)
+                return None
+            print(f"Cascade for {job['job_type']} {job['target_id']} ran out of time, continuing as a job")
+        except Exception as e:
+            print(f"Inline cascade for {job['job_type']} {job['target_id']} failed, continuing as a job: {e}")
+    queue_job(job)
+    return job
+
+
+def cascade_response(job: dict, message: str) -> dict:
+    if job is None:
+        return response(200, {'message': message})
+    return response(202, {
+        'message': f"{message} - history is being removed in the background",
+        'job_id': job['job_id'],
+        'status_url': f"/jobs/{job['job_id']}"
+    })
+
+
+# ============= JOBS =============
+
+def create_job(job_type: str, target_id: str, device_ids: list, requested_by: str,
+               owner_id: str = None) -> dict:
+    """Record a queued cascade job. Nothing runs it until cascade_delete or queue_job."""
+    now = datetime.utcnow().isoformat() + 'Z'
+    job = {
+        'job_id': str(uuid.uuid4()),
+        'job_type': job_type,
+        'target_id': target_id,
+        'device_ids': device_ids,
+        'progress': {},
+        'requested_by': requested_by,
+        'status': 'queued',
+        'runs': 0,
+        'created_at': now,
+        'updated_at': now,
+        'expires_at': int(time.time()) + JOB_RETENTION_DAYS * 86400
+    }
+    if owner_id:
+        job['owner_id'] = owner_id
+    jobs_table.put_item(Item=job)
+    return job
+
+
+def queue_job(job: dict):
+    """Save a queued job's progress and invoke this function asynchronously to run it"""
+    try:
+        job['updated_at'] = datetime.utcnow().isoformat() + 'Z'
+        jobs_table.update_item(
+            Key={'job_id': job['job_id']},
+            UpdateExpression='SET progress = :progress, updated_at = :now',
+            ExpressionAttributeValues={':progress': job['progress'], ':now': job['updated_at']}
+        )
+        invoke_job(job['job_id'])
+    except Exception as e:
+        # The job item is there - GET /jobs/{id} invokes it again once it looks stalled
+        print(f"Could not start job {job['job_id']}: {e}")
+
+
+def finish_job(job: dict):
+    """Mark a job the inline cascade completed"""
+    try:
+        jobs_table.update_item(
+            Key={'job_id': job['job_id']},
+            UpdateExpression='SET #s = :status, progress = :progress, updated_at = :now',
+            ExpressionAttributeNames={'#s': 'status'},
+            ExpressionAttributeValues={':status': 'completed', ':progress': job['progress'],
+                                       ':now': datetime.utcnow().isoformat() + 'Z'}
+        )
+    except Exception as e:
+        # Left queued: a run started later finds nothing to delete and completes it
+        print(f"Could not complete job {job['job_id']}: {e}")
+
+
+def invoke_job(job_id: str):
+    lambda_client.invoke(
+        FunctionName=JOB_FUNCTION_NAME,
+        InvocationType='Event',
+        Payload=json.dumps({'source': JOB_EVENT_SOURCE, 'job_id': job_id}).encode()
     )
-    device_ids = [d['device_id'] for d in devices_result.get('Items', [])]
+
+
+def run_job(job_id: str, context) -> dict:
+    """
+    Async invocation: work on a job until the invocation is nearly out of time,
+    save progress, then re-invoke to continue. A duplicate delivery of the same
+    invocation loses the claim on `runs` and exits.
+    """
+    job = jobs_table.get_item(Key={'job_id': job_id}, ConsistentRead=True).get('Item')
+    if not job or job['status'] in ('completed', 'failed'):
+        return {'job_id': job_id, 'status': job['status'] if job else 'missing'}
     
-    if not device_ids:
-        return response(200, {
-            'today_usage': 0,
-            'monthly_usage': 0,
-            'money_saved': 0,
-            'total_sessions': 0,
-            'avg_per_session': 0
-        })
+    runs = int(job.get('runs', 0))
+    try:
+        jobs_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET #s = :running, runs = :next, updated_at = :now',
+            ConditionExpression='runs = :runs',
+            ExpressionAttributeNames={'#s': 'status'},
+            ExpressionAttributeValues={':running': 'running', ':next': runs + 1, ':runs': runs,
+                                       ':now': datetime.utcnow().isoformat() + 'Z'}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f"Job {job_id} already claimed by another run")
+            return {'job_id': job_id, 'status': 'running'}
+        raise
+    
+    remaining = context.get_remaining_time_in_millis() / 1000 if context else CASCADE_SYNC_SECONDS
+    deadline = time.monotonic() + remaining - JOB_TIME_MARGIN_SECONDS
+    progress = job.get('progress', {})
+    status, error = 'running', None
+    try:
+        if run_cascade(job['device_ids'], progress, deadline, job.get('owner_id')):
+            status = 'completed'
+        elif runs + 1 >= JOB_MAX_RUNS:
+            status, error = 'failed', f"Gave up after {runs + 1} runs"
+    except Exception as e:
+        print(f"Job {job_id} failed: {e}")
+        status, error = 'failed', str(e)
+    
+    update = 'SET #s = :status, progress = :progress, updated_at = :now'
+    values = {':status': status, ':progress': progress, ':now': datetime.utcnow().isoformat() + 'Z'}
+    if error:
+        update += ', #e = :error'
+        values[':error'] = error
+    jobs_table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression=update,
+        ExpressionAttributeNames={'#s': 'status', **({'#e': 'error'} if error else {})},
+        ExpressionAttributeValues=values
+    )
+    if status == 'running':
+        invoke_job(job_id)
+    print(f"Job {job_id} run {runs + 1}: {status}")
+    return {'job_id': job_id, 'status': status}
+
+
+def get_job(job_id: str, user_id: str, role: str) -> dict:
+    """GET /jobs/{id} - progress of a background cascade delete"""
+    job = jobs_table.get_item(Key={'job_id': job_id}).get('Item')
+    if not job:
+        return response(404, {'error': 'Job not found'})
+    if role != 'admin' and job.get('requested_by') != user_id:
+        return response(403, {'error': 'Access denied'})
     
-    # Get all-time sessions
-    now = datetime.utcnow()
+    if job['status'] == 'queued' and job_age_seconds(job) > JOB_STALL_SECONDS:
+        # Its async invocation never started (the invoke failed) - a duplicate
+        # invocation loses the claim on `runs` in run_job
+        try:
+            invoke_job(job_id)
+        except Exception as e:
+            print(f"Could not restart job {job_id}: {e}")
+    
+    progress = job.get('progress', {})
+    deleted = {kind: sum(int(kinds.get(kind, {}).get('deleted', 0)) for kinds in progress.values())
+               for kind in CASCADE_KINDS}
+    devices_done = sum(
+        1 for device_id in job.get('device_ids', [])
+        if all(progress.get(device_id, {}).get(kind, {}).get('done') for kind in CASCADE_KINDS)
+    )
+    body = {
+        'job_id': job['job_id'],
+        'job_type': job['job_type'],
+        'target_id': job['target_id'],
+        'status': job['status'],
+        'deleted': deleted,
+        'devices_done': devices_done,
+        'devices_total': len(job.get('device_ids', [])),
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at']
+    }
+    if job.get('error'):
+        body['error'] = job['error']
+    return response(200, body)
+
+
+def job_age_seconds(job: dict) -> float:
+    """Seconds since the job item was last saved"""
+    updated = datetime.fromisoformat(job['updated_at'].replace('Z', ''))
+    return (datetime.utcnow() - updated).total_seconds()
+
+
+# ============= USER STATS =============
+
+def record_user_stats(user_id: str, start_time: str, water: Decimal, money: Decimal,
+                      sessions: int = 1, session_ids: list = None):
+    """
+    Add sessions' contribution (negative values remove it) to the user's
+    aggregate: all-time totals plus the daily bucket of the sessions' local date.
+    
+    Nested ADDs need the bucket to exist, so three conditional variants are tried
+    in order - bucket exists / new day / no daily map yet. Nothing is written while
+    the aggregate item does not exist; get_summary builds it from the sessions table
+    on first use. While that build runs (building_since is set) only session_ids are
+    noted in building_sessions - the build reads those sessions back from the table,
+    so a session stopped or deleted during the build is counted exactly once.
+    """
+    if not user_id:
+        return
+    day = local_date(start_time or datetime.utcnow().isoformat())
+    totals = 'total_water :w, total_money :m, total_sessions :n'
+    values = {':w': water, ':m': money, ':n': sessions}
+    bucket = {'water': water, 'money': money, 'sessions': sessions}
+    built = 'attribute_not_exists(building_since)'
+    
+    attempts = [(
+        f"ADD {totals}, daily.#day.water :w, daily.#day.money :m, daily.#day.sessions :n",
+        f'{built} AND attribute_exists(daily.#day)', values
+    )]
+    if sessions > 0:
+        attempts += [
+            (f"SET daily.#day = :bucket ADD {totals}",
+             f'{built} AND attribute_exists(daily) AND attribute_not_exists(daily.#day)',
+             {**values, ':bucket': bucket}),
+            (f"SET daily = :daily ADD {totals}",
+             f'{built} AND attribute_exists(user_id) AND attribute_not_exists(daily)',
+             {**values, ':daily': {day: bucket}})
+        ]
+    else:
+        # Removing from a day that has already been pruned - totals only
+        attempts.append((f"ADD {totals}",
+                         f'{built} AND attribute_exists(user_id) AND attribute_not_exists(daily.#day)', values))
+    if session_ids:
+        attempts.append(('ADD building_sessions :ids', 'attribute_exists(building_since)',
+                         {':ids': set(session_ids)}))
+    
+    # A second round covers a concurrent writer creating the bucket between our attempts
+    for _ in range(2):
+        for update_expr, condition, attempt_values in attempts:
+            update_kwargs = {
+                'Key': {'user_id': user_id},
+                'UpdateExpression': update_expr,
+                'ConditionExpression': condition,
+                'ExpressionAttributeValues': attempt_values
+            }
+            if '#day' in update_expr or '#day' in condition:
+                update_kwargs['ExpressionAttributeNames'] = {'#day': day}
+            try:
+                user_stats_table.update_item(**update_kwargs)
+                return
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+    print(f"User stats for {user_id} not built yet - the next summary will include this session")
+
+
+def remove_sessions_from_user_stats(user_id: str, sessions: list):
+    """Subtract deleted completed sessions, one update per local day"""
+    per_day = {}
+    for session in sessions:
+        if session.get('status') != 'completed' or not session.get('start_time'):
+            continue
+        day = per_day.setdefault(local_date(session['start_time']), {
+            'start_time': session['start_time'], 'water': Decimal('0'), 'money': Decimal('0'), 'ids': []
+        })
+        day['water'] += Decimal(str(session.get('water_saved', 0)))
+        day['money'] += Decimal(str(session.get('money_saved', 0)))
+        day['ids'].append(session['session_id'])
+    for day in per_day.values():
+        record_user_stats(user_id, day['start_time'], -day['water'], -day['money'], -len(day['ids']),
+                          day['ids'])
+
+
+def rebuild_user_stats(user_id: str) -> dict:
+    """
+    Build the aggregate from the user's sessions (users whose history
+    predates the aggregate). Never overwrites one that is already built.
+    
+    An empty item with building_since is created before the sessions are
+    queried, so stops and deletes that race the (eventually consistent)
+    index query note their session in building_sessions instead of being
+    lost. Those sessions, and any the index still shows as active, are
+    read back from the table before the result replaces the item - guarded
+    by the building_sessions size, so a session noted meanwhile forces
+    another pass. A build left unfinished is finished by the next request.
+    """
+    building_since = datetime.utcnow().isoformat() + 'Z'
+    try:
+        user_stats_table.put_item(
+            Item={'user_id': user_id, 'building_since': building_since, 'total_water': Decimal('0'),
+                  'total_money': Decimal('0'), 'total_sessions': 0, 'daily': {}},
+            ConditionExpression='attribute_not_exists(user_id)'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        existing = user_stats_table.get_item(Key={'user_id': user_id}, ConsistentRead=True).get('Item')
+        if existing and 'building_since' not in existing:
+            return existing
+    
+    sessions = query_user_sessions(
+        user_id,
+        ProjectionExpression='session_id, start_time, water_saved, money_saved, #s',
+        ExpressionAttributeNames={'#s': 'status'}
+    )
     
-    # Adjust for Israel Time (UTC+2)
-    # 00:00 Israel = 22:00 UTC previous day
-    from datetime import timedelta
-    israel_now = now + timedelta(hours=2)
-    israel_midnight = israel_now.replace(hour=0, minute=0, second=0, microsecond=0)
-    utc_cutoff = israel_midnight - timedelta(hours=2)
-    today_start = utc_cutoff.isoformat()
+    stats = None
+    for _ in range(USER_STATS_BUILD_ATTEMPTS):
+        item = user_stats_table.get_item(Key={'user_id': user_id}, ConsistentRead=True).get('Item')
+        if item is not None and 'building_since' not in item:
+            return item
+        noted = set(item.get('building_sessions', ())) if item else set()
+        stats = build_user_stats(user_id, sessions, noted)
+        if item is None:
+            # User deleted meanwhile - nothing to store
+            return stats
+        
+        condition = 'building_since = :since AND '
+        values = {':since': item['building_since']}
+        if noted:
+            condition += 'size(building_sessions) = :noted'
+            values[':noted'] = len(noted)
+        else:
+            condition += 'attribute_not_exists(building_sessions)'
+        try:
+            user_stats_table.put_item(Item=stats, ConditionExpression=condition,
+                                      ExpressionAttributeValues=values)
+            print(f"Built user stats for {user_id} from {stats['total_sessions']} sessions")
+            return stats
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    print(f"User stats for {user_id} kept changing while being built - the next summary finishes it")
+    return stats
+
+
+def build_user_stats(user_id: str, sessions: list, noted: set) -> dict:
+    """
+    Aggregate completed sessions. Noted sessions, and sessions the index still
+    shows as active, are counted from a consistent read of the sessions table.
+    """
+    recheck = set(noted)
+    counted = []
+    for session in sessions:
+        if session['session_id'] in noted:
+            continue
+        if session.get('status') == 'completed':
+            counted.append(session)
+        elif session.get('status') == 'active':
+            recheck.add(session['session_id'])
+    for session_id in sorted(recheck):
+        session = sessions_table.get_item(Key={'session_id': session_id}, ConsistentRead=True).get('Item')
+        if session and session.get('status') == 'completed':
+            counted.append(session)
+    
+    stats = {
+        'user_id': user_id,
+        'total_water': Decimal('0'),
+        'total_money': Decimal('0'),
+        'total_sessions': 0,
+        'daily': {}
+    }
+    for session in counted:
+        water = Decimal(str(session.get('water_saved', 0)))
+        money = Decimal(str(session.get('money_saved', 0)))
+        stats['total_water'] += water
+        stats['total_money'] += money
+        stats['total_sessions'] += 1
+        if session.get('start_time'):
+            bucket = stats['daily'].setdefault(local_date(session['start_time']), {
+                'water': Decimal('0'), 'money': Decimal('0'), 'sessions': 0
+            })
+            bucket['water'] += water
+            bucket['money'] += money
+            bucket['sessions'] += 1
+    
+    # Keep the newest buckets only, like prune_user_stats
+    for day in sorted(stats['daily'])[:-USER_STATS_DAILY_DAYS]:
+        del stats['daily'][day]
+    return stats
+
+
+def prune_user_stats(user_id: str, daily: dict):
+    """Drop the oldest daily buckets beyond USER_STATS_DAILY_DAYS"""
+    expired = sorted(daily)[:-USER_STATS_DAILY_DAYS]
+    if not expired:
+        return
+    names = {f'#d{i}': day for i, day in enumerate(expired)}
+    user_stats_table.update_item(
+        Key={'user_id': user_id},
+        UpdateExpression='REMOVE ' + ', '.join(f'daily.{name}' for name in names),
+        ExpressionAttributeNames=names
+    )
+
+
+# ============= DASHBOARD =============
+
+def dashboard_history(query: dict, user_id: str) -> dict:
+    """GET /dashboard/history - parse limit/cursor/from/to"""
+    try:
+        limit = int(query.get('limit', 50))
+    except (ValueError, TypeError):
+        print(f"Invalid limit parameter: {query.get('limit')}, defaulting to 50")
+        limit = 50
+    return get_history(user_id, min(max(limit, 1), HISTORY_MAX_LIMIT), query.get('cursor'),
+                       query.get('from'), query.get('to'))
+
+
+def dashboard_trends(device_id: str, query: dict, user_id: str) -> dict:
+    """GET /dashboard/trends/{device_id} - parse resolution/hours"""
+    resolution = query.get('resolution', 'hour')
+    try:
+        hours = int(query.get('hours', 24))
+    except (ValueError, TypeError):
+        hours = 24
+    return get_trends(device_id, user_id, resolution, hours)
+
+
+def get_summary(user_id: str) -> dict:
+    """Get dashboard summary for user - one read of the per-user aggregate"""
+    stats = user_stats_table.get_item(Key={'user_id': user_id}).get('Item')
+    if stats is None or 'building_since' in stats:
+        stats = rebuild_user_stats(user_id)
     
-    total_water = Decimal('0')
-    total_money = Decimal('0')
-    today_usage = Decimal('0')
-    session_count = 0
+    daily = stats.get('daily', {})
+    if len(daily) > USER_STATS_DAILY_DAYS:
+        try:
+            prune_user_stats(user_id, daily)
+        except Exception as e:
+            print(f"Error pruning user stats for {user_id}: {e}")
     
-    for device_id in device_ids:
-        # Fetch all sessions for device
-        result = sessions_table.query(
-            IndexName='device-index',
-            KeyConditionExpression=Key('device_id').eq(device_id)
-        )
-        
-        for session in result.get('Items', []):
-            if session.get('status') == 'completed':
-                # Global Totals (All Time)
-                session_count += 1
-                total_water += session.get('water_saved', Decimal('0'))
-                total_money += session.get('money_saved', Decimal('0'))
-                
-                start_time = session.get('start_time', '')
-                if start_time >= today_start:
-                    today_usage += session.get('water_saved', Decimal('0'))
-                    
+    total_water = Decimal(str(stats.get('total_water', 0)))
+    total_money = Decimal(str(stats.get('total_money', 0)))
+    session_count = int(stats.get('total_sessions', 0))
+    today = daily.get(local_date(datetime.utcnow().isoformat()), {})
+    today_usage = Decimal(str(today.get('water', 0)))
     avg_per_session = total_water / session_count if session_count > 0 else Decimal('0')
     
     # Get user's current price for the frontend
     current_price = Decimal('0.008')
     try:
-        user_res = users_table.get_item(Key={'user_id': user_id})
-        user_data = user_res.get('Item', {})
+        user_data = get_user_settings(user_id)
         current_price = user_data.get('system', {}).get('water_price_per_liter', Decimal('0.008'))
     except Exception as e:
         print(f"Error fetching current price for summary: {e}")
@@ -839,41 +1627,209 @@ def get_summary(user_id: str) -> dict:
     })
 
 
-def get_history(user_id: str, limit: int) -> dict:
-    """Get session history for user"""
-    # Get user's devices
-    devices_result = devices_table.query(
-        IndexName='user-index',
-        KeyConditionExpression=Key('user_id').eq(user_id)
-    )
-    devices = devices_result.get('Items', [])
-    device_map = {d['device_id']: d.get('name', 'Unknown Device') for d in devices}
-    device_ids = list(device_map.keys())
-    
+def parse_history_time(value: str, end_of_day: bool = False) -> str:
+    """Validate an ISO date/time filter; a bare date used as an upper bound covers the whole day"""
+    datetime.fromisoformat(value.replace('Z', ''))
+    if end_of_day and len(value) == 10:
+        return value + 'T23:59:59.999999Z'
+    return value
+
+
+def start_time_condition(key_condition, since: str = None, until: str = None):
+    """Narrow a sessions key condition to start_time in [since, until]"""
+    if since and until:
+        return key_condition & Key('start_time').between(since, until)
+    if since:
+        return key_condition & Key('start_time').gte(since)
+    if until:
+        return key_condition & Key('start_time').lte(until)
+    return key_condition
+
+
+def query_user_sessions(user_id: str, since: str = None, until: str = None, **kwargs) -> list:
+    """
+    All of a user's sessions started in [since, until]: one range query on the
+    user index, or one query per device when the index is not configured.
+    """
+    if SESSIONS_USER_INDEX:
+        return query_all_items(
+            sessions_table,
+            IndexName=SESSIONS_USER_INDEX,
+            KeyConditionExpression=start_time_condition(Key('user_id').eq(user_id), since, until),
+            **kwargs
+        )
     sessions = []
-    for device_id in device_ids:
-        result = sessions_table.query(
+    for device_id in get_device_names(user_id):
+        sessions.extend(query_all_items(
+            sessions_table,
             IndexName='device-index',
-            KeyConditionExpression=Key('device_id').eq(device_id),
-            ScanIndexForward=False,
-            Limit=limit
-        )
-        for session in result.get('Items', []):
-            if 'device_name' not in session:
-                session['device_name'] = device_map.get(session['device_id'], 'Unknown Device')
-            sessions.append(session)
+            KeyConditionExpression=start_time_condition(Key('device_id').eq(device_id), since, until),
+            **kwargs
+        ))
+    return sessions
+
+
+def is_history_position(position) -> bool:
+    """[start_time, session_id] of the last session a page returned"""
+    return (isinstance(position, list) and len(position) == 2
+            and all(isinstance(part, str) for part in position))
+
+
+def encode_history_cursor(state: dict) -> str:
+    """Opaque continuation token - URL-safe base64 of the resume positions"""
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode()
+
+
+def decode_history_cursor(token: str) -> dict:
+    state = json.loads(base64.urlsafe_b64decode(token.encode()))
+    if not isinstance(state, dict):
+        raise ValueError('malformed cursor')
+    if SESSIONS_USER_INDEX:
+        if not is_history_position(state.get('k')):
+            raise ValueError('malformed cursor')
+    else:
+        if not isinstance(state.get('d'), dict):
+            raise ValueError('malformed cursor')
+        if not all(position == 0 or is_history_position(position) for position in state['d'].values()):
+            raise ValueError('malformed cursor')
+    return state
+
+
+def user_history_page(user_id: str, state: dict, limit: int, since: str, until: str) -> tuple:
+    """One page from the user index; the cursor holds its LastEvaluatedKey"""
+    query_kwargs = {
+        'IndexName': SESSIONS_USER_INDEX,
+        'KeyConditionExpression': start_time_condition(Key('user_id').eq(user_id), since, until),
+        'ScanIndexForward': False,
+        'Limit': limit
+    }
+    if state.get('k'):
+        start_time, session_id = state['k']
+        query_kwargs['ExclusiveStartKey'] = {'user_id': user_id, 'start_time': start_time, 'session_id': session_id}
+    result = sessions_table.query(**query_kwargs)
+    sessions = result.get('Items', [])
+    
+    next_state = None
+    last_key = result.get('LastEvaluatedKey')
+    if last_key:
+        next_state = {'k': [last_key['start_time'], last_key['session_id']]}
+    return sessions, next_state
+
+
+def iter_device_sessions(device_id: str, key_condition, start_key: dict, fetch_size: int, exhausted: set):
+    """A device's sessions newest first, fetched lazily in growing pages"""
+    query_kwargs = {
+        'IndexName': 'device-index',
+        'KeyConditionExpression': key_condition,
+        'ScanIndexForward': False,
+        'Limit': fetch_size
+    }
+    if start_key:
+        query_kwargs['ExclusiveStartKey'] = start_key
+    while True:
+        result = sessions_table.query(**query_kwargs)
+        yield from result.get('Items', [])
+        if 'LastEvaluatedKey' not in result:
+            exhausted.add(device_id)
+            return
+        query_kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
+        query_kwargs['Limit'] = min(query_kwargs['Limit'] * 2, HISTORY_MAX_FETCH)
+
+
+def device_history_page(device_ids: list, state: dict, limit: int, since: str, until: str) -> tuple:
+    """
+    One page merged across the user's devices (deployments without the user
+    index). The cursor holds each device's position.
+    """
+    # Position per device: [start_time, session_id] of the last session returned, 0 once exhausted.
+    # Devices not in the cursor (or not the user's) start from the top.
+    positions = {device_id: state.get('d', {}).get(device_id) for device_id in device_ids}
+    exhausted = {device_id for device_id, position in positions.items() if position == 0}
+    active = [device_id for device_id in device_ids if device_id not in exhausted]
+    
+    # Small first fetch per device; a stream that keeps winning the merge fetches more
+    fetch_size = max(HISTORY_MIN_FETCH, -(-(limit + 1) // max(len(active), 1)))
+    streams = []
+    for device_id in active:
+        key_condition = start_time_condition(Key('device_id').eq(device_id), since, until)
+        position = positions[device_id]
+        start_key = None
+        if position:
+            start_key = {'device_id': device_id, 'start_time': position[0], 'session_id': position[1]}
+        streams.append(iter_device_sessions(device_id, key_condition, start_key, fetch_size, exhausted))
+    
+    # k-way merge by start_time; one extra item tells whether another page exists
+    merged = heapq.merge(*streams, key=lambda s: s.get('start_time', ''), reverse=True)
+    page = list(islice(merged, limit + 1))
+    sessions = page[:limit]
+    
+    for session in sessions:
+        positions[session['device_id']] = [session['start_time'], session['session_id']]
+    for device_id in exhausted:
+        positions[device_id] = 0
+    
+    next_state = None
+    if len(page) > limit:
+        next_state = {'d': {device_id: position for device_id, position in positions.items() if position is not None}}
+    return sessions, next_state
+
+
+def get_history(user_id: str, limit: int, cursor: str = None,
+                since: str = None, until: str = None) -> dict:
+    """Get session history for user, newest first, one page at a time"""
+    try:
+        if cursor:
+            # The range travels with the cursor so every page resumes inside the same key condition;
+            # it came back from the client, so it is validated like the query parameters
+            state = decode_history_cursor(cursor)
+            since, until = state.get('from'), state.get('to')
+            if not all(value is None or isinstance(value, str) for value in (since, until)):
+                raise ValueError('malformed cursor')
+        else:
+            state = {}
+        since = parse_history_time(since) if since else None
+        until = parse_history_time(until, end_of_day=True) if until else None
+    except (ValueError, TypeError):
+        return response(400, {'error': 'Invalid cursor or time range'})
+    
+    device_map = None
+    if SESSIONS_USER_INDEX:
+        sessions, next_state = user_history_page(user_id, state, limit, since, until)
+    else:
+        device_map = get_device_names(user_id)
+        sessions, next_state = device_history_page(list(device_map), state, limit, since, until)
     
-    # Sort by start_time descending
-    sessions.sort(key=lambda x: x.get('start_time', ''), reverse=True)
+    # Sessions started before device_name was stored on them
+    for session in sessions:
+        if 'device_name' not in session:
+            if device_map is None:
+                device_map = get_device_names(user_id)
+            session['device_name'] = device_map.get(session['device_id'], 'Unknown Device')
     
-    return response(200, {'sessions': sessions[:limit]})
+    next_cursor = None
+    if next_state:
+        next_state.update({'from': since, 'to': until})
+        next_cursor = encode_history_cursor(next_state)
+    
+    return response(200, {'sessions': sessions, 'next_cursor': next_cursor})
+
+
+def get_device_names(user_id: str) -> dict:
+    """device_id -> name for the user's devices"""
+    devices = query_all_items(
+        devices_table,
+        IndexName='user-index',
+        KeyConditionExpression=Key('user_id').eq(user_id),
+        ProjectionExpression='device_id, #n',
+        ExpressionAttributeNames={'#n': 'name'}
+    )
+    return {d['device_id']: d.get('name', 'Unknown Device') for d in devices}
 
 
 def get_realtime(device_id: str, user_id: str) -> dict:
     """Get real-time telemetry for device"""
     # Check ownership
-    result = devices_table.get_item(Key={'device_id': device_id})
-    device = result.get('Item')
+    device = load_device(device_id)
     
     if not device or device.get('user_id') != user_id:
         return response(403, {'error': 'Access denied'})
@@ -881,41 +1837,88 @@ def get_realtime(device_id: str, user_id: str) -> dict:
     # Get latest telemetry (last 5 minutes)
     five_min_ago = (datetime.utcnow() - timedelta(minutes=5)).isoformat()
     
-    result = telemetry_table.query(
-        KeyConditionExpression=Key('device_id').eq(device_id) & 
-                               Key('timestamp').gte(five_min_ago),
-        ScanIndexForward=False,
-        Limit=10
-    )
-    
     return response(200, {
         'device': device,
-        'telemetry': result.get('Items', [])
+        'telemetry': query_telemetry(device_id, five_min_ago, 10)
     })
 
 
-# ============= USERS =============
-
-def handle_users(method: str, path: str, params: dict, body: dict,
-                 user_id: str, role: str, email: str = None, name: str = None) -> dict:
-    """Handle user-related requests"""
-    target_user_id = params.get('user_id')
+def query_telemetry(device_id: str, since: str, limit: int) -> list:
+    """Latest raw readings since an ISO timestamp, newest first, in either storage mode"""
+    if TELEMETRY_STORAGE_MODE != 'chunked':
+        result = telemetry_table.query(
+            KeyConditionExpression=Key('device_id').eq(device_id) & 
+                                   Key('timestamp').gte(since),
+            ScanIndexForward=False,
+            Limit=limit
+        )
+        return result.get('Items', [])
+    
+    # Chunks are keyed by window start, so the first one may begin before `since`
+    since_epoch = int(datetime.fromisoformat(since.replace('Z', '')).replace(tzinfo=timezone.utc).timestamp())
+    window_start = datetime.utcfromtimestamp(since_epoch - since_epoch % TELEMETRY_CHUNK_SECONDS)
+    query_kwargs = {
+        'KeyConditionExpression': Key('device_id').eq(device_id) &
+                                  Key('chunk_start').gte(window_start.strftime('%Y-%m-%dT%H:%M:%S')),
+        'ScanIndexForward': False
+    }
+    
+    readings = []
+    while True:
+        result = chunks_table.query(**query_kwargs)
+        for item in result.get('Items', []):
+            readings.extend(r for r in decode_chunk(item) if r['timestamp'] >= since)
+        # Newest chunks come first - stop once we have enough
+        if len(readings) >= limit or 'LastEvaluatedKey' not in result:
+            break
+        query_kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
     
-    # GET /users/me - Get own profile
-    if method == 'GET' and (not target_user_id or target_user_id == 'me'):
-        return get_user_profile(user_id, email, name)
+    readings.sort(key=lambda r: r['timestamp'], reverse=True)
+    return readings[:limit]
+
+
+def get_trends(device_id: str, user_id: str, resolution: str, hours: int) -> dict:
+    """Get temperature/heating trends for a device from the minute or hour rollups"""
+    if resolution not in ('minute', 'hour'):
+        return response(400, {'error': 'resolution must be minute or hour'})
+    # Keep responses bounded: 24h of minutes, 90 days of hours
+    hours = max(1, min(hours, 24 if resolution == 'minute' else 24 * 90))
     
-    # PUT /users/me - Update own profile
-    elif method == 'PUT' and (not target_user_id or target_user_id == 'me'):
-        return update_user_profile(user_id, body)
+    # Check ownership
+    if device_owner(device_id) != user_id:
+        return response(403, {'error': 'Access denied'})
     
-    # Admin: GET /users - List all users
-    elif method == 'GET' and not target_user_id and role == 'admin':
-        return list_all_users()
+    bucket_format = '%Y-%m-%dT%H:%M' if resolution == 'minute' else '%Y-%m-%dT%H'
+    start = (datetime.utcnow() - timedelta(hours=hours)).strftime(bucket_format)
     
-    return response(404, {'error': 'User route not found'})
+    query_kwargs = {
+        'KeyConditionExpression': Key('device_id').eq(device_id) &
+                                  Key('bucket').between(f'{resolution}#{start}', f'{resolution}#~')
+    }
+    points = []
+    while True:
+        result = rollups_table.query(**query_kwargs)
+        for item in result.get('Items', []):
+            count = item.get('reading_count', 0)
+            ready_count = item.get('ready_count', 0)
+            points.append({
+                'time': item['bucket'].split('#', 1)[1],
+                'count': count,
+                'min_temp': item.get('min_temp'),
+                'max_temp': item.get('max_temp'),
+                'avg_temp': item['temp_sum'] / count if count else None,
+                'heating_seconds': item.get('heating_seconds', 0),
+                'avg_time_to_ready': item['time_to_ready_sum'] / ready_count if ready_count else None
+            })
+        if 'LastEvaluatedKey' not in result:
+            break
+        query_kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
+    
+    return response(200, {'device_id': device_id, 'resolution': resolution, 'points': points})
 
 
+# ============= USERS =============
+
 def get_user_profile(user_id: str, email: str = None, name: str = None) -> dict:
     """Get user profile"""
     result = users_table.get_item(Key={'user_id': user_id})
@@ -1012,22 +2015,13 @@ def update_user_profile(user_id: str, body: dict) -> dict:
         ExpressionAttributeValues=expr_values,
         ExpressionAttributeNames=expr_names if expr_names else None
     )
+    invalidate_user_settings(user_id)
     
     return response(200, {'message': 'Profile updated'})
 
 
 # ============= SETTINGS =============
 
-def handle_settings(method: str, body: dict, user_id: str) -> dict:
-    """Handle settings requests"""
-    if method == 'GET':
-        return get_settings(user_id)
-    elif method == 'PUT':
-        return update_settings(user_id, body)
-    
-    return response(404, {'error': 'Settings route not found'})
-
-
 def get_settings(user_id: str) -> dict:
     """Get user settings"""
     result = users_table.get_item(Key={'user_id': user_id})
@@ -1099,6 +2093,7 @@ def update_settings(user_id: str, body: dict) -> dict:
             ExpressionAttributeValues=expr_values,
             ExpressionAttributeNames=expr_names if expr_names else None
         )
+        invalidate_user_settings(user_id)
         
         return response(200, {'message': 'Settings updated'})
     except Exception as e:
@@ -1108,152 +2103,212 @@ def update_settings(user_id: str, body: dict) -> dict:
 
 # ============= ADMIN =============
 
-def handle_admin(method: str, path: str, params: dict, query: dict, body: dict = None) -> dict:
-    """Handle admin requests"""
-    
-    # Admin User Actions
-    if path.startswith('/admin/users'):
-        if path == '/admin/users' and method == 'GET':
-            return list_all_users()
-        
-        # User management paths: /admin/users/{userId} or /admin/users/{userId}/role
-        parts = path.split('/')
-        if len(parts) >= 4:
-            target_user_id = parts[3]
-            
-            if len(parts) == 4 and method == 'DELETE':
-                return delete_user_admin(target_user_id)
-                
-            if len(parts) == 5 and parts[4] == 'role' and method == 'POST':
-                # body is passed directly now
-                role_data = body if body else {}
-                # If body was stringified JSON in some contexts:
-                if isinstance(role_data, str):
-                    role_data = json.loads(role_data)
-                    
-                return update_user_role(target_user_id, role_data.get('role'))
-
-    
-    if '/stats' in path:
-        # Check for userId in query params for filtering
-        target_user_id = query.get('userId') if query else None
-        return get_system_stats(target_user_id)
-    
-    elif '/devices' in path:
-        return list_all_devices()
-    
-    return response(404, {'error': 'Admin route not found'})
+def admin_update_role(target_user_id: str, body: dict) -> dict:
+    """POST /admin/users/{user_id}/role"""
+    role_data = body if body else {}
+    # If body was stringified JSON in some contexts:
+    if isinstance(role_data, str):
+        role_data = json.loads(role_data)
+    return update_user_role(target_user_id, role_data.get('role'))
 
 
 def get_system_stats(target_user_id: str = None) -> dict:
     """
     Get system-wide statistics.
     If target_user_id is provided, return stats ONLY for that user.
+    Served from the SystemStats items kept by stats_materializer: one query.
     """
-    # Scan all tables fully
-    users_res = scan_all_items(users_table)
-    devices_res = scan_all_items(devices_table)
-    sessions_res = scan_all_items(sessions_table)
+    pk = f"USER#{target_user_id}" if target_user_id else 'GLOBAL'
+    items = query_all_items(stats_table, KeyConditionExpression=Key('pk').eq(pk))
+    totals = next((item for item in items if item['sk'] == 'TOTALS'), None)
+    if totals is None and (not target_user_id or
+                           'Item' not in stats_table.get_item(Key={'pk': 'GLOBAL', 'sk': 'TOTALS'})):
+        # Materializer not deployed (or not rebuilt) yet
+        return scan_system_stats(target_user_id)
+    totals = totals or {}
+    
+    # Day items sort before TOTALS and by date
+    daily_data = [
+        {'date': item['sk'][len('DAY#'):], 'sessions': int(item.get('sessions', 0)),
+         'water': float(item.get('water', 0))}
+        for item in items
+        if item['sk'].startswith('DAY#') and item.get('sessions', 0) > 0
+    ]
     
-    # If filtering by user, filter the lists first
+    return response(200, {
+        'total_users': int(totals.get('users', 0)),
+        'total_devices': int(totals.get('devices', 0)),
+        'devices_online': int(totals.get('devices_online', 0)),
+        'total_sessions': int(totals.get('sessions', 0)),
+        'total_water_saved': float(totals.get('water_saved', 0)),
+        'activity_data': daily_data
+    })
+
+
+def scan_system_stats(target_user_id: str = None) -> dict:
+    """
+    get_system_stats computed from the tables in one streaming pass: projected
+    scans (or, for one user, targeted queries) feed the counters item by item,
+    so memory does not grow with the number of sessions.
+    """
+    status_names = {'#s': 'status'}
     if target_user_id:
-        users_res = [u for u in users_res if u.get('user_id') == target_user_id]
-        # Identify devices owned by this user
-        user_devices = {d.get('device_id') for d in devices_res if d.get('user_id') == target_user_id}
-        devices_res = [d for d in devices_res if d.get('device_id') in user_devices]
-        # Identify sessions from those devices
-        sessions_res = [s for s in sessions_res if s.get('device_id') in user_devices]
-    
-    # Simple counts
-    users_count = len(users_res)
-    devices_count = len(devices_res)
-    sessions_count = len(sessions_res)
-    
-    # Online devices count
-    online_count = sum(1 for d in devices_res if d.get('status') == 'online')
-    
-    # Total water saved in completed sessions
-    total_water = sum(
-        float(s.get('water_saved', 0)) 
-        for s in sessions_res 
-        if s.get('status') == 'completed'
-    )
+        user = users_table.get_item(Key={'user_id': target_user_id}, ProjectionExpression='user_id').get('Item')
+        users = [user] if user else []
+        # A user has few devices; their sessions stream from one device-index query each
+        devices = query_all_items(
+            devices_table,
+            IndexName='user-index',
+            KeyConditionExpression=Key('user_id').eq(target_user_id),
+            ProjectionExpression='device_id, #s',
+            ExpressionAttributeNames=status_names
+        )
+        sessions = chain.from_iterable(
+            iter_query(
+                sessions_table,
+                IndexName='device-index',
+                KeyConditionExpression=Key('device_id').eq(device['device_id']),
+                ProjectionExpression='#s, start_time, water_saved',
+                ExpressionAttributeNames=status_names
+            )
+            for device in devices
+        )
+    else:
+        users = iter_scan(users_table, ProjectionExpression='user_id')
+        devices = iter_scan(devices_table, ProjectionExpression='device_id, #s',
+                            ExpressionAttributeNames=status_names)
+        sessions = iter_scan(sessions_table, ProjectionExpression='#s, start_time, water_saved',
+                             ExpressionAttributeNames=status_names)
     
-    # Generate Daily Data (All Time)
-    daily_data = []
-    days_map = {}
+    return response(200, aggregate_system_stats(users, devices, sessions))
+
+
+def aggregate_system_stats(users, devices, sessions) -> dict:
+    """Single pass over (possibly streaming) item iterables -> the /admin/stats body"""
+    users_count = sum(1 for _ in users)
+    
+    devices_count = 0
+    online_count = 0
+    for device in devices:
+        devices_count += 1
+        if device.get('status') == 'online':
+            online_count += 1
     
-    # Process all sessions
-    for s in sessions_res:
-        if not s.get('start_time'): continue
+    sessions_count = 0
+    total_water = Decimal('0')
+    days_map = {}
+    for s in sessions:
+        sessions_count += 1
+        completed = s.get('status') == 'completed'
+        water = Decimal(str(s.get('water_saved', 0))) if completed else Decimal('0')
+        total_water += water
+        
+        if not s.get('start_time'):
+            continue
         try:
-            # Handle timestamps (Shift UTC to UTC+2 for Israel Time)
-            st_str = str(s['start_time']).replace('Z', '')
-            st = datetime.fromisoformat(st_str)
-            st_israel = st + timedelta(hours=2)
-            
-            # Group by date YYYY-MM-DD
-            day_key = st_israel.strftime('%Y-%m-%d')
-            
-            if day_key not in days_map:
-                days_map[day_key] = {'date': day_key, 'sessions': 0, 'water': Decimal('0')}
-            
-            days_map[day_key]['sessions'] += 1
-            if s.get('status') == 'completed':
-                 days_map[day_key]['water'] += Decimal(str(s.get('water_saved', 0)))
-                 
-        except Exception as e:
+            # Group by Israel local date
+            day_key = local_date(s['start_time'])
+        except ValueError as e:
             print(f"Error parsing date {s.get('start_time')}: {e}")
             continue
-
-    # Convert map to sorted list
-    daily_data = sorted(days_map.values(), key=lambda x: x['date'])
+        day = days_map.setdefault(day_key, {'date': day_key, 'sessions': 0, 'water': Decimal('0')})
+        day['sessions'] += 1
+        day['water'] += water
     
-    # Convert decimals to float for JSON
+    daily_data = sorted(days_map.values(), key=lambda x: x['date'])
     for d in daily_data:
         d['water'] = float(d['water'])
-
-    return response(200, {
+    
+    return {
         'total_users': users_count,
         'total_devices': devices_count,
         'devices_online': online_count,
         'total_sessions': sessions_count,
-        'total_water_saved': total_water,
-        'activity_data': daily_data 
-    })
+        'total_water_saved': float(total_water),
+        'activity_data': daily_data
+    }
 
 
+def iter_scan(table, segments: int = None, **kwargs):
+    """
+    Yield every item of a table (scan kwargs such as ProjectionExpression pass
+    through). With more than one segment this is a DynamoDB parallel scan: one
+    thread per Segment, pages yielded as soon as any segment returns them, so
+    item order is not defined.
+    """
+    segments = SCAN_SEGMENTS if segments is None else segments
+    if segments <= 1:
+        while True:
+            result = table.scan(**kwargs)
+            yield from result.get('Items', [])
+            if 'LastEvaluatedKey' not in result:
+                return
+            kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
+    
+    # One waiting page per segment: memory stays at a few pages however big the table is
+    pages = queue.Queue(maxsize=segments)
+    stop = threading.Event()
+    
+    def put(message):
+        while not stop.is_set():
+            try:
+                pages.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+    
+    def scan_segment(segment: int):
+        segment_kwargs = dict(kwargs, Segment=segment, TotalSegments=segments)
+        try:
+            while not stop.is_set():
+                result = table.scan(**segment_kwargs)
+                put(('items', result.get('Items', [])))
+                if 'LastEvaluatedKey' not in result:
+                    break
+                segment_kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
+        except Exception as e:
+            put(('error', e))
+        finally:
+            put(('done', None))
+    
+    executor = ThreadPoolExecutor(max_workers=segments)
+    try:
+        for segment in range(segments):
+            executor.submit(scan_segment, segment)
+        running = segments
+        while running:
+            kind, payload = pages.get()
+            if kind == 'items':
+                yield from payload
+            elif kind == 'error':
+                raise payload
+            else:
+                running -= 1
+    finally:
+        # Also reached when the caller stops early - lets the segment threads exit
+        stop.set()
+        executor.shutdown(wait=False)
+
 
 def scan_all_items(table, **kwargs):
-    """Helper to scan all items with pagination"""
-    items = []
-    response = table.scan(**kwargs)
-    items.extend(response.get('Items', []))
-    
-    while 'LastEvaluatedKey' in response:
-        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
-        response = table.scan(**kwargs)
-        items.extend(response.get('Items', []))
-        
-    return items
+    """Helper to scan all items with pagination (parallel, see iter_scan)"""
+    return list(iter_scan(table, **kwargs))
 
 def list_all_users() -> dict:
     """List all users (admin only)"""
     # Get all users
     users = scan_all_items(users_table)
     
-    # Get all devices
-    devices = scan_all_items(devices_table, ProjectionExpression='user_id')
+    # Count devices as the scan streams in
     device_counts = {}
-    for d in devices:
+    for d in iter_scan(devices_table, ProjectionExpression='user_id'):
         uid = d.get('user_id')
         if uid:
             device_counts[uid] = device_counts.get(uid, 0) + 1
         
-    # Get all sessions
-    sessions = scan_all_items(sessions_table, ProjectionExpression='user_id')
+    # Count sessions the same way
     session_counts = {}
-    for s in sessions:
+    for s in iter_scan(sessions_table, ProjectionExpression='user_id'):
         uid = s.get('user_id')
         if uid:
             session_counts[uid] = session_counts.get(uid, 0) + 1
@@ -1292,41 +2347,36 @@ def delete_user_admin(target_user_id: str) -> dict:
             print(f"Error deleting from Cognito: {str(e)}")
             # Continue to delete from DB anyway
             
-        # 2. Find and Delete User's Devices and Sessions
+        # 2. Delete the user's devices, then their history (inline or as a job)
+        devices = query_all_items(
+            devices_table,
+            IndexName='user-index',
+            KeyConditionExpression=Key('user_id').eq(target_user_id),
+            ProjectionExpression='device_id, total_sessions'
+        )
+        device_ids = [d['device_id'] for d in devices]
+        # Recorded before anything is deleted, so the devices' history is purged
+        # even if a later step fails. The aggregate is gone with the user - no
+        # per-session bookkeeping (no owner_id)
+        job = create_job('delete_user', target_user_id, device_ids, 'admin')
         try:
-            # Query devices by user_index
-            dev_response = devices_table.query(
-                IndexName='user-index',
-                KeyConditionExpression=Key('user_id').eq(target_user_id)
-            )
-            devices = dev_response.get('Items', [])
+            batch_delete_keys(devices_table, [{'device_id': device_id} for device_id in device_ids])
+            for device_id in device_ids:
+                forget_device(device_id)
+            print(f"Deleted {len(device_ids)} devices")
             
-            for device in devices:
-                dev_id = device['device_id']
-                
-                # Delete sessions for this device
-                try:
-                    sess_response = sessions_table.query(
-                        IndexName='device-index',
-                        KeyConditionExpression=Key('device_id').eq(dev_id)
-                    )
-                    for session in sess_response.get('Items', []):
-                        sessions_table.delete_item(Key={'session_id': session['session_id']})
-                        print(f"Deleted session {session['session_id']}")
-                except Exception as s_err:
-                    print(f"Error cleaning sessions for device {dev_id}: {s_err}")
-                
-                # Delete the device itself
-                devices_table.delete_item(Key={'device_id': dev_id})
-                print(f"Deleted device {dev_id}")
-                
-        except Exception as d_err:
-            print(f"Error performing cascading delete: {d_err}")
-
-        # 3. Delete from Users Table
-        users_table.delete_item(Key={'user_id': target_user_id})
+            # 3. Delete from Users Table
+            users_table.delete_item(Key={'user_id': target_user_id})
+            user_stats_table.delete_item(Key={'user_id': target_user_id})
+            invalidate_user_settings(target_user_id)
+        except Exception:
+            # Some devices may be gone already - purge the history in the background
+            queue_job(job)
+            raise
         
-        return response(200, {'message': f'User {target_user_id} and all associated data deleted successfully'})
+        estimate = sum(int(d.get('total_sessions', 0)) for d in devices)
+        job = cascade_delete(job, estimate)
+        return cascade_response(job, f'User {target_user_id} and all associated data deleted successfully')
         
     except Exception as e:
         print(f"Error deleting user: {str(e)}")
@@ -1377,6 +2427,7 @@ def update_user_role(target_user_id: str, new_role: str) -> dict:
                 ':ts': datetime.utcnow().isoformat()
             }
         )
+        invalidate_user_settings(target_user_id)
         
         return response(200, {'message': f'User role updated to {new_role}'})
         
@@ -1414,36 +2465,52 @@ def delete_session(session_id: str, user_id: str) -> dict:
                  return response(403, {'error': 'Cannot verify ownership (no device_id)'})
         else:
             # Check if device belongs to user
-            dev_resp = devices_table.get_item(Key={'device_id': device_id})
-            device = dev_resp.get('Item')
-            
-            if device and device.get('user_id') == user_id:
+            if device_owner(device_id) == user_id:
                 user_id_match = True
                 
         # Allow admins to delete as well? For now, stick to owner.
         if not user_id_match:
             return response(403, {'error': 'Not authorized to delete this session'})
 
-        # Capture stats before delete
-        water_saved = session.get('water_saved', Decimal('0'))
+        # Delete Session - ALL_OLD tells us whether this request actually removed it,
+        # so a repeated delete cannot decrement the counters twice
+        deleted = sessions_table.delete_item(
+            Key={'session_id': session_id}, ReturnValues='ALL_OLD'
+        ).get('Attributes')
+        if not deleted:
+            return response(404, {'error': 'Session not found'})
+        water_saved = deleted.get('water_saved', Decimal('0'))
         
-        # Delete Session
-        sessions_table.delete_item(Key={'session_id': session_id})
+        # A deleted session can no longer be the device's active one
+        if device_id and deleted.get('status') == 'active':
+            clear_active_session(device_id, session_id)
         
-        # Update Device Stats (Decrement)
-        if device_id:
+        # Update Device Stats (Decrement) - only stopped sessions were counted
+        if device_id and deleted.get('status') != 'active':
             try:
                 devices_table.update_item(
                     Key={'device_id': device_id},
                     UpdateExpression='ADD total_water_saved :w, total_sessions :i',
+                    # Never recreate a deleted device as a bare counter item
+                    ConditionExpression='attribute_exists(device_id)',
                     ExpressionAttributeValues={
                         ':w': -water_saved,
                         ':i': -1
                     }
                 )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    print(f"Failed to decrement device stats: {e}")
             except Exception as e:
                 print(f"Failed to decrement device stats: {e}")
         
+        if deleted.get('status') != 'active':
+            try:
+                record_user_stats(deleted.get('user_id') or user_id, deleted.get('start_time'),
+                                  -water_saved, -deleted.get('money_saved', Decimal('0')), -1, [session_id])
+            except Exception as e:
+                print(f"Failed to decrement user stats: {e}")
+        
         return response(200, {'message': 'Session deleted and stats updated'})
 
     except Exception as e:
@@ -0,0 +1,18 @@
+"""
+EcoShower - Local dates
+Dashboard and admin days are Israel local dates (UTC+2). The API's per-user
+aggregates and the stats materializer's SystemStats day buckets must put a
+session on the same day, so both use local_date from here.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+LOCAL_UTC_OFFSET_HOURS = 2
+
+
+def local_date(timestamp: str) -> str:
+    """Israel local date (YYYY-MM-DD) of an ISO timestamp (naive means UTC)"""
+    moment = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return (moment + timedelta(hours=LOCAL_UTC_OFFSET_HOURS)).strftime('%Y-%m-%d')
@@ -3,34 +3,126 @@ EcoShower - Process Telemetry Lambda
 Handles incoming IoT data and triggers notifications
 """
 
+import base64
 import json
-import boto3
 import os
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
 from decimal import Decimal
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeDeserializer
+from telemetry_codec import decode_chunk, decode_readings, encode_readings, to_epoch_ms
+from instrumentation import Tracer
+from aws_clients import TTLCache, lazy_client, lazy_resource, lazy_table
 
-# Initialize AWS clients
-dynamodb = boto3.resource('dynamodb')
-iot_client = boto3.client('iot-data')
-sns_client = boto3.client('sns')
+# IoT and SNS calls run while a reading is being ingested - fail fast and retry a
+# bounded number of times instead of using the SDK defaults (60s reads, legacy retries)
+DISPATCH_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('DISPATCH_CONNECT_TIMEOUT_SECONDS', '1'))
+DISPATCH_READ_TIMEOUT_SECONDS = float(os.environ.get('DISPATCH_READ_TIMEOUT_SECONDS', '2'))
+DISPATCH_MAX_ATTEMPTS = int(os.environ.get('DISPATCH_MAX_ATTEMPTS', '3'))
+PUBLISH_CONFIG = Config(
+    connect_timeout=DISPATCH_CONNECT_TIMEOUT_SECONDS,
+    read_timeout=DISPATCH_READ_TIMEOUT_SECONDS,
+    retries={'max_attempts': DISPATCH_MAX_ATTEMPTS, 'mode': 'standard'}
+)
+
+# Per-stage timings and AWS call counts, logged as one EMF line per sampled invocation
+tracer = Tracer('process_telemetry')
+
+# Initialize AWS clients - created on first use (most readings never publish)
+dynamodb = tracer.instrument(lazy_resource('dynamodb'), 'dynamodb')
+iot_client = tracer.instrument(lazy_client('iot-data', config=PUBLISH_CONFIG), 'iot')
+sns_client = tracer.instrument(lazy_client('sns', config=PUBLISH_CONFIG), 'sns')
 
 # Environment variables
 TELEMETRY_TABLE = os.environ.get('TELEMETRY_TABLE', 'EcoShower-Telemetry')
 DEVICES_TABLE = os.environ.get('DEVICES_TABLE', 'EcoShower-Devices')
 SESSIONS_TABLE = os.environ.get('SESSIONS_TABLE', 'EcoShower-Sessions')
 USERS_TABLE = os.environ.get('USERS_TABLE', 'EcoShower-Users')
+ROLLUPS_TABLE = os.environ.get('ROLLUPS_TABLE', 'EcoShower-TelemetryRollups')
+TELEMETRY_CHUNKS_TABLE = os.environ.get('TELEMETRY_CHUNKS_TABLE', 'EcoShower-TelemetryChunks')
 
 # Tables
-telemetry_table = dynamodb.Table(TELEMETRY_TABLE)
-devices_table = dynamodb.Table(DEVICES_TABLE)
-sessions_table = dynamodb.Table(SESSIONS_TABLE)
-users_table = dynamodb.Table(USERS_TABLE)
+telemetry_table = tracer.instrument(lazy_table(dynamodb, TELEMETRY_TABLE), 'dynamodb')
+devices_table = tracer.instrument(lazy_table(dynamodb, DEVICES_TABLE), 'dynamodb')
+sessions_table = tracer.instrument(lazy_table(dynamodb, SESSIONS_TABLE), 'dynamodb')
+users_table = tracer.instrument(lazy_table(dynamodb, USERS_TABLE), 'dynamodb')
+rollups_table = tracer.instrument(lazy_table(dynamodb, ROLLUPS_TABLE), 'dynamodb')
+chunks_table = tracer.instrument(lazy_table(dynamodb, TELEMETRY_CHUNKS_TABLE), 'dynamodb')
 
 # Water cost per liter (NIS) - REMOVED (Now dynamic per user)
 # WATER_COST_PER_LITER = Decimal('0.008')
 # Liters saved per second when circulating
 LITERS_PER_SECOND = Decimal('0.8')
 
+# BatchWriteItem accepts at most 25 items per request
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_RETRIES = int(os.environ.get('BATCH_WRITE_MAX_RETRIES', '3'))
+BATCH_WRITE_BACKOFF_SECONDS = 0.05
+
+# User settings are cached across warm invocations. Changes made through the API
+# become visible here within CONFIG_CACHE_TTL_SECONDS. Device configs come back
+# with every device write (ReturnValues=ALL_NEW) and need no separate cache.
+CONFIG_CACHE_TTL_SECONDS = float(os.environ.get('CONFIG_CACHE_TTL_SECONDS', '30'))
+CONFIG_CACHE_MAX_ITEMS = int(os.environ.get('CONFIG_CACHE_MAX_ITEMS', '1024'))
+
+user_cache = TTLCache(CONFIG_CACHE_MAX_ITEMS, CONFIG_CACHE_TTL_SECONDS)
+
+# Write coalescing: the device item is rewritten only when the status changes or the
+# temperature moves more than the deadband; otherwise last_seen is refreshed every
+# HEARTBEAT_SECONDS. Decisions use the last state this container wrote, not a read.
+STATUS_TEMP_DEADBAND_TENTHS = int(os.environ.get('STATUS_TEMP_DEADBAND_TENTHS', '5'))
+HEARTBEAT_SECONDS = float(os.environ.get('HEARTBEAT_SECONDS', '60'))
+# 'all' stores every reading, 'on_change' applies the same policy to the Telemetry table
+TELEMETRY_STORE_MODE = os.environ.get('TELEMETRY_STORE_MODE', 'all')
+
+# A 'ready' device starts a new heating cycle only on a heating reading this far below
+# its target, so sensor noise around the target does not repeat the water-ready alert
+READY_REARM_DEGREES = Decimal(os.environ.get('READY_REARM_DEGREES', '2'))
+
+written_state_cache = TTLCache(CONFIG_CACHE_MAX_ITEMS, HEARTBEAT_SECONDS * 10)
+stored_reading_cache = TTLCache(CONFIG_CACHE_MAX_ITEMS, HEARTBEAT_SECONDS * 10)
+
+# Per-device minute/hour rollups (min, max, mean, count, heating time, time to ready).
+# 'stream' builds them in batches from the Telemetry/TelemetryChunks streams
+# (rollup_handler) and ingest only records time to ready; 'inline' writes them on
+# every ingest invocation (two writes per single reading); 'off' disables them.
+ROLLUPS_MODE = os.environ.get('ROLLUPS_MODE', 'stream')
+if os.environ.get('ROLLUPS_ENABLED', 'true').lower() == 'false':
+    ROLLUPS_MODE = 'off'
+# Gaps longer than this between readings are not counted as heating time
+ROLLUP_MAX_GAP_SECONDS = float(os.environ.get('ROLLUP_MAX_GAP_SECONDS', '60'))
+ROLLUP_RESOLUTIONS = {
+    # resolution: (bucket format, retention days - 0 keeps forever)
+    'minute': ('%Y-%m-%dT%H:%M', int(os.environ.get('ROLLUP_MINUTE_RETENTION_DAYS', '7'))),
+    'hour': ('%Y-%m-%dT%H', int(os.environ.get('ROLLUP_HOUR_RETENTION_DAYS', '0'))),
+}
+# Raw readings expire through the table's TTL attribute (0 keeps them forever); the
+# rollups keep the history the dashboard shows beyond that
+TELEMETRY_RETENTION_DAYS = int(os.environ.get('TELEMETRY_RETENTION_DAYS', '30'))
+TTL_ATTRIBUTE = 'expires_at'
+
+# 'items' writes one Telemetry item per reading; 'chunked' appends delta-encoded
+# segments (see telemetry_codec) to one item per device per TELEMETRY_CHUNK_SECONDS
+TELEMETRY_STORAGE_MODE = os.environ.get('TELEMETRY_STORAGE_MODE', 'items')
+TELEMETRY_CHUNK_SECONDS = int(os.environ.get('TELEMETRY_CHUNK_SECONDS', '3600'))
+# Appends to a chunk that moved on since it was read back are retried this many times
+CHUNK_APPEND_ATTEMPTS = 3
+
+# Notifications are sent from a small thread pool so a slow SNS call does not hold up
+# ingest. Everything submitted is waited on (up to DISPATCH_FLUSH_TIMEOUT_SECONDS)
+# before the handler returns - Lambda freezes the container afterwards.
+DISPATCH_MAX_WORKERS = int(os.environ.get('DISPATCH_MAX_WORKERS', '4'))
+DISPATCH_MAX_PENDING = int(os.environ.get('DISPATCH_MAX_PENDING', '100'))
+DISPATCH_FLUSH_TIMEOUT_SECONDS = float(os.environ.get('DISPATCH_FLUSH_TIMEOUT_SECONDS', '5'))
+
+# Outlives the stream batching window - update_rollups checks the gap between readings itself
+last_rollup_reading = TTLCache(CONFIG_CACHE_MAX_ITEMS, 3600)
+rollup_extremes_cache = TTLCache(CONFIG_CACHE_MAX_ITEMS * 2, 3600)
+
 
 def lambda_handler(event, context):
     """
@@ -43,50 +135,54 @@ def lambda_handler(event, context):
         "status": "heating",  # heating, ready, idle
         "timestamp": "2025-12-07T12:00:00Z"
     }
-    """
-    print(f"Received event: {json.dumps(event)}")
     
+    Batched events (a list of readings from an IoT rule, or an SQS/Kinesis
+    "Records" envelope) are handed to process_batch.
+    """
+    tracer.begin()
+    try:
+        if isinstance(event, list) or 'Records' in event:
+            return process_batch(event)
+        return process_single(event)
+    finally:
+        # Deliver queued notifications before Lambda freezes the container
+        with tracer.stage('dispatch_flush'):
+            flush_dispatch(context)
+        tracer.end()
+
+
+def process_single(event: dict) -> dict:
+    """Handle one reading delivered directly by the IoT rule"""
     try:
         # Extract data from event
-        device_id = event.get('device_id')
-        temperature = Decimal(str(event.get('temperature', 0)))
-        status = event.get('status', 'unknown')
-        timestamp = event.get('timestamp', datetime.utcnow().isoformat())
-        
-        if not device_id:
-            raise ValueError("device_id is required")
+        reading = parse_reading(event)
+        device_id = reading['device_id']
+        tracer.add_readings(1)
         
         # 1. Store telemetry data
-        store_telemetry(device_id, temperature, status, timestamp)
+        with tracer.stage('store_telemetry'):
+            if should_store_reading(reading):
+                if TELEMETRY_STORAGE_MODE == 'chunked':
+                    reading['record_id'] = 'event'
+                    if store_telemetry_chunks([reading]):
+                        raise RuntimeError("Failed to store telemetry chunk")
+                else:
+                    store_telemetry(device_id, reading['temperature'], reading['status'], reading['timestamp'])
         
-        # 2. Get device configuration
-        device = get_device(device_id)
-        if not device:
-            print(f"Device {device_id} not found in database")
+        # 2-5. Device state, water ready and session savings
+        result = process_reading(device_id, reading['temperature'], reading['status'], reading['timestamp'])
+        if not result:
             return {'statusCode': 404, 'body': 'Device not found'}
         
-        target_temp = Decimal(str(device.get('target_temp', 38)))
-        user_id = device.get('user_id')
-        
-        # 3. Update device status
-        update_device_status(device_id, status, temperature)
-        
-        # 4. Check if water is ready
-        if status == 'heating' and temperature >= target_temp:
-            handle_water_ready(device_id, user_id, device)
-        
-        # 5. Calculate water saved in current session
-        if status == 'heating':
-            update_session_savings(device_id, user_id)
+        # 6. Minute/hour rollups
+        with tracer.stage('update_rollups'):
+            rollup_ingested(device_id, [reading], result.get('time_to_ready'))
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Telemetry processed successfully',
-                'device_id': device_id,
-                'temperature': float(temperature),
-                'target_temp': float(target_temp),
-                'status': status
+                **result
             })
         }
         
@@ -98,57 +194,853 @@ def lambda_handler(event, context):
         }
 
 
+def parse_reading(payload: dict) -> dict:
+    """Validate a raw telemetry message and normalize its fields"""
+    device_id = payload.get('device_id')
+    if not device_id:
+        raise ValueError("device_id is required")
+    
+    return {
+        'device_id': device_id,
+        'temperature': Decimal(str(payload.get('temperature', 0))),
+        'status': payload.get('status', 'unknown'),
+        'timestamp': payload.get('timestamp', datetime.utcnow().isoformat())
+    }
+
+
+def process_reading(device_id: str, temperature: Decimal, status: str, timestamp: str = None,
+                    rearm_temp: Decimal = None) -> dict:
+    """Apply one reading to the device state. Returns None if the device is unknown."""
+    # Update device status - one write that also returns the device config
+    # (target_temp, user_id, name, active session pointer) and any ready transition
+    with tracer.stage('update_device_status'):
+        device, water_ready = update_device_status(device_id, status, temperature, timestamp, rearm_temp)
+    if not device:
+        print(f"Device {device_id} not found in database")
+        return None
+    
+    target_temp = Decimal(str(device.get('target_temp', 38)))
+    user_id = device.get('user_id')
+    
+    # Water is ready - only the invocation that won the heating -> ready edge gets here
+    time_to_ready = None
+    if water_ready:
+        with tracer.stage('handle_water_ready'):
+            if not handle_water_ready(device_id, user_id, device):
+                # Reported as a failed reading (500 / logged in batch mode); the device
+                # keeps heating, so its next reading at the target retries the valve
+                raise RuntimeError(f"Failed to open the valve on device {device_id}")
+        if device.get('active_session_start') and timestamp:
+            time_to_ready = reading_epoch(timestamp) - reading_epoch(device['active_session_start'])
+    
+    # Calculate water saved in current session
+    if status == 'heating' and device.get('active_session_id'):
+        with tracer.stage('update_session_savings'):
+            update_session_savings(
+                device['active_session_id'], device.get('active_session_start'), user_id
+            )
+    
+    result = {
+        'device_id': device_id,
+        'temperature': float(temperature),
+        'target_temp': float(target_temp),
+        'status': status
+    }
+    if time_to_ready is not None and time_to_ready >= 0:
+        result['time_to_ready'] = time_to_ready
+    return result
+
+
+# ============= BATCH MODE =============
+
+def extract_batch_records(event) -> list:
+    """
+    Flatten a batched event into (record_id, payload) pairs.
+    
+    Supports a plain list of readings (IoT rule batching), SQS records
+    (JSON "body") and Kinesis records (base64 "kinesis.data"). The record_id
+    is what Lambda expects back in batchItemFailures.
+    """
+    if isinstance(event, list):
+        return [(str(index), message) for index, message in enumerate(event)]
+    
+    records = []
+    for index, record in enumerate(event.get('Records', [])):
+        if 'kinesis' in record:
+            record_id = record['kinesis'].get('sequenceNumber', str(index))
+            raw = base64.b64decode(record['kinesis']['data'])
+        elif 'body' in record:
+            record_id = record.get('messageId', str(index))
+            raw = record['body']
+        else:
+            record_id = str(index)
+            raw = record
+        
+        try:
+            payload = json.loads(raw) if isinstance(raw, (str, bytes)) else raw
+        except json.JSONDecodeError:
+            payload = None
+        records.append((record_id, payload))
+    return records
+
+
+def process_batch(event) -> dict:
+    """
+    Handle a batch of readings.
+    
+    Telemetry rows are written with BatchWriteItem; device state, water ready
+    and savings logic run once per device using that device's latest reading.
+    Readings that could not be stored are reported per record so SQS/Kinesis
+    only redeliver those. A device state failure is not redelivered - its
+    readings are stored, and the device's next reading re-applies the state.
+    """
+    records = extract_batch_records(event)
+    print(f"Received batch of {len(records)} readings")
+    tracer.add_readings(len(records))
+    
+    failed_ids = set()
+    readings_by_device = {}
+    
+    for record_id, payload in records:
+        try:
+            if not isinstance(payload, dict):
+                raise ValueError("Reading is not a JSON object")
+            reading = parse_reading(payload)
+        except (ValueError, ArithmeticError) as e:
+            # Malformed readings will never succeed - drop instead of retrying
+            print(f"Skipping malformed reading {record_id}: {e}")
+            continue
+        reading['record_id'] = record_id
+        readings_by_device.setdefault(reading['device_id'], []).append(reading)
+    
+    # 1. Store telemetry data (every reading, or only changes in on_change mode)
+    all_readings = []
+    for readings in readings_by_device.values():
+        readings.sort(key=lambda r: r['timestamp'])
+        all_readings.extend(readings)
+    with tracer.stage('store_telemetry'):
+        failed_ids.update(store_telemetry_batch([r for r in all_readings if should_store_reading(r)]))
+    
+    # 2. Apply each device's latest reading once, then roll up all of its readings
+    processed = 0
+    for device_id, readings in readings_by_device.items():
+        latest = readings[-1]
+        heating = [r['temperature'] for r in readings if r['status'] == 'heating']
+        try:
+            result = process_reading(device_id, latest['temperature'], latest['status'], latest['timestamp'],
+                                     min(heating, default=None))
+        except Exception as e:
+            print(f"Error processing device {device_id}: {str(e)}")
+            result = {}
+        if result is None:
+            continue
+        if result:
+            processed += 1
+        # Readings that failed to store are rolled up when they are redelivered;
+        # the rest are rolled up even when the device state failed
+        stored = [r for r in readings if r['record_id'] not in failed_ids]
+        if stored:
+            with tracer.stage('update_rollups'):
+                rollup_ingested(device_id, stored, result.get('time_to_ready'))
+    
+    print(f"Batch done: {len(all_readings)} readings, {processed} devices, {len(failed_ids)} failed")
+    return {
+        'batchItemFailures': [{'itemIdentifier': record_id} for record_id in sorted(failed_ids)]
+    }
+
+
+def store_telemetry_batch(readings: list) -> set:
+    """Store many readings with BatchWriteItem. Returns record_ids that could not be written."""
+    if TELEMETRY_STORAGE_MODE == 'chunked':
+        return store_telemetry_chunks(readings)
+    
+    # A single BatchWriteItem request may not contain the same key twice
+    by_key = {}
+    for reading in readings:
+        by_key.setdefault((reading['device_id'], reading['timestamp']), []).append(reading)
+    
+    keys = list(by_key.keys())
+    failed_ids = set()
+    
+    for i in range(0, len(keys), BATCH_WRITE_SIZE):
+        chunk = keys[i:i + BATCH_WRITE_SIZE]
+        request_items = {
+            TELEMETRY_TABLE: [
+                {'PutRequest': {'Item': telemetry_item(
+                    device_id,
+                    by_key[(device_id, timestamp)][-1]['temperature'],
+                    by_key[(device_id, timestamp)][-1]['status'],
+                    timestamp
+                )}}
+                for device_id, timestamp in chunk
+            ]
+        }
+        
+        try:
+            unprocessed = write_batch_with_retry(request_items)
+        except Exception as e:
+            print(f"Error writing telemetry batch: {str(e)}")
+            unprocessed = request_items
+        
+        for request in unprocessed.get(TELEMETRY_TABLE, []):
+            item = request['PutRequest']['Item']
+            failed_ids.update(r['record_id'] for r in by_key[(item['device_id'], item['timestamp'])])
+    
+    print(f"Stored {len(keys)} telemetry readings")
+    return failed_ids
+
+
+def write_batch_with_retry(request_items: dict) -> dict:
+    """BatchWriteItem with exponential backoff on UnprocessedItems. Returns what is left."""
+    for attempt in range(BATCH_WRITE_MAX_RETRIES + 1):
+        response = dynamodb.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems') or {}
+        if not request_items:
+            return {}
+        if attempt < BATCH_WRITE_MAX_RETRIES:
+            time.sleep(BATCH_WRITE_BACKOFF_SECONDS * (2 ** attempt))
+    return request_items
+
+
+def telemetry_item(device_id: str, temperature: Decimal, status: str, timestamp: str) -> dict:
+    """Build a raw Telemetry item, with a TTL when a retention period is configured"""
+    item = {
+        'device_id': device_id,
+        'timestamp': timestamp,
+        'temperature': temperature,
+        'status': status
+    }
+    if TELEMETRY_RETENTION_DAYS > 0:
+        item[TTL_ATTRIBUTE] = int(reading_epoch(timestamp)) + TELEMETRY_RETENTION_DAYS * 86400
+    return item
+
+
 def store_telemetry(device_id: str, temperature: Decimal, status: str, timestamp: str):
     """Store telemetry data in DynamoDB"""
     telemetry_table.put_item(
-        Item={
-            'device_id': device_id,
-            'timestamp': timestamp,
-            'temperature': temperature,
-            'status': status
-        }
+        Item=telemetry_item(device_id, temperature, status, timestamp)
     )
     print(f"Stored telemetry for device {device_id}: {temperature}°C")
 
 
-def get_device(device_id: str) -> dict:
-    """Get device configuration from DynamoDB"""
-    response = devices_table.get_item(
-        Key={'device_id': device_id}
-    )
-    return response.get('Item')
+def chunk_start(timestamp: str) -> str:
+    """Start of the chunk window a reading belongs to"""
+    epoch = int(reading_epoch(timestamp))
+    window = epoch - epoch % TELEMETRY_CHUNK_SECONDS
+    return datetime.fromtimestamp(window, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
 
 
-def update_device_status(device_id: str, status: str, temperature: Decimal):
-    """Update device's current status and temperature"""
-    devices_table.update_item(
-        Key={'device_id': device_id},
-        UpdateExpression='SET #status = :status, current_temp = :temp, last_seen = :ts',
-        ExpressionAttributeNames={'#status': 'status'},
-        ExpressionAttributeValues={
-            ':status': status,
-            ':temp': temperature,
-            ':ts': datetime.utcnow().isoformat()
+def store_telemetry_chunks(readings: list) -> set:
+    """
+    Append readings to per-device, per-window chunk items - one UpdateItem per chunk
+    holding a delta-encoded segment. Returns record_ids that could not be written.
+    """
+    chunks = {}
+    for reading in readings:
+        key = (reading['device_id'], chunk_start(reading['timestamp']))
+        chunks.setdefault(key, []).append(reading)
+    
+    failed_ids = set()
+    for (device_id, start), chunk_readings in chunks.items():
+        try:
+            append_chunk_segment(device_id, start, chunk_readings)
+        except RuntimeError as e:
+            print(f"Error storing telemetry chunk {device_id}/{start}: {str(e)}")
+            failed_ids.update(r['record_id'] for r in chunk_readings)
+        except ClientError as e:
+            error = e.response['Error']
+            if error['Code'] != 'ValidationException' or 'size' not in error.get('Message', '').lower():
+                print(f"Error storing telemetry chunk {device_id}/{start}: {str(e)}")
+                failed_ids.update(r['record_id'] for r in chunk_readings)
+                continue
+            # Chunk hit the item size limit - keep the readings as plain items instead
+            print(f"Chunk {device_id}/{start} is full, storing readings as items")
+            for reading in chunk_readings:
+                try:
+                    store_telemetry(device_id, reading['temperature'], reading['status'], reading['timestamp'])
+                except Exception as item_error:
+                    print(f"Error storing telemetry item: {str(item_error)}")
+                    failed_ids.add(reading['record_id'])
+    
+    print(f"Stored {len(readings)} telemetry readings in {len(chunks)} chunks")
+    return failed_ids
+
+
+def append_chunk_segment(device_id: str, start: str, readings: list):
+    """
+    Append readings (sorted by timestamp) to one chunk as a new segment.
+    
+    The append only goes through when every reading is newer than the chunk's
+    last_ts, so a redelivered batch does not store its readings twice. Otherwise
+    the chunk is read back and only the readings it does not hold yet are
+    appended, guarded by its segment count.
+    """
+    key = {'device_id': device_id, 'chunk_start': start}
+    condition = 'attribute_not_exists(last_ts) OR last_ts < :first'
+    first_expr = 'if_not_exists(first_ts, :first)'
+    first_ts, last_ts = readings[0]['timestamp'], readings[-1]['timestamp']
+    seen = None
+    
+    for _ in range(CHUNK_APPEND_ATTEMPTS):
+        values = {
+            ':segment': [encode_readings(readings)],
+            ':empty': [],
+            ':first': first_ts,
+            ':last': last_ts,
+            ':n': len(readings)
         }
-    )
+        update_expr = ('SET #segments = list_append(if_not_exists(#segments, :empty), :segment), '
+                       f'first_ts = {first_expr}, last_ts = :last')
+        if seen is not None:
+            values[':seen'] = seen
+        if TELEMETRY_RETENTION_DAYS > 0:
+            update_expr += f", {TTL_ATTRIBUTE} = :exp"
+            values[':exp'] = int(reading_epoch(start)) + TELEMETRY_CHUNK_SECONDS + TELEMETRY_RETENTION_DAYS * 86400
+        
+        try:
+            chunks_table.update_item(
+                Key=key,
+                UpdateExpression=update_expr + ' ADD reading_count :n',
+                ConditionExpression=condition,
+                ExpressionAttributeNames={'#segments': 'segments'},
+                ExpressionAttributeValues=values
+            )
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        
+        # Older readings than the chunk's last_ts: a redelivery or a late reading
+        item = chunks_table.get_item(Key=key, ConsistentRead=True).get('Item') or {}
+        held = {to_epoch_ms(r['timestamp']) for r in decode_chunk(item)}
+        readings = [r for r in readings if to_epoch_ms(r['timestamp']) not in held]
+        if not readings:
+            print(f"Chunk {device_id}/{start} already holds these readings")
+            return
+        bounds = [readings[0]['timestamp'], readings[-1]['timestamp']]
+        bounds += [item[name] for name in ('first_ts', 'last_ts') if name in item]
+        first_ts = min(bounds, key=to_epoch_ms)
+        last_ts = max(bounds, key=to_epoch_ms)
+        first_expr = ':first'
+        seen = len(item.get('segments', []))
+        condition = 'attribute_not_exists(#segments) OR size(#segments) = :seen'
+    
+    raise RuntimeError(f"Chunk {device_id}/{start} kept changing while appending")
+
+
+# ============= ROLLUPS =============
+
+def rollup_ingested(device_id: str, readings: list, time_to_ready: float = None):
+    """Rollup work for readings the ingest path just applied, per ROLLUPS_MODE"""
+    if ROLLUPS_MODE == 'inline':
+        update_rollups(device_id, readings, time_to_ready)
+    elif ROLLUPS_MODE == 'stream' and time_to_ready is not None:
+        # The stream carries readings, not ready transitions - those are counted here
+        record_time_to_ready(device_id, readings[-1]['timestamp'], time_to_ready)
+
+
+def record_time_to_ready(device_id: str, timestamp: str, time_to_ready: float):
+    """Count one ready transition in the minute and hour buckets of its reading (once per shower)"""
+    moment = datetime.fromtimestamp(reading_epoch(timestamp), tz=timezone.utc)
+    for resolution, (bucket_format, retention_days) in ROLLUP_RESOLUTIONS.items():
+        bucket = f"{resolution}#{moment.strftime(bucket_format)}"
+        update_expr = 'ADD ready_count :one, time_to_ready_sum :ttr'
+        values = {':one': 1, ':ttr': Decimal(str(round(time_to_ready, 3)))}
+        if retention_days > 0:
+            update_expr += f" SET {TTL_ATTRIBUTE} = :exp"
+            values[':exp'] = int(moment.timestamp()) + retention_days * 86400
+        try:
+            rollups_table.update_item(
+                Key={'device_id': device_id, 'bucket': bucket},
+                UpdateExpression=update_expr,
+                ExpressionAttributeValues=values
+            )
+        except Exception as e:
+            print(f"Error recording time to ready in {bucket} for device {device_id}: {str(e)}")
+
+
+def update_rollups(device_id: str, readings: list, time_to_ready: float = None):
+    """
+    Fold readings (sorted by timestamp) into the device's minute and hour rollups.
+    
+    Each bucket holds min/max temperature, reading count and temperature sum
+    (mean = temp_sum / reading_count), seconds spent heating, and the number of
+    ready transitions with their summed time to ready. Rollup failures are
+    logged and never fail the reading.
+    """
+    if ROLLUPS_MODE == 'off' or not readings:
+        return
+    
+    # Aggregate in memory first - one write per bucket per invocation
+    buckets = {}
+    previous = last_rollup_reading.get(device_id)
+    for reading in readings:
+        epoch = reading_epoch(reading['timestamp'])
+        moment = datetime.fromtimestamp(epoch, tz=timezone.utc)
+        
+        heating_seconds = 0
+        if previous and previous['status'] == 'heating':
+            gap = epoch - previous['epoch']
+            if 0 < gap <= ROLLUP_MAX_GAP_SECONDS:
+                heating_seconds = gap
+        previous = {'epoch': epoch, 'status': reading['status']}
+        
+        for resolution, (bucket_format, retention_days) in ROLLUP_RESOLUTIONS.items():
+            bucket = f"{resolution}#{moment.strftime(bucket_format)}"
+            agg = buckets.get(bucket)
+            if agg is None:
+                agg = buckets[bucket] = {
+                    'count': 0, 'sum': Decimal('0'), 'heating': Decimal('0'),
+                    'min': reading['temperature'], 'max': reading['temperature'],
+                    'first': reading['timestamp'], 'epoch': epoch,
+                    'retention_days': retention_days
+                }
+            agg['count'] += 1
+            agg['sum'] += reading['temperature']
+            agg['heating'] += Decimal(str(round(heating_seconds, 3)))
+            agg['min'] = min(agg['min'], reading['temperature'])
+            agg['max'] = max(agg['max'], reading['temperature'])
+            agg['last'] = reading['timestamp']
+    last_rollup_reading.set(device_id, previous)
+    
+    # Time to ready belongs to the buckets of the reading that completed heating
+    if time_to_ready is not None:
+        for bucket, agg in buckets.items():
+            if agg['last'] == readings[-1]['timestamp']:
+                agg['time_to_ready'] = Decimal(str(round(time_to_ready, 3)))
+    
+    for bucket, agg in buckets.items():
+        try:
+            write_rollup(device_id, bucket, agg)
+        except Exception as e:
+            print(f"Error updating rollup {bucket} for device {device_id}: {str(e)}")
+
+
+def write_rollup(device_id: str, bucket: str, agg: dict):
+    """
+    Apply one bucket's partial aggregate with a single UpdateItem.
+    
+    Counters use ADD. min/max cannot be expressed as an update, so they are SET
+    under a condition, predicted from the extremes this container last saw; if
+    another writer got there first the counters are applied alone and the
+    extremes are fixed up separately.
+    """
+    key = {'device_id': device_id, 'bucket': bucket}
+    known = rollup_extremes_cache.get((device_id, bucket))
+    
+    set_parts = ['first_ts = if_not_exists(first_ts, :first)', 'last_ts = :last']
+    add_parts = ['reading_count :n', 'temp_sum :sum', 'heating_seconds :heat']
+    values = {
+        ':first': agg['first'], ':last': agg['last'],
+        ':n': agg['count'], ':sum': agg['sum'], ':heat': agg['heating']
+    }
+    if agg['retention_days'] > 0:
+        set_parts.append(f"{TTL_ATTRIBUTE} = :exp")
+        values[':exp'] = int(agg['epoch']) + agg['retention_days'] * 86400
+    if 'time_to_ready' in agg:
+        add_parts += ['ready_count :one', 'time_to_ready_sum :ttr']
+        values[':one'] = 1
+        values[':ttr'] = agg['time_to_ready']
+    
+    conditions = []
+    extremes = {}
+    if known is None or agg['min'] < known['min']:
+        set_parts.append('min_temp = :min')
+        conditions.append('(attribute_not_exists(min_temp) OR min_temp > :min)')
+        extremes[':min'] = agg['min']
+    if known is None or agg['max'] > known['max']:
+        set_parts.append('max_temp = :max')
+        conditions.append('(attribute_not_exists(max_temp) OR max_temp < :max)')
+        extremes[':max'] = agg['max']
+    
+    update_kwargs = {
+        'Key': key,
+        'UpdateExpression': f"SET {', '.join(set_parts)} ADD {', '.join(add_parts)}",
+        'ExpressionAttributeValues': {**values, **extremes},
+        'ReturnValues': 'ALL_NEW'
+    }
+    if conditions:
+        update_kwargs['ConditionExpression'] = ' AND '.join(conditions)
+    
+    try:
+        item = rollups_table.update_item(**update_kwargs)['Attributes']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # Counters first, then move each extreme only if it is still an improvement
+        base_set = [part for part in set_parts if not part.startswith(('min_temp', 'max_temp'))]
+        item = rollups_table.update_item(
+            Key=key,
+            UpdateExpression=f"SET {', '.join(base_set)} ADD {', '.join(add_parts)}",
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW'
+        )['Attributes']
+        for attr, placeholder, comparator in (('min_temp', ':min', '>'), ('max_temp', ':max', '<')):
+            if placeholder not in extremes:
+                continue
+            try:
+                item = rollups_table.update_item(
+                    Key=key,
+                    UpdateExpression=f"SET {attr} = {placeholder}",
+                    ConditionExpression=f"attribute_not_exists({attr}) OR {attr} {comparator} {placeholder}",
+                    ExpressionAttributeValues={placeholder: extremes[placeholder]},
+                    ReturnValues='ALL_NEW'
+                )['Attributes']
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+    
+    rollup_extremes_cache.set((device_id, bucket), {
+        'min': item.get('min_temp', agg['min']),
+        'max': item.get('max_temp', agg['max'])
+    })
+
+
+# ============= ROLLUP STREAM =============
+
+_deserializer = TypeDeserializer()
+
 
+def stream_image(record: dict, name: str) -> dict:
+    """Deserialized OldImage/NewImage of a DynamoDB stream record (None when absent)"""
+    raw = record.get('dynamodb', {}).get(name)
+    if raw is None:
+        return None
+    return {key: _deserializer.deserialize(value) for key, value in raw.items()}
 
-def handle_water_ready(device_id: str, user_id: str, device: dict):
-    """Handle when water reaches target temperature"""
+
+def stream_readings(record: dict) -> list:
+    """
+    Readings a Telemetry or TelemetryChunks stream record added.
+
+    Telemetry INSERTs carry one reading; a chunk write carries the segments its
+    NewImage has beyond its OldImage. Re-writes of an existing reading (MODIFY)
+    and TTL deletes (REMOVE) add nothing.
+    """
+    table_name = record.get('eventSourceARN', '').split(':table/')[-1].split('/')[0]
+    new = stream_image(record, 'NewImage')
+    if new is None:
+        return []
+
+    if table_name == TELEMETRY_TABLE:
+        if record.get('eventName') != 'INSERT':
+            return []
+        return [{
+            'device_id': new['device_id'],
+            'timestamp': new['timestamp'],
+            'temperature': new['temperature'],
+            'status': new['status']
+        }]
+
+    if table_name == TELEMETRY_CHUNKS_TABLE:
+        old = stream_image(record, 'OldImage') or {}
+        readings = []
+        for segment in new.get('segments', [])[len(old.get('segments', [])):]:
+            for reading in decode_readings(getattr(segment, 'value', segment)):
+                reading['device_id'] = new['device_id']
+                readings.append(reading)
+        return readings
+
+    print(f"Ignoring record from {record.get('eventSourceARN')}")
+    return []
+
+
+def rollup_handler(event, context):
+    """
+    Build minute/hour rollups from a batch of Telemetry/TelemetryChunks stream records.
+
+    Deployed as its own function (EcoShower-TelemetryRollups) on the tables'
+    streams, so the ingest path writes no rollups. Rollup write failures are
+    logged by update_rollups and never fail the batch - a retried batch would
+    ADD its counters twice.
+    """
+    # Readings were already counted by the ingest function - project_cost only
+    # adds this function's capacity
+    tracer.begin('telemetry_rollups', source='stream')
+    try:
+        by_device = {}
+        records = event.get('Records', [])
+        with tracer.stage('decode'):
+            for record in records:
+                for reading in stream_readings(record):
+                    by_device.setdefault(reading['device_id'], []).append(reading)
+
+        if ROLLUPS_MODE != 'stream':
+            return {'records': len(records), 'devices': 0}
+
+        with tracer.stage('update_rollups'):
+            for device_id, readings in by_device.items():
+                readings.sort(key=lambda r: reading_epoch(r['timestamp']))
+                tracer.add_readings(len(readings))
+                update_rollups(device_id, readings)
+
+        print(f"Rolled up {sum(len(r) for r in by_device.values())} readings "
+              f"from {len(records)} stream records for {len(by_device)} devices")
+        return {'records': len(records), 'devices': len(by_device)}
+    finally:
+        tracer.end()
+
+
+def is_significant_change(last: dict, status: str, temperature: Decimal) -> bool:
+    """True when status changed or temperature moved more than the deadband"""
+    if last['status'] != status:
+        return True
+    return abs(temperature - last['temperature']) * 10 > STATUS_TEMP_DEADBAND_TENTHS
+
+
+def reading_epoch(timestamp: str) -> float:
+    """Seconds since epoch for a reading timestamp (now, if it cannot be parsed)"""
+    try:
+        parsed = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+    except ValueError:
+        return time.time()
+
+
+def should_store_reading(reading: dict) -> bool:
+    """Store-on-change policy for raw telemetry. Always True in 'all' mode."""
+    if TELEMETRY_STORE_MODE != 'on_change':
+        return True
+    
+    device_id = reading['device_id']
+    epoch = reading_epoch(reading['timestamp'])
+    last = stored_reading_cache.get(device_id)
+    if (last is not None
+            and not is_significant_change(last, reading['status'], reading['temperature'])
+            and 0 <= epoch - last['epoch'] < HEARTBEAT_SECONDS):
+        return False
+    
+    stored_reading_cache.set(device_id, {
+        'status': reading['status'],
+        'temperature': reading['temperature'],
+        'epoch': epoch
+    })
+    return True
+
+
+def get_user(user_id: str) -> dict:
+    """Get user settings - water price, units, language, SNS topic, alerts (cached)"""
+    if not user_id:
+        return {}
+    user = user_cache.get(user_id)
+    if user is None:
+        response = users_table.get_item(Key={'user_id': user_id})
+        user = response.get('Item')
+        if user:
+            user_cache.set(user_id, user)
+    return user or {}
+
+
+def invalidate_device(device_id: str):
+    """Forget the last written device state so the next reading writes (and re-reads) it"""
+    written_state_cache.invalidate(device_id)
+
+
+def invalidate_user(user_id: str):
+    """Drop cached user settings so the next lookup re-reads them"""
+    user_cache.invalidate(user_id)
+
+
+def is_ready(device: dict, status: str, temperature: Decimal) -> bool:
+    """True when a heating reading reaches the target of a device that is not ready yet"""
+    return (status == 'heating' and device.get('status') != 'ready'
+            and temperature >= Decimal(str(device.get('target_temp', 38))))
+
+
+def target_condition(placeholder: str, temperature: Decimal, comparator: str) -> str:
+    """Condition comparing target_temp with a temperature; items without one use the default of 38"""
+    condition = f"target_temp {comparator} {placeholder}"
+    default_holds = temperature >= 38 if comparator == '<=' else temperature < 38
+    if default_holds:
+        condition = f"({condition} OR attribute_not_exists(target_temp))"
+    return condition
+
+
+def update_device_status(device_id: str, status: str, temperature: Decimal,
+                         timestamp: str = None, rearm_temp: Decimal = None) -> tuple:
+    """
+    Update device's current status and temperature with a single UpdateItem.
+    
+    Returns (device, water_ready): the device item as of the last write
+    (ReturnValues=ALL_NEW, so no separate GetItem is needed) or None if the
+    device does not exist, and whether this call won the heating -> ready edge.
+    Writes are coalesced (deadband + heartbeat) based on the last written state.
+    rearm_temp is the lowest heating temperature behind this reading (a batch
+    applies only its latest reading); it defaults to the reading itself.
+    """
+    now = time.monotonic()
+    last = written_state_cache.get(device_id)
+    ts = datetime.utcnow().isoformat()
+    rearm_limit = (temperature if rearm_temp is None else min(rearm_temp, temperature)) + READY_REARM_DEGREES
+    
+    # Out-of-order reading - the device has already moved past it
+    if last is not None and timestamp and last.get('timestamp') and timestamp < last['timestamp']:
+        return last['item'], False
+    
+    # Ready edge predicted from the last known item - fold it into this reading's write
+    if last is not None and is_ready(last['item'], status, temperature):
+        device = write_ready_transition(device_id, temperature, ts)
+        if device:
+            written_state_cache.set(device_id, {
+                'status': status, 'temperature': temperature,
+                'written_at': now, 'timestamp': timestamp, 'item': device
+            })
+            return device, True
+    
+    # A heating reading well below the target starts a new cycle on a 'ready' device
+    rearms = (status == 'heating' and last is not None and last['item'].get('status') == 'ready'
+              and rearm_limit < Decimal(str(last['item'].get('target_temp', 38))))
+    
+    if last is None or rearms or is_significant_change(last, status, temperature):
+        update_expr = 'SET #status = :status, current_temp = :temp, last_seen = :ts'
+        expr_names = {'#status': 'status'}
+        expr_values = {':status': status, ':temp': temperature}
+        written = {'status': status, 'temperature': temperature}
+    elif now - last['written_at'] >= HEARTBEAT_SECONDS:
+        # Heartbeat - nothing meaningful changed, just show the device is alive
+        update_expr = 'SET last_seen = :ts'
+        expr_names = {}
+        expr_values = {}
+        written = {'status': last['status'], 'temperature': last['temperature']}
+    else:
+        return last['item'], False
+    
+    # The device keeps reporting 'heating' after the water is ready; that must not
+    # re-arm the heating -> ready edge. 'heating' overwrites 'ready' only well below
+    # the target, which is the start of a new heating cycle (START_HEATING never touches
+    # the stored status, so a device sits in 'ready' between showers).
+    condition = 'attribute_exists(device_id)'
+    if status == 'heating' and expr_names:
+        if last is not None and last['item'].get('status') == 'ready' and not rearms:
+            update_expr = 'SET current_temp = :temp, last_seen = :ts'
+            expr_names = {}
+            del expr_values[':status']
+        else:
+            condition += (' AND (attribute_not_exists(#status) OR #status <> :ready OR '
+                          f"{target_condition(':rearm', rearm_limit, '>')})")
+            expr_values[':ready'] = 'ready'
+            expr_values[':rearm'] = rearm_limit
+    
+    expr_values[':ts'] = ts
+    update_kwargs = {
+        'Key': {'device_id': device_id},
+        'UpdateExpression': update_expr,
+        'ConditionExpression': condition,
+        'ExpressionAttributeValues': expr_values,
+        'ReturnValues': 'ALL_NEW'
+    }
+    if expr_names:
+        update_kwargs['ExpressionAttributeNames'] = expr_names
+    
+    try:
+        response = devices_table.update_item(**update_kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        if ':ready' not in expr_values:
+            invalidate_device(device_id)
+            return None, False
+        # Already ready at this temperature (possibly set by another container) - keep the status as is
+        try:
+            response = devices_table.update_item(
+                Key={'device_id': device_id},
+                UpdateExpression='SET current_temp = :temp, last_seen = :ts',
+                ConditionExpression='attribute_exists(device_id)',
+                ExpressionAttributeValues={':temp': temperature, ':ts': ts},
+                ReturnValues='ALL_NEW'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            invalidate_device(device_id)
+            return None, False
+    device = response.get('Attributes', {})
+    
+    # Edge not predicted (cold container, or target changed) - claim it now
+    water_ready = False
+    if is_ready(device, status, temperature):
+        ready_device = write_ready_transition(device_id, temperature, ts)
+        if ready_device:
+            device, water_ready = ready_device, True
+    
+    written_state_cache.set(device_id, {
+        **written, 'written_at': now, 'timestamp': timestamp, 'item': device
+    })
+    return device, water_ready
+
+
+def write_ready_transition(device_id: str, temperature: Decimal, ts: str) -> dict:
+    """
+    Atomically move the device to ready together with a heating reading at its target.
+    Returns the updated item only for the single invocation that wins the transition.
+    """
+    try:
+        response = devices_table.update_item(
+            Key={'device_id': device_id},
+            UpdateExpression='SET #status = :ready, ready_at = :ts, current_temp = :temp, last_seen = :ts',
+            ConditionExpression=('attribute_exists(device_id) AND '
+                                 '(attribute_not_exists(#status) OR #status <> :ready) AND '
+                                 f"{target_condition(':temp', temperature, '<=')}"),
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':ready': 'ready',
+                ':temp': temperature,
+                ':ts': ts
+            },
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
+    return response.get('Attributes')
+
+
+def revert_ready_transition(device_id: str, ready_at: str):
+    """
+    Undo a ready transition whose valve command failed, so the next heating
+    reading at the target claims the edge (and retries the valve) again.
+    """
+    invalidate_device(device_id)
+    try:
+        devices_table.update_item(
+            Key={'device_id': device_id},
+            UpdateExpression='SET #status = :heating REMOVE ready_at',
+            ConditionExpression='#status = :ready AND ready_at = :ready_at',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':heating': 'heating', ':ready': 'ready', ':ready_at': ready_at}
+        )
+    except ClientError as e:
+        # Moved on meanwhile (stopped, or a newer transition) - nothing to undo
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def handle_water_ready(device_id: str, user_id: str, device: dict) -> bool:
+    """
+    Handle when water reaches target temperature.
+    The caller has already moved the device to 'ready' (see write_ready_transition).
+    Returns False, with the transition rolled back, if the valve could not be opened.
+    """
     print(f"Water ready for device {device_id}!")
     
-    # 1. Send command to open valve
-    send_device_command(device_id, 'OPEN_VALVE')
+    # 1. Send command to open valve - inline, it has priority over the notification
+    if not timed_dispatch('command', send_device_command, device_id, 'OPEN_VALVE'):
+        revert_ready_transition(device_id, device.get('ready_at'))
+        return False
     
-    # 2. Update device status
-    devices_table.update_item(
-        Key={'device_id': device_id},
-        UpdateExpression='SET #status = :status',
-        ExpressionAttributeNames={'#status': 'status'},
-        ExpressionAttributeValues={':status': 'ready'}
-    )
+    # 2. Send push notification - in the background, flushed before the handler returns
+    dispatch_async('notification', notify_water_ready, device_id, user_id, device)
     
-    # 3. Send push notification
+    # 3. Finalize session - REMOVED to allow manual stop
+    # finalize_session(device_id)
+    return True
+
+
+def notify_water_ready(device_id: str, user_id: str, device: dict) -> bool:
+    """Build the water-ready message in the user's language and unit, then send it"""
     target_temp = device.get('target_temp', 38)
     
     # Check user preference for temperature unit
@@ -156,8 +1048,7 @@ def handle_water_ready(device_id: str, user_id: str, device: dict):
     unit_display = "°C"
     
     try:
-        user_res = users_table.get_item(Key={'user_id': user_id})
-        user = user_res.get('Item', {})
+        user = get_user(user_id)
         system = user.get('system', {})
         
         # Check both snake_case and camelCase
@@ -191,20 +1082,17 @@ def handle_water_ready(device_id: str, user_id: str, device: dict):
         message_text = f'המים מוכנים! ({target_temp}°C)'
         title_text = '💧 המים מוכנים!'
 
-    send_notification(
+    return send_notification(
         user_id=user_id,
         title=title_text,
         message=message_text,
         notification_type='WATER_READY',
         device_id=device_id
     )
-    
-    # 4. Finalize session - REMOVED to allow manual stop
-    # finalize_session(device_id)
 
 
-def send_device_command(device_id: str, command: str):
-    """Send command to device via IoT Core"""
+def send_device_command(device_id: str, command: str) -> bool:
+    """Send command to device via IoT Core. Returns True if published, raises on failure."""
     topic = f'ecoshower/{device_id}/commands'
     payload = {
         'command': command,
@@ -218,34 +1106,35 @@ def send_device_command(device_id: str, command: str):
             payload=json.dumps(payload)
         )
         print(f"Sent command {command} to device {device_id}")
+        return True
     except Exception as e:
         print(f"Error sending command: {str(e)}")
+        raise
 
 
 def send_notification(user_id: str, title: str, message: str, 
-                      notification_type: str, device_id: str):
-    """Send push notification via SNS (Private Topic)"""
+                      notification_type: str, device_id: str) -> bool:
+    """Send push notification via SNS (Private Topic). Returns False if skipped, raises on failure."""
     try:
         # Get user profile to find their private topic and settings
-        user_res = users_table.get_item(Key={'user_id': user_id})
-        user = user_res.get('Item')
+        user = get_user(user_id)
         
         if not user:
             print(f"User {user_id} not found, cannot send notification")
-            return
+            return False
 
         topic_arn = user.get('sns_topic_arn')
         
         if not topic_arn:
             # Fallback to global if configured, or just log
             print(f"No private SNS topic for user {user_id}")
-            return
+            return False
 
         # Check user settings
         settings = user.get('notifications', {})
         if notification_type == 'WATER_READY' and not settings.get('water_ready_alert', True):
             print(f"User {user_id} has disabled water ready alerts. Skipping.")
-            return
+            return False
 
         if notification_type == 'WATER_READY':
             # Logic moved to handle_water_ready for better control
@@ -276,90 +1165,170 @@ def send_notification(user_id: str, title: str, message: str,
             }
         )
         print(f"Sent notification to user {user_id} via {topic_arn}")
+        return True
+    except ClientError as e:
+        # Topic deleted or replaced since the user was cached - re-read it next time
+        if e.response['Error']['Code'] == 'NotFound':
+            invalidate_user(user_id)
+        print(f"Error sending notification: {str(e)}")
+        raise
     except Exception as e:
         print(f"Error sending notification: {str(e)}")
+        raise
 
 
-def update_session_savings(device_id: str, user_id: str = None):
-    """Update water saved in current session"""
-    # Get current active session
-    response = sessions_table.query(
-        IndexName='device-index',
-        KeyConditionExpression='device_id = :did',
-        FilterExpression='#status = :status',
-        ExpressionAttributeNames={'#status': 'status'},
-        ExpressionAttributeValues={
-            ':did': device_id,
-            ':status': 'active'
-        },
-        Limit=1,
-        ScanIndexForward=False
-    )
+# ============= DISPATCH =============
+
+_dispatch_pool = None
+_pending_dispatches = []
+_dispatch_lock = threading.Lock()
+# Per invocation: {kind: {'sent', 'skipped', 'failed', 'total_ms', 'max_ms'}} plus 'abandoned'
+dispatch_metrics = {}
+
+
+def record_dispatch(kind: str, outcome: str, elapsed_ms: float):
+    """Count one dispatch outcome ('sent', 'skipped' or 'failed') and its latency"""
+    with _dispatch_lock:
+        metrics = dispatch_metrics.setdefault(
+            kind, {'sent': 0, 'skipped': 0, 'failed': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        )
+        metrics[outcome] += 1
+        metrics['total_ms'] = round(metrics['total_ms'] + elapsed_ms, 1)
+        metrics['max_ms'] = round(max(metrics['max_ms'], elapsed_ms), 1)
+
+
+def timed_dispatch(kind: str, func, *args) -> bool:
+    """Run one send function, recording sent/skipped/failed and its latency. Never raises."""
+    started = time.monotonic()
+    try:
+        outcome = 'sent' if func(*args) else 'skipped'
+    except Exception as e:
+        print(f"Error in {kind} dispatch: {str(e)}")
+        outcome = 'failed'
+    record_dispatch(kind, outcome, (time.monotonic() - started) * 1000)
+    return outcome == 'sent'
+
+
+def dispatch_async(kind: str, func, *args):
+    """
+    Queue a send on the background pool. When DISPATCH_MAX_PENDING sends are
+    already waiting, run it inline instead so the backlog stays bounded.
+    """
+    global _dispatch_pool
+    if DISPATCH_MAX_WORKERS <= 0 or len(_pending_dispatches) >= DISPATCH_MAX_PENDING:
+        timed_dispatch(kind, func, *args)
+        return
+    if _dispatch_pool is None:
+        _dispatch_pool = ThreadPoolExecutor(
+            max_workers=DISPATCH_MAX_WORKERS, thread_name_prefix='dispatch'
+        )
+    _pending_dispatches.append(_dispatch_pool.submit(timed_dispatch, kind, func, *args))
+
+
+def flush_dispatch(context=None):
+    """
+    Wait for queued sends, bounded by DISPATCH_FLUSH_TIMEOUT_SECONDS and the time
+    left in the invocation, then log this invocation's dispatch metrics.
+    """
+    if _pending_dispatches:
+        timeout = DISPATCH_FLUSH_TIMEOUT_SECONDS
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            # Leave half a second to return the response
+            timeout = min(timeout, max(context.get_remaining_time_in_millis() / 1000 - 0.5, 0))
+        _, not_done = wait(_pending_dispatches, timeout=timeout)
+        _pending_dispatches.clear()
+        if not_done:
+            # They resume if the container is thawed again; otherwise they are lost
+            print(f"Dispatch flush timed out with {len(not_done)} sends still running")
+            with _dispatch_lock:
+                dispatch_metrics['abandoned'] = len(not_done)
     
-    if response.get('Items'):
-        session = response['Items'][0]
-        session_id = session['session_id']
-        
-        # Calculate time elapsed
-        start_time = datetime.fromisoformat(session['start_time'].replace('Z', '+00:00'))
-        now = datetime.utcnow()
-        elapsed_seconds = Decimal(str((now - start_time.replace(tzinfo=None)).total_seconds()))
-        
-        # Get user water price
-        water_price = Decimal('0.008') # Default
-        if user_id:
-            try:
-                user_res = users_table.get_item(Key={'user_id': user_id})
-                user_item = user_res.get('Item', {})
-                system_settings = user_item.get('system', {})
-                # Check snake_case then camelCase
-                price_setting = system_settings.get('water_price_per_liter') or system_settings.get('waterPricePerLiter')
-                if price_setting:
-                    water_price = Decimal(str(price_setting))
-                    print(f"DEBUG: Used custom water price: {water_price} for user {user_id}")
-            except Exception as e:
-                print(f"Error fetching water price for {user_id}: {e}")
-
-        # Calculate savings
-        water_saved = elapsed_seconds * LITERS_PER_SECOND
-        money_saved = water_saved * water_price
-        
+    with _dispatch_lock:
+        if dispatch_metrics:
+            if tracer.current is not None:
+                tracer.set_property('dispatch', dict(dispatch_metrics))
+            else:
+                print(f"Dispatch metrics: {json.dumps(dispatch_metrics)}")
+            dispatch_metrics.clear()
+
+
+def update_session_savings(session_id: str, start_time: str, user_id: str = None):
+    """Update water saved in the device's active session (from the device's session pointer)"""
+    if not start_time:
+        return
+    
+    # Calculate time elapsed
+    start = datetime.fromisoformat(start_time.replace('Z', '+00:00'))
+    now = datetime.utcnow()
+    elapsed_seconds = Decimal(str((now - start.replace(tzinfo=None)).total_seconds()))
+    
+    # Get user water price
+    water_price = Decimal('0.008') # Default
+    if user_id:
+        try:
+            user_item = get_user(user_id)
+            system_settings = user_item.get('system', {})
+            # Check snake_case then camelCase
+            price_setting = system_settings.get('water_price_per_liter') or system_settings.get('waterPricePerLiter')
+            if price_setting:
+                water_price = Decimal(str(price_setting))
+        except Exception as e:
+            print(f"Error fetching water price for {user_id}: {e}")
+
+    # Calculate savings
+    water_saved = elapsed_seconds * LITERS_PER_SECOND
+    money_saved = water_saved * water_price
+    
+    try:
         sessions_table.update_item(
             Key={'session_id': session_id},
             UpdateExpression='SET water_saved = :water, money_saved = :money',
+            ConditionExpression='#status = :active',
+            ExpressionAttributeNames={'#status': 'status'},
             ExpressionAttributeValues={
                 ':water': water_saved,
-                ':money': money_saved
+                ':money': money_saved,
+                ':active': 'active'
             }
         )
+    except ClientError as e:
+        # Session was stopped meanwhile - never overwrite its final totals
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
 
 
 def finalize_session(device_id: str):
-    """Finalize the current session"""
-    response = sessions_table.query(
-        IndexName='device-index',
-        KeyConditionExpression='device_id = :did',
-        FilterExpression='#status = :status',
-        ExpressionAttributeNames={'#status': 'status'},
-        ExpressionAttributeValues={
-            ':did': device_id,
-            ':status': 'active'
-        },
-        Limit=1,
-        ScanIndexForward=False
-    )
+    """Finalize the current session and clear the device's active session pointer"""
+    device = devices_table.get_item(
+        Key={'device_id': device_id},
+        ProjectionExpression='active_session_id',
+        ConsistentRead=True
+    ).get('Item') or {}
+    session_id = device.get('active_session_id')
+    if not session_id:
+        return
     
-    if response.get('Items'):
-        session = response['Items'][0]
-        session_id = session['session_id']
-        
+    try:
         sessions_table.update_item(
             Key={'session_id': session_id},
             UpdateExpression='SET #status = :status, end_time = :end',
+            ConditionExpression='#status = :active',
             ExpressionAttributeNames={'#status': 'status'},
             ExpressionAttributeValues={
                 ':status': 'completed',
+                ':active': 'active',
                 ':end': datetime.utcnow().isoformat()
             }
         )
-        print(f"Session {session_id} finalized")
+        devices_table.update_item(
+            Key={'device_id': device_id},
+            UpdateExpression='REMOVE active_session_id, active_session_start',
+            ConditionExpression='active_session_id = :sid',
+            ExpressionAttributeValues={':sid': session_id}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return
+    invalidate_device(device_id)
+    print(f"Session {session_id} finalized")
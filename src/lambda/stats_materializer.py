@@ -0,0 +1,282 @@
+"""
+EcoShower - System stats materializer
+Consumes the DynamoDB Streams of the Users, Devices and Sessions tables and
+keeps the admin dashboard's counters up to date in the SystemStats table, so
+/admin/stats reads a few items instead of scanning every table.
+
+SystemStats items (pk / sk):
+  GLOBAL / TOTALS            users, devices, devices_online, sessions, water_saved
+  GLOBAL / DAY#YYYY-MM-DD    sessions, water (Israel local date of start_time)
+  USER#<user_id> / TOTALS    the same counters for one user
+  USER#<user_id> / DAY#...   the same buckets for one user
+
+Each stream record is turned into the difference between what its old and new
+image contribute; a batch's differences are summed per item and applied with
+one ADD per item. Records that change no counter (most Devices writes) cost
+nothing more; the others get a marker item so a redelivered record is applied
+once (see apply_records). tools/rebuild_system_stats.py recomputes everything
+from the tables (first deployment, or after a stream outage). Consumed
+capacity is logged as in the other lambdas (see instrumentation.py), so
+tools/project_cost.py can add these writes to the projection.
+"""
+
+import os
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+from aws_clients import lazy_resource, lazy_table
+from instrumentation import Tracer
+from local_time import local_date
+
+tracer = Tracer('stats_materializer')
+
+# Initialize AWS clients
+dynamodb = tracer.instrument(lazy_resource('dynamodb'), 'dynamodb')
+
+# Environment variables
+USERS_TABLE = os.environ.get('USERS_TABLE', 'EcoShower-Users')
+DEVICES_TABLE = os.environ.get('DEVICES_TABLE', 'EcoShower-Devices')
+SESSIONS_TABLE = os.environ.get('SESSIONS_TABLE', 'EcoShower-Sessions')
+STATS_TABLE = os.environ.get('STATS_TABLE', 'EcoShower-SystemStats')
+
+stats_table = tracer.instrument(lazy_table(dynamodb, STATS_TABLE), 'dynamodb')
+
+GLOBAL_PK = 'GLOBAL'
+TOTALS_SK = 'TOTALS'
+DAY_PREFIX = 'DAY#'
+
+# Per-record markers (pk RECORD#<source>#<sequence number>, sk APPLIED) outlive the
+# stream's 24 h retention, after which Lambda can no longer redeliver the record
+RECORD_PREFIX = 'RECORD#'
+APPLIED_SK = 'APPLIED'
+RECORD_MARKER_HOURS = int(os.environ.get('RECORD_MARKER_HOURS', '48'))
+TTL_ATTRIBUTE = 'expires_at'
+# BatchGetItem takes at most 100 keys; an item's pending check stays well inside
+# the 4 KB ConditionExpression limit
+BATCH_GET_SIZE = 100
+PENDING_CHECK_SIZE = 25
+
+_deserializer = TypeDeserializer()
+
+
+def user_pk(user_id: str) -> str:
+    return f"USER#{user_id}"
+
+
+# ============= CONTRIBUTIONS =============
+
+def contributions(source: str, item: dict) -> dict:
+    """{(pk, sk): {counter: amount}} that one Users/Devices/Sessions item adds to the stats"""
+    if not item:
+        return {}
+    owner = item.get('user_id')
+    totals = {}
+    day = None
+
+    if source == 'users':
+        totals = {'users': 1}
+    elif source == 'devices':
+        totals = {'devices': 1, 'devices_online': 1 if item.get('status') == 'online' else 0}
+    elif source == 'sessions':
+        # Every session counts; water only once it is completed
+        water = Decimal(str(item.get('water_saved', 0))) if item.get('status') == 'completed' else Decimal('0')
+        totals = {'sessions': 1, 'water_saved': water}
+        if item.get('start_time'):
+            try:
+                day = (DAY_PREFIX + local_date(item['start_time']), {'sessions': 1, 'water': water})
+            except ValueError:
+                print(f"Error parsing date {item.get('start_time')}")
+
+    result = {}
+    for pk in [GLOBAL_PK] + ([user_pk(owner)] if owner else []):
+        result[(pk, TOTALS_SK)] = dict(totals)
+        if day:
+            result[(pk, day[0])] = dict(day[1])
+    return result
+
+
+def record_delta(source: str, old: dict, new: dict) -> dict:
+    """What a change from `old` to `new` adds (or removes) per stats item - zeros dropped"""
+    delta = defaultdict(lambda: defaultdict(Decimal))
+    for key, counters in contributions(source, new).items():
+        for name, amount in counters.items():
+            delta[key][name] += amount
+    for key, counters in contributions(source, old).items():
+        for name, amount in counters.items():
+            delta[key][name] -= amount
+    return {key: {n: a for n, a in counters.items() if a} for key, counters in delta.items()
+            if any(counters.values())}
+
+
+def merge_deltas(target: dict, delta: dict):
+    for key, counters in delta.items():
+        merged = target.setdefault(key, {})
+        for name, amount in counters.items():
+            merged[name] = merged.get(name, Decimal('0')) + amount
+
+
+# ============= STREAM HANDLER =============
+
+def source_of(record: dict) -> str:
+    """'users', 'devices' or 'sessions' from the record's stream ARN (table/<name>/stream/...)"""
+    table_name = record.get('eventSourceARN', '').split(':table/')[-1].split('/')[0]
+    return {USERS_TABLE: 'users', DEVICES_TABLE: 'devices', SESSIONS_TABLE: 'sessions'}.get(table_name)
+
+
+def image(record: dict, name: str) -> dict:
+    raw = record.get('dynamodb', {}).get(name)
+    if not raw:
+        return None
+    return {key: _deserializer.deserialize(value) for key, value in raw.items()}
+
+
+def record_id(source: str, record: dict) -> str:
+    """Stable id of a stream record - the same on every redelivery, however the batch is split"""
+    return f"{source}#{record.get('dynamodb', {}).get('SequenceNumber', '')}"
+
+
+def item_ref(key: tuple) -> str:
+    return f"{key[0]}|{key[1]}"
+
+
+def applied_items(record_ids: list) -> dict:
+    """{record_id: {'pk|sk', ...}} - the stats items earlier attempts added each record to"""
+    applied = {}
+    for start in range(0, len(record_ids), BATCH_GET_SIZE):
+        keys = [{'pk': RECORD_PREFIX + rid, 'sk': APPLIED_SK} for rid in record_ids[start:start + BATCH_GET_SIZE]]
+        request = {STATS_TABLE: {'Keys': keys, 'ConsistentRead': True}}
+        while request:
+            result = dynamodb.batch_get_item(RequestItems=request)
+            for item in result['Responses'].get(STATS_TABLE, []):
+                applied[item['pk'][len(RECORD_PREFIX):]] = set(item.get('items', ()))
+            request = result.get('UnprocessedKeys')
+    return applied
+
+
+def add_counters(key: tuple, contributions: dict) -> int:
+    """
+    ADD the summed counters of {record_id: counters} to one stats item, noting
+    the records in its pending_records under the same write. A record already
+    pending there (an interrupted earlier attempt added it) is left out.
+    Returns the number of writes.
+    """
+    pk, sk = key
+    written = 0
+    record_ids = sorted(contributions)
+    for start in range(0, len(record_ids), PENDING_CHECK_SIZE):
+        chunk = {rid: contributions[rid] for rid in record_ids[start:start + PENDING_CHECK_SIZE]}
+        while chunk:
+            counters = {}
+            for amounts in chunk.values():
+                for name, amount in amounts.items():
+                    counters[name] = counters.get(name, Decimal('0')) + amount
+            names = {'#p': 'pending_records'}
+            values = {':records': set(chunk)}
+            adds = ['#p :records']
+            for i, (name, amount) in enumerate(sorted(counters.items())):
+                names[f"#c{i}"] = name
+                values[f":c{i}"] = amount
+                adds.append(f"#c{i} :c{i}")
+            conditions = []
+            for i, rid in enumerate(sorted(chunk)):
+                values[f":r{i}"] = rid
+                conditions.append(f"NOT contains(#p, :r{i})")
+            try:
+                stats_table.update_item(
+                    Key={'pk': pk, 'sk': sk},
+                    UpdateExpression='ADD ' + ', '.join(adds),
+                    ConditionExpression=' AND '.join(conditions),
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=values
+                )
+                written += 1
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+            pending = stats_table.get_item(
+                Key={'pk': pk, 'sk': sk},
+                ProjectionExpression='#p',
+                ExpressionAttributeNames={'#p': 'pending_records'},
+                ConsistentRead=True
+            ).get('Item', {}).get('pending_records', set())
+            print(f"Records {sorted(pending & set(chunk))} already applied to {pk}/{sk}")
+            chunk = {rid: counters for rid, counters in chunk.items() if rid not in pending}
+    return written
+
+
+def apply_records(source: str, records: list) -> int:
+    """
+    Add the records' contributions to the SystemStats items exactly once per record.
+
+    Each stats item is written once per batch with its records' summed deltas.
+    Afterwards every record's marker item lists the stats items it reached and
+    the items' pending_records entries are dropped. When Lambda redelivers
+    records - a retried batch, whole or split - an item is skipped for a record
+    whose marker lists it, or that it still holds as pending from an attempt
+    interrupted before the markers were written. Returns the number of writes.
+    """
+    per_item = {}
+    for record in records:
+        rid = record_id(source, record)
+        for key, counters in record_delta(source, image(record, 'OldImage'), image(record, 'NewImage')).items():
+            per_item.setdefault(key, {})[rid] = counters
+    if not per_item:
+        return 0
+
+    record_ids = sorted({rid for contributions in per_item.values() for rid in contributions})
+    with tracer.stage('check_applied'):
+        applied = applied_items(record_ids)
+    written = 0
+    with tracer.stage('add_counters'):
+        for key, contributions in sorted(per_item.items()):
+            todo = {rid: counters for rid, counters in contributions.items()
+                    if item_ref(key) not in applied.get(rid, ())}
+            if todo:
+                written += add_counters(key, todo)
+
+    expires_at = int(time.time()) + RECORD_MARKER_HOURS * 3600
+    with tracer.stage('mark_applied'):
+        for rid in record_ids:
+            stats_table.update_item(
+                Key={'pk': RECORD_PREFIX + rid, 'sk': APPLIED_SK},
+                UpdateExpression=f"ADD #items :items SET {TTL_ATTRIBUTE} = :exp",
+                ExpressionAttributeNames={'#items': 'items'},
+                ExpressionAttributeValues={
+                    ':items': {item_ref(key) for key, contributions in per_item.items() if rid in contributions},
+                    ':exp': expires_at
+                }
+            )
+        for (pk, sk), contributions in sorted(per_item.items()):
+            stats_table.update_item(
+                Key={'pk': pk, 'sk': sk},
+                UpdateExpression='DELETE #p :records',
+                ExpressionAttributeNames={'#p': 'pending_records'},
+                ExpressionAttributeValues={':records': set(contributions)}
+            )
+    return written
+
+
+def lambda_handler(event, context):
+    """Stream batch from one of the source tables -> SystemStats updates"""
+    tracer.begin(source='stream')
+    try:
+        by_source = defaultdict(list)
+        for record in event.get('Records', []):
+            source = source_of(record)
+            if source is None:
+                print(f"Ignoring record from {record.get('eventSourceARN')}")
+                continue
+            by_source[source].append(record)
+
+        written = 0
+        for source, records in by_source.items():
+            written += apply_records(source, records)
+
+        print(f"Applied {sum(len(r) for r in by_source.values())} records to {written} stats items")
+        return {'records': sum(len(r) for r in by_source.values()), 'items_written': written}
+    finally:
+        tracer.end()
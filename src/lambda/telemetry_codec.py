@@ -0,0 +1,184 @@
+"""
+EcoShower - Telemetry Chunk Codec
+Packs readings into compact delta-encoded binary segments and back.
+Shared by process_telemetry (writer) and lambda_function (reader).
+"""
+
+from datetime import datetime, timezone
+from decimal import Decimal
+
+FORMAT_VERSION = 1
+# Temperatures are stored as integers scaled by 10 ** digits (digits <= MAX_DIGITS)
+MAX_DIGITS = 3
+
+
+def _zigzag(value: int) -> int:
+    """Map signed ints to unsigned so small negatives stay small"""
+    return ((-value) << 1) - 1 if value < 0 else value << 1
+
+
+def _unzigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> tuple:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _decimal_digits(value: Decimal) -> int:
+    exponent = value.normalize().as_tuple().exponent
+    return min(max(-exponent, 0), MAX_DIGITS) if isinstance(exponent, int) else 0
+
+
+def to_epoch_ms(timestamp: str) -> int:
+    """ISO-8601 timestamp (naive means UTC) to epoch milliseconds"""
+    parsed = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(round(parsed.timestamp() * 1000))
+
+
+def from_epoch_ms(epoch_ms: int) -> str:
+    """Epoch milliseconds to the ISO format the devices send"""
+    moment = datetime.fromtimestamp(epoch_ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+    return moment.isoformat(timespec='milliseconds') + 'Z'
+
+
+def encode_readings(readings: list) -> bytes:
+    """
+    Encode readings - dicts with 'timestamp', 'temperature' (Decimal) and
+    'status' - into one binary segment.
+
+    Layout (all integers are zigzag varints):
+        version, count, digits, status table (size, then length-prefixed UTF-8),
+        first timestamp (ms), first delta, then delta-of-delta per reading,
+        first scaled temperature, then temperature deltas,
+        one status table index per reading.
+    Order is preserved; timestamps do not need to be sorted.
+    """
+    out = bytearray([FORMAT_VERSION])
+    _write_varint(out, len(readings))
+    if not readings:
+        return bytes(out)
+
+    temperatures = [Decimal(str(r['temperature'])) for r in readings]
+    digits = max(_decimal_digits(t) for t in temperatures)
+    scale = 10 ** digits
+    _write_varint(out, digits)
+
+    statuses = []
+    status_index = {}
+    for r in readings:
+        status = str(r.get('status', 'unknown'))
+        if status not in status_index:
+            status_index[status] = len(statuses)
+            statuses.append(status)
+    _write_varint(out, len(statuses))
+    for status in statuses:
+        raw = status.encode('utf-8')
+        _write_varint(out, len(raw))
+        out.extend(raw)
+
+    # Timestamps: first value, first delta, then delta-of-delta (regular sampling -> zeros)
+    times = [to_epoch_ms(r['timestamp']) for r in readings]
+    previous_time = times[0]
+    previous_delta = 0
+    _write_varint(out, _zigzag(previous_time))
+    for index, value in enumerate(times[1:]):
+        delta = value - previous_time
+        _write_varint(out, _zigzag(delta if index == 0 else delta - previous_delta))
+        previous_time, previous_delta = value, delta
+
+    # Temperatures: scaled integers, first value then deltas
+    previous_temp = 0
+    for temperature in temperatures:
+        scaled = int((temperature * scale).to_integral_value())
+        _write_varint(out, _zigzag(scaled - previous_temp))
+        previous_temp = scaled
+
+    for r in readings:
+        _write_varint(out, status_index[str(r.get('status', 'unknown'))])
+
+    return bytes(out)
+
+
+def decode_readings(data: bytes) -> list:
+    """Decode one segment back into reading dicts (timestamp as ISO string)"""
+    data = bytes(data)
+    if not data:
+        return []
+    if data[0] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported telemetry segment version {data[0]}")
+
+    count, pos = _read_varint(data, 1)
+    if count == 0:
+        return []
+    digits, pos = _read_varint(data, pos)
+
+    table_size, pos = _read_varint(data, pos)
+    statuses = []
+    for _ in range(table_size):
+        length, pos = _read_varint(data, pos)
+        statuses.append(data[pos:pos + length].decode('utf-8'))
+        pos += length
+
+    times = []
+    previous_delta = 0
+    for index in range(count):
+        raw, pos = _read_varint(data, pos)
+        value = _unzigzag(raw)
+        if index == 0:
+            times.append(value)
+        elif index == 1:
+            previous_delta = value
+            times.append(times[-1] + value)
+        else:
+            previous_delta += value
+            times.append(times[-1] + previous_delta)
+
+    scale = Decimal(10) ** digits
+    temperatures = []
+    previous_temp = 0
+    for _ in range(count):
+        raw, pos = _read_varint(data, pos)
+        previous_temp += _unzigzag(raw)
+        temperatures.append(Decimal(previous_temp) / scale)
+
+    readings = []
+    for index in range(count):
+        status_id, pos = _read_varint(data, pos)
+        readings.append({
+            'timestamp': from_epoch_ms(times[index]),
+            'temperature': temperatures[index],
+            'status': statuses[status_id]
+        })
+    return readings
+
+
+def decode_chunk(item: dict) -> list:
+    """Decode every segment of a chunk item, sorted by timestamp, one reading per timestamp"""
+    by_timestamp = {}
+    for segment in item.get('segments', []):
+        # boto3 returns Binary wrappers for B attributes
+        for reading in decode_readings(getattr(segment, 'value', segment)):
+            # Older chunks can hold a redelivered segment twice - keep the first copy
+            by_timestamp.setdefault(reading['timestamp'], reading)
+    readings = sorted(by_timestamp.values(), key=lambda r: r['timestamp'])
+    for reading in readings:
+        reading['device_id'] = item.get('device_id')
+    return readings
@@ -0,0 +1,110 @@
+"""
+Chunked telemetry storage against the in-memory stand-ins in tools/fakes.py:
+redelivered batches must not append their readings to a chunk twice.
+
+    python -m pytest src/lambda/tests
+"""
+
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, LAMBDA_DIR)
+sys.path.insert(0, os.path.join(LAMBDA_DIR, 'tools'))
+
+# The lambdas build boto3 clients at import; no call ever reaches AWS
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('TRACING_ENABLED', 'false')
+
+import process_telemetry  # noqa: E402
+from fakes import FakeDynamoDB, FakePublisher, create_project_tables, install  # noqa: E402
+from telemetry_codec import decode_chunk, to_epoch_ms  # noqa: E402
+
+CHUNK_START = '2025-01-06T06:00:00'
+
+
+class FailingPublisher(FakePublisher):
+    """iot-data stand-in whose publishes fail, so the valve never opens"""
+
+    def publish(self, **kwargs):
+        raise RuntimeError("IoT endpoint unavailable")
+
+
+@pytest.fixture
+def pt(monkeypatch):
+    """process_telemetry in chunked mode on fresh fake tables"""
+    fake = create_project_tables(FakeDynamoDB())
+    for attr in ['dynamodb', 'iot_client', 'sns_client'] + [a for a in vars(process_telemetry) if a.endswith('_table')]:
+        monkeypatch.setattr(process_telemetry, attr, getattr(process_telemetry, attr))
+    install(process_telemetry, fake, {'iot_client': FakePublisher('iot'), 'sns_client': FakePublisher('sns')})
+    monkeypatch.setattr(process_telemetry, 'TELEMETRY_STORAGE_MODE', 'chunked')
+    monkeypatch.setattr(process_telemetry, 'ROLLUPS_MODE', 'off')
+    for cache in (process_telemetry.written_state_cache, process_telemetry.stored_reading_cache):
+        cache.clear()
+
+    fake.Table('EcoShower-Users').put_item(Item={'user_id': 'user-1'})
+    fake.Table('EcoShower-Devices').put_item(Item={
+        'device_id': 'dev-1',
+        'user_id': 'user-1',
+        'status': 'heating',
+        'target_temp': Decimal('38')
+    })
+    return process_telemetry
+
+
+def batch(*readings) -> dict:
+    """An SQS event, one reading per message"""
+    return {'Records': [
+        {'messageId': f"msg-{seconds}", 'body': (
+            f'{{"device_id": "dev-1", "temperature": {temperature}, "status": "heating", '
+            f'"timestamp": "2025-01-06T06:00:{seconds:02d}.000Z"}}'
+        )}
+        for seconds, temperature in readings
+    ]}
+
+
+def chunk(pt) -> dict:
+    return pt.chunks_table.get_item(Key={'device_id': 'dev-1', 'chunk_start': CHUNK_START})['Item']
+
+
+def stored_seconds(pt) -> list:
+    return [to_epoch_ms(r['timestamp']) // 1000 % 60 for r in decode_chunk(chunk(pt))]
+
+
+def test_redelivered_batch_is_stored_once(pt):
+    event = batch((0, 30), (5, 34), (10, 37))
+    assert pt.lambda_handler(event, None) == {'batchItemFailures': []}
+    pt.lambda_handler(event, None)
+
+    assert chunk(pt)['reading_count'] == 3
+    assert len(chunk(pt)['segments']) == 1
+    assert stored_seconds(pt) == [0, 5, 10]
+
+
+def test_failed_valve_does_not_redeliver_stored_readings(pt, monkeypatch):
+    monkeypatch.setattr(pt, 'iot_client', FailingPublisher('iot'))
+    event = batch((0, 30), (5, 34), (10, 38.5))
+
+    assert pt.lambda_handler(event, None) == {'batchItemFailures': []}
+    # The device is back to heating, so its next reading at the target retries the valve
+    assert pt.devices_table.get_item(Key={'device_id': 'dev-1'})['Item']['status'] == 'heating'
+    # Lambda may still retry the whole batch (timeout, crash) - nothing is appended twice
+    pt.lambda_handler(event, None)
+    assert chunk(pt)['reading_count'] == 3
+    assert stored_seconds(pt) == [0, 5, 10]
+
+
+def test_partial_redelivery_appends_only_new_readings(pt):
+    pt.lambda_handler(batch((0, 30), (5, 34)), None)
+    # A redelivered reading together with a new one, and a late reading on its own
+    pt.lambda_handler(batch((5, 34), (10, 36)), None)
+    pt.lambda_handler(batch((2, 31)), None)
+
+    item = chunk(pt)
+    assert item['reading_count'] == 4
+    assert stored_seconds(pt) == [0, 2, 5, 10]
+    assert item['first_ts'] == '2025-01-06T06:00:00.000Z'
+    assert item['last_ts'] == '2025-01-06T06:00:10.000Z'
@@ -0,0 +1,163 @@
+"""
+Round-trip tests for telemetry_codec - the chunked Telemetry storage format.
+
+    python -m pytest src/lambda/tests
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+from boto3.dynamodb.types import Binary
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telemetry_codec import (  # noqa: E402
+    FORMAT_VERSION, MAX_DIGITS, decode_chunk, decode_readings, encode_readings, from_epoch_ms, to_epoch_ms
+)
+
+START = datetime(2025, 1, 6, 6, 0, tzinfo=timezone.utc)
+
+
+def reading(seconds: float, temperature, status: str = 'heating') -> dict:
+    moment = START + timedelta(seconds=seconds)
+    return {
+        'timestamp': moment.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        'temperature': Decimal(str(temperature)),
+        'status': status
+    }
+
+
+def assert_round_trip(readings: list):
+    decoded = decode_readings(encode_readings(readings))
+    assert len(decoded) == len(readings)
+    for original, result in zip(readings, decoded):
+        assert to_epoch_ms(result['timestamp']) == to_epoch_ms(original['timestamp'])
+        assert result['temperature'] == original['temperature']
+        assert result['status'] == original['status']
+
+
+def test_round_trip_regular_sampling():
+    readings = [reading(i * 5, round(20 + i * 0.3, 1), 'heating' if i < 40 else 'ready') for i in range(60)]
+    assert_round_trip(readings)
+
+
+def test_round_trip_keeps_timestamp_format():
+    decoded = decode_readings(encode_readings([reading(0, 21.5)]))
+    assert decoded[0]['timestamp'] == '2025-01-06T06:00:00.000Z'
+    assert from_epoch_ms(to_epoch_ms(decoded[0]['timestamp'])) == decoded[0]['timestamp']
+
+
+def test_empty_segment():
+    assert decode_readings(encode_readings([])) == []
+    assert decode_readings(b'') == []
+
+
+def test_single_reading():
+    assert_round_trip([reading(0, 38)])
+
+
+def test_out_of_order_timestamps_keep_their_order():
+    readings = [reading(seconds, 30) for seconds in (10, 5, 20, 0, 15, 15)]
+    assert_round_trip(readings)
+
+
+def test_irregular_sampling():
+    readings = [reading(seconds, 30) for seconds in (0, 1, 7, 7.5, 60, 3600, 3601.25)]
+    assert_round_trip(readings)
+
+
+def test_negative_deltas():
+    # Falling temperatures, below-zero values and time going backwards
+    readings = [reading(0, 12.5), reading(5, 3.1), reading(10, -4.7), reading(2, -40), reading(4, 0)]
+    assert_round_trip(readings)
+
+
+def test_timestamps_before_epoch():
+    readings = [{'timestamp': '1969-12-31T23:59:58Z', 'temperature': Decimal('1'), 'status': 'idle'},
+                {'timestamp': '1970-01-01T00:00:01Z', 'temperature': Decimal('2'), 'status': 'idle'}]
+    assert_round_trip(readings)
+
+
+def test_naive_timestamps_are_utc():
+    decoded = decode_readings(encode_readings([
+        {'timestamp': '2025-01-06T06:00:00', 'temperature': Decimal('30'), 'status': 'heating'}
+    ]))
+    assert decoded[0]['timestamp'] == '2025-01-06T06:00:00.000Z'
+
+
+def test_timestamps_are_rounded_to_milliseconds():
+    decoded = decode_readings(encode_readings([
+        {'timestamp': '2025-01-06T06:00:00.123456Z', 'temperature': Decimal('30'), 'status': 'heating'},
+        {'timestamp': '2025-01-06T06:00:00.999600Z', 'temperature': Decimal('30'), 'status': 'heating'}
+    ]))
+    assert [r['timestamp'] for r in decoded] == ['2025-01-06T06:00:00.123Z', '2025-01-06T06:00:01.000Z']
+
+
+def test_mixed_precision_uses_the_finest():
+    readings = [reading(0, '38'), reading(5, '38.5'), reading(10, '38.25'), reading(15, '38.125')]
+    assert_round_trip(readings)
+
+
+def test_precision_is_capped_at_max_digits():
+    assert MAX_DIGITS == 3
+    decoded = decode_readings(encode_readings([
+        {'timestamp': '2025-01-06T06:00:00Z', 'temperature': Decimal('38.12345'), 'status': 'heating'},
+        {'timestamp': '2025-01-06T06:00:05Z', 'temperature': Decimal('-1.0004'), 'status': 'heating'}
+    ]))
+    assert [r['temperature'] for r in decoded] == [Decimal('38.123'), Decimal('-1.000')]
+
+
+def test_float_temperatures():
+    decoded = decode_readings(encode_readings([
+        {'timestamp': '2025-01-06T06:00:00Z', 'temperature': 37.6, 'status': 'heating'}
+    ]))
+    assert decoded[0]['temperature'] == Decimal('37.6')
+
+
+def test_status_table():
+    readings = [reading(i, 30, status) for i, status in enumerate(['heating', 'ready', 'heating', 'idle', 'מוכן'])]
+    assert_round_trip(readings)
+    assert decode_readings(encode_readings([{'timestamp': '2025-01-06T06:00:00Z', 'temperature': 1}]))[0]['status'] == 'unknown'
+
+
+def test_regular_sampling_is_compact():
+    readings = [reading(i * 5, 38) for i in range(720)]
+    # delta-of-delta, temperature delta and status index are one zero byte each
+    assert len(encode_readings(readings)) <= 3 * len(readings) + 32
+
+
+def test_unsupported_version():
+    data = bytearray(encode_readings([reading(0, 30)]))
+    data[0] = FORMAT_VERSION + 1
+    with pytest.raises(ValueError):
+        decode_readings(bytes(data))
+
+
+def test_decode_chunk_merges_segments():
+    first = [reading(i * 5, 20 + i) for i in range(10)]
+    second = [reading(50 + i * 5, 30 + i, 'ready') for i in range(10)]
+    late = [reading(2, 21.5), reading(7, 22.5)]
+    item = {
+        'device_id': 'dev-1',
+        'chunk_start': '2025-01-06T06:00:00',
+        # As boto3 returns them: Binary wrappers, plus raw bytes from the fakes
+        'segments': [Binary(encode_readings(second)), Binary(encode_readings(first)), encode_readings(late)]
+    }
+    decoded = decode_chunk(item)
+    expected = sorted(first + second + late, key=lambda r: to_epoch_ms(r['timestamp']))
+    assert [to_epoch_ms(r['timestamp']) for r in decoded] == [to_epoch_ms(r['timestamp']) for r in expected]
+    assert [r['temperature'] for r in decoded] == [r['temperature'] for r in expected]
+    assert {r['device_id'] for r in decoded} == {'dev-1'}
+
+
+def test_decode_chunk_drops_repeated_segments():
+    segment = encode_readings([reading(i * 5, 20 + i) for i in range(5)])
+    decoded = decode_chunk({'device_id': 'dev-1', 'segments': [segment, Binary(segment)]})
+    assert [to_epoch_ms(r['timestamp']) for r in decoded] == [to_epoch_ms(reading(i * 5, 0)['timestamp']) for i in range(5)]
+
+
+def test_decode_chunk_without_segments():
+    assert decode_chunk({'device_id': 'dev-1'}) == []
@@ -0,0 +1,130 @@
+"""
+EcoShower - Sessions user index backfill
+
+History and the dashboard rebuild read a user's sessions from the Sessions
+`user-start-index` GSI (user_id / start_time). DynamoDB only indexes items that
+carry both attributes, and sessions an admin started used to carry the admin's
+user_id. This one-time job sets every session's user_id to its device's owner
+(what the per-device history showed) and reports sessions it cannot index.
+
+    python src/lambda/tools/backfill_session_index.py --dry-run
+    python src/lambda/tools/backfill_session_index.py --create-index
+    python src/lambda/tools/backfill_session_index.py --only-missing
+
+Safe to re-run: sessions that already match are not written. The API keeps
+using the device-index until SESSIONS_USER_INDEX=user-start-index is added to
+its environment - do that after this job reports no unindexed sessions.
+"""
+
+import argparse
+import os
+import sys
+
+import boto3
+from botocore.exceptions import ClientError
+
+SESSIONS_TABLE = os.environ.get('SESSIONS_TABLE', 'EcoShower-Sessions')
+DEVICES_TABLE = os.environ.get('DEVICES_TABLE', 'EcoShower-Devices')
+SESSIONS_USER_INDEX = os.environ.get('SESSIONS_USER_INDEX', 'user-start-index')
+
+
+def scan_all(table, **kwargs):
+    """Yield every item, following LastEvaluatedKey"""
+    while True:
+        result = table.scan(**kwargs)
+        yield from result.get('Items', [])
+        if 'LastEvaluatedKey' not in result:
+            return
+        kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
+
+
+def create_index(client, table_name: str, index_name: str) -> bool:
+    """Add the user_id/start_time GSI unless it exists; returns True if it was created"""
+    description = client.describe_table(TableName=table_name)['Table']
+    if any(i['IndexName'] == index_name for i in description.get('GlobalSecondaryIndexes', [])):
+        print(f"{index_name} already exists on {table_name}")
+        return False
+    client.update_table(
+        TableName=table_name,
+        AttributeDefinitions=[
+            {'AttributeName': 'user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'start_time', 'AttributeType': 'S'}
+        ],
+        GlobalSecondaryIndexUpdates=[{'Create': {
+            'IndexName': index_name,
+            'KeySchema': [
+                {'AttributeName': 'user_id', 'KeyType': 'HASH'},
+                {'AttributeName': 'start_time', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'ALL'}
+        }}]
+    )
+    print(f"Creating {index_name} on {table_name} - DynamoDB builds it in the background")
+    return True
+
+
+def backfill(sessions_table, devices_table, only_missing: bool = False, dry_run: bool = False) -> dict:
+    """Align session user_id with the device owner; returns counts"""
+    owners = {
+        d['device_id']: d['user_id']
+        for d in scan_all(devices_table, ProjectionExpression='device_id, user_id')
+        if d.get('user_id')
+    }
+    counts = {'scanned': 0, 'updated': 0, 'unchanged': 0, 'orphaned': 0, 'no_start_time': 0}
+
+    for session in scan_all(sessions_table, ProjectionExpression='session_id, device_id, user_id, start_time'):
+        counts['scanned'] += 1
+        if not session.get('start_time'):
+            counts['no_start_time'] += 1
+        owner = owners.get(session.get('device_id'))
+        current = session.get('user_id')
+        if owner is None:
+            # Device deleted - keep whatever user_id the session has
+            counts['orphaned'] += 1
+            continue
+        if current == owner or (only_missing and current):
+            counts['unchanged'] += 1
+            continue
+
+        counts['updated'] += 1
+        print(f"{session['session_id']}: user_id {current!r} -> {owner!r}")
+        if dry_run:
+            continue
+        try:
+            sessions_table.update_item(
+                Key={'session_id': session['session_id']},
+                UpdateExpression='SET user_id = :u',
+                ConditionExpression='attribute_exists(session_id)',
+                ExpressionAttributeValues={':u': owner}
+            )
+        except ClientError as e:
+            # Deleted while we were scanning
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--create-index', action='store_true', help=f'add {SESSIONS_USER_INDEX} if missing')
+    parser.add_argument('--only-missing', action='store_true',
+                        help='only fill sessions without a user_id; keep mismatched ones')
+    parser.add_argument('--dry-run', action='store_true', help='report changes without writing')
+    args = parser.parse_args(argv)
+
+    dynamodb = boto3.resource('dynamodb')
+    if args.create_index and not args.dry_run:
+        create_index(dynamodb.meta.client, SESSIONS_TABLE, SESSIONS_USER_INDEX)
+
+    counts = backfill(dynamodb.Table(SESSIONS_TABLE), dynamodb.Table(DEVICES_TABLE),
+                      only_missing=args.only_missing, dry_run=args.dry_run)
+    verb = 'would update' if args.dry_run else 'updated'
+    print(f"Scanned {counts['scanned']} sessions: {verb} {counts['updated']}, "
+          f"unchanged {counts['unchanged']}, orphaned {counts['orphaned']}")
+    if counts['no_start_time']:
+        print(f"{counts['no_start_time']} sessions have no start_time and stay out of the index")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+EcoShower - Cold-start (import time) benchmark
+
+Imports each lambda module in a fresh interpreter, several times, and reports
+the median cost of:
+  boto3         importing boto3 itself (paid by every lambda)
+  module        importing the lambda module after boto3 - what our own
+                module-level code adds to every cold start
+  first use     creating each lazy client/table the first time a route
+                touches it (what the eager version paid up front)
+
+    python src/lambda/tools/bench_cold_start.py
+    python src/lambda/tools/bench_cold_start.py --runs 10 --budget-ms 60
+
+Exits non-zero when a module's import time exceeds --budget-ms.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.dirname(TOOLS_DIR)
+MODULES = ['lambda_function', 'process_telemetry']
+
+PROBE = r"""
+import importlib, json, sys, time
+sys.path.insert(0, {lambda_dir!r})
+started = time.perf_counter()
+import boto3
+boto3_done = time.perf_counter()
+module = importlib.import_module({module!r})
+module_done = time.perf_counter()
+
+from aws_clients import LazyClient
+first_use = {{}}
+lazies = []
+for name, value in vars(module).items():
+    # Unwrap instrumentation proxies without touching the lazy object's attributes
+    target = value if isinstance(value, LazyClient) else getattr(value, '__dict__', {{}}).get('_target')
+    if isinstance(target, LazyClient):
+        lazies.append((name, target))
+# Resources before the tables built from them, so each cost is counted once
+lazies.sort(key=lambda pair: 'table' in repr(pair[1]))
+for name, lazy in lazies:
+    before = time.perf_counter()
+    lazy._get()
+    first_use[name] = (time.perf_counter() - before) * 1000
+
+print(json.dumps({{
+    'boto3': (boto3_done - started) * 1000,
+    'module': (module_done - boto3_done) * 1000,
+    'first_use': first_use
+}}))
+"""
+
+
+def probe(module: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('TRACING_ENABLED', 'false')
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE.format(lambda_dir=LAMBDA_DIR, module=module)],
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(module: str, runs: int) -> dict:
+    samples = [probe(module) for _ in range(runs)]
+    first_use = {}
+    for name in samples[0]['first_use']:
+        first_use[name] = round(statistics.median(s['first_use'][name] for s in samples), 2)
+    return {
+        'boto3_ms': round(statistics.median(s['boto3'] for s in samples), 2),
+        'module_ms': round(statistics.median(s['module'] for s in samples), 2),
+        'first_use_ms': first_use,
+        'all_clients_ms': round(sum(first_use.values()), 2)
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per module')
+    parser.add_argument('--module', choices=MODULES, action='append', help='only measure this module')
+    parser.add_argument('--budget-ms', type=float, help='fail when a module import (after boto3) takes longer')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    results = {module: measure(module, args.runs) for module in (args.module or MODULES)}
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for module, result in results.items():
+            print(f"{module} (median of {args.runs} runs)")
+            print(f"  import boto3        {result['boto3_ms']} ms")
+            print(f"  import module       {result['module_ms']} ms")
+            print(f"  all clients/tables  {result['all_clients_ms']} ms (paid lazily, per route)")
+            for name, elapsed in result['first_use_ms'].items():
+                print(f"    {name:<18}{elapsed} ms")
+
+    failures = [module for module, result in results.items()
+                if args.budget_ms is not None and result['module_ms'] > args.budget_ms]
+    for module in failures:
+        print(f"BUDGET EXCEEDED - {module} import {results[module]['module_ms']} ms > {args.budget_ms} ms",
+              file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+EcoShower - Response compression benchmark
+
+Runs representative API responses - from a dashboard summary to the admin user
+list - through lambda_function.compress_response at each size threshold and
+reports the trade-off:
+
+  client KB    bytes the client downloads (API Gateway decodes the base64)
+  lambda KB    bytes the function returns to API Gateway (base64 adds 1/3;
+               the Lambda response limit is 6 MB)
+  CPU ms       compression + base64 time spent in the function
+  est. ms      CPU ms + download time at --mbps
+
+    python src/lambda/tools/bench_compression.py
+    python src/lambda/tools/bench_compression.py --mbps 5 --levels 1 5 9
+    python src/lambda/tools/bench_compression.py --thresholds 0 2048 8192 --users 5000
+
+Threshold 0 is compression off (COMPRESSION_MIN_BYTES=0).
+"""
+
+import argparse
+import copy
+import json
+import os
+import statistics
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+sys.path.insert(0, TOOLS_DIR)
+
+# The lambda builds (lazy) boto3 clients at import; no call ever reaches AWS
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import lambda_function as lf  # noqa: E402
+from bench_json import build_payloads  # noqa: E402
+
+
+def build_responses(args) -> dict:
+    """name -> API Gateway response, small single-item bodies through admin-sized lists"""
+    payloads = build_payloads(args.users, args.devices, args.sessions, args.readings, seed=7)
+    small = build_payloads(1, 1, 20, 60, seed=7)
+    bodies = {
+        'dashboard.summary': {'money_saved': 12.4, 'monthly_usage': 1550.2, 'total_sessions': 42,
+                              'avg_per_session': 36.9, 'today_usage': 61.0, 'water_price': 0.008,
+                              'period': 'all_time'},
+        'devices.get': {'device': small['admin.devices']['devices'][0]},
+        'dashboard.history (20)': small['dashboard.history'],
+        'dashboard.realtime (60)': small['dashboard.realtime'],
+        **payloads
+    }
+    return {name: lf.response(200, body) for name, body in bodies.items()}
+
+
+def measure(result: dict, threshold: int, level: int, runs: int) -> dict:
+    """Median compression cost and the resulting sizes for one response"""
+    timings = []
+    for _ in range(runs):
+        candidate = copy.deepcopy(result)
+        started = time.perf_counter()
+        lf.compress_response(candidate, 'gzip', min_bytes=threshold, level=level)
+        timings.append(time.perf_counter() - started)
+    lambda_bytes = len(candidate['body'])
+    client_bytes = lambda_bytes * 3 // 4 if candidate.get('isBase64Encoded') else lambda_bytes
+    return {
+        'compressed': bool(candidate.get('isBase64Encoded')),
+        'client_bytes': client_bytes,
+        'lambda_bytes': lambda_bytes,
+        'cpu_ms': statistics.median(timings) * 1000
+    }
+
+
+def run(args) -> dict:
+    responses = build_responses(args)
+    sizes = []
+    for name, result in responses.items():
+        row = {'payload': name, 'bytes': len(result['body'].encode('utf-8'))}
+        for level in args.levels:
+            packed = measure(result, 1, level, args.runs)
+            row[f"level_{level}"] = {'bytes': packed['client_bytes'], 'ms': round(packed['cpu_ms'], 3)}
+        sizes.append(row)
+
+    thresholds = []
+    bytes_per_ms = args.mbps * 1e6 / 8 / 1000
+    for level in args.levels:
+        for threshold in args.thresholds:
+            totals = {'level': level, 'threshold': threshold, 'compressed': 0, 'client_bytes': 0,
+                      'lambda_bytes': 0, 'cpu_ms': 0.0}
+            for result in responses.values():
+                outcome = measure(result, threshold, level, args.runs)
+                totals['compressed'] += outcome['compressed']
+                totals['client_bytes'] += outcome['client_bytes']
+                totals['lambda_bytes'] += outcome['lambda_bytes']
+                totals['cpu_ms'] += outcome['cpu_ms']
+            totals['estimated_ms'] = round(totals['cpu_ms'] + totals['client_bytes'] / bytes_per_ms, 2)
+            totals['cpu_ms'] = round(totals['cpu_ms'], 3)
+            thresholds.append(totals)
+    return {'payloads': len(responses), 'mbps': args.mbps, 'sizes': sizes, 'thresholds': thresholds}
+
+
+def print_report(result: dict, levels: list):
+    print(f"{'payload':<26}{'KB':>9}" + ''.join(f"{f'gzip-{level} KB':>14}{'ms':>8}" for level in levels))
+    for row in result['sizes']:
+        print(f"{row['payload']:<26}{row['bytes'] / 1024:>9.1f}" +
+              ''.join(f"{row[f'level_{level}']['bytes'] / 1024:>14.1f}{row[f'level_{level}']['ms']:>8.2f}"
+                      for level in levels))
+
+    print(f"\nAll {result['payloads']} responses once, download at {result['mbps']} Mbit/s:")
+    print(f"{'level':>6}{'threshold':>11}{'compressed':>12}{'client KB':>11}{'lambda KB':>11}"
+          f"{'CPU ms':>9}{'est. ms':>9}")
+    for row in result['thresholds']:
+        threshold = row['threshold'] if row['threshold'] > 0 else 'off'
+        print(f"{row['level']:>6}{threshold:>11}{row['compressed']:>12}{row['client_bytes'] / 1024:>11.1f}"
+              f"{row['lambda_bytes'] / 1024:>11.1f}{row['cpu_ms']:>9.2f}{row['estimated_ms']:>9.1f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--thresholds', type=int, nargs='+', default=[0, 512, 2048, 8192, 32768, 131072],
+                        help='COMPRESSION_MIN_BYTES values to compare (0 = off)')
+    parser.add_argument('--levels', type=int, nargs='+', default=[5], help='gzip levels to compare')
+    parser.add_argument('--mbps', type=float, default=20, help='client download bandwidth for the estimate')
+    parser.add_argument('--users', type=int, default=1000, help='users in the admin user list')
+    parser.add_argument('--devices', type=int, default=1200, help='devices in the admin device list')
+    parser.add_argument('--sessions', type=int, default=100, help='sessions in a history page')
+    parser.add_argument('--readings', type=int, default=1440, help='telemetry readings / trend points')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs per response and setting')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result, args.levels)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+EcoShower - Response serialization micro-benchmark
+
+Encodes representative API payloads - shaped like DynamoDB returns them, with
+Decimal numbers - through each JSON backend and reports the median time:
+
+  legacy   json.dumps(cls=DecimalEncoder), what response() used before json_codec
+  stdlib   json_codec with the stdlib encoder
+  convert  one pass converting Decimals to floats, then the stdlib encoder with no hook
+  orjson   json_codec with orjson (skipped when it is not installed)
+
+    python src/lambda/tools/bench_json.py
+    python src/lambda/tools/bench_json.py --users 5000 --devices 6000 --runs 50
+
+Every backend's output is decoded and compared with the legacy one, so a
+faster encoder cannot silently change a response.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from decimal import Decimal
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+
+import json_codec  # noqa: E402
+
+
+class DecimalEncoder(json.JSONEncoder):
+    """The encoder response() used before json_codec"""
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        return super().default(obj)
+
+
+def legacy_dumps(value) -> str:
+    return json.dumps(value, cls=DecimalEncoder, ensure_ascii=False)
+
+
+def to_plain(value):
+    """Copy of an item tree with Decimals as floats - only Decimal and container values are replaced"""
+    kind = type(value)
+    if kind is Decimal:
+        return float(value)
+    if kind is dict:
+        plain = value.copy()
+        for key, item in value.items():
+            if type(item) in PLAIN_TYPES:
+                plain[key] = to_plain(item)
+        return plain
+    if kind is list:
+        return [to_plain(item) if type(item) in PLAIN_TYPES else item for item in value]
+    return value
+
+
+PLAIN_TYPES = {Decimal, dict, list}
+
+
+def convert_dumps(value) -> str:
+    return json.dumps(to_plain(value), ensure_ascii=False, separators=(',', ':'))
+
+
+def money(rng: random.Random, high: float) -> Decimal:
+    return Decimal(str(round(rng.uniform(0, high), 3)))
+
+
+def build_payloads(users: int, devices: int, sessions: int, readings: int, seed: int) -> dict:
+    """name -> response body, as the admin, history and dashboard routes build them"""
+    rng = random.Random(seed)
+    user_items = [{
+        'user_id': f"user-{i:05d}",
+        'email': f"user{i}@example.com",
+        'name': f"משתמש {i}",
+        'role': 'admin' if i % 50 == 0 else 'user',
+        'created_at': '2025-01-06T06:00:00',
+        'sns_topic_arn': f"arn:aws:sns:eu-north-1:123456789012:EcoShower-User-{i:05d}",
+        'system': {'water_price_per_liter': Decimal('0.008'), 'temperature_unit': 'celsius', 'language': 'he'},
+        'notifications': {'water_ready': True, 'session_summary': rng.random() < 0.5},
+        'devices_count': rng.randint(0, 3),
+        'sessions_count': rng.randint(0, 900)
+    } for i in range(users)]
+    device_items = [{
+        'device_id': f"dev-{i:05d}",
+        'user_id': f"user-{i % max(users, 1):05d}",
+        'name': f"מקלחת {i}",
+        'device_code': f"{i:012d}",
+        'status': rng.choice(['ready', 'heating', 'online', 'offline']),
+        'target_temp': Decimal(rng.randint(35, 42)),
+        'current_temp': money(rng, 45),
+        'total_sessions': Decimal(rng.randint(0, 900)),
+        'total_water_saved': money(rng, 20000),
+        'created_at': '2025-01-06T06:00:00',
+        'last_seen': '2025-03-01T07:30:00Z'
+    } for i in range(devices)]
+    session_items = [{
+        'session_id': f"sess-{i:06d}",
+        'device_id': f"dev-{i % max(devices, 1):05d}",
+        'device_name': f"מקלחת {i % max(devices, 1)}",
+        'user_id': 'user-00001',
+        'start_time': f"2025-03-{1 + i % 28:02d}T07:{i % 60:02d}:00Z",
+        'end_time': f"2025-03-{1 + i % 28:02d}T07:{(i + 8) % 60:02d}:00Z",
+        'status': 'completed',
+        'target_temp': Decimal(38),
+        'planned_duration': Decimal(10),
+        'duration': money(rng, 900),
+        'water_saved': money(rng, 120),
+        'money_saved': money(rng, 1)
+    } for i in range(sessions)]
+    reading_items = [{
+        'device_id': 'dev-00001',
+        'timestamp': f"2025-03-01T07:{i // 60 % 60:02d}:{i % 60:02d}Z",
+        'temperature': money(rng, 45),
+        'status': 'heating'
+    } for i in range(readings)]
+    trend_points = [{
+        'time': f"2025-03-01T{i // 60 % 24:02d}:{i % 60:02d}",
+        'count': Decimal(12),
+        'min_temp': money(rng, 30),
+        'max_temp': money(rng, 45),
+        'avg_temp': money(rng, 40),
+        'heating_seconds': Decimal(rng.randint(0, 60)),
+        'avg_time_to_ready': None
+    } for i in range(readings)]
+    return {
+        'admin.users': {'users': user_items},
+        'admin.devices': {'devices': device_items},
+        'dashboard.history': {'sessions': session_items, 'next_cursor': 'eyJrIjogWyIyMDI1Il19'},
+        'dashboard.realtime': {'device': device_items[0] if device_items else {}, 'telemetry': reading_items},
+        'dashboard.trends': {'device_id': 'dev-00001', 'resolution': 'minute', 'points': trend_points}
+    }
+
+
+def time_encoder(encode, payload, runs: int) -> float:
+    """Median seconds per encode"""
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        encode(payload)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def run(args) -> list:
+    encoders = {
+        'legacy': legacy_dumps,
+        'stdlib': lambda value: json_codec.dumps(value, 'stdlib'),
+        'convert': convert_dumps
+    }
+    if json_codec.orjson is not None:
+        encoders['orjson'] = lambda value: json_codec.dumps(value, 'orjson')
+
+    rows = []
+    for name, payload in build_payloads(args.users, args.devices, args.sessions, args.readings, args.seed).items():
+        expected = json.loads(legacy_dumps(payload))
+        row = {'payload': name, 'bytes': len(legacy_dumps(payload).encode()), 'ms': {}}
+        for backend, encode in encoders.items():
+            if json.loads(encode(payload)) != expected:
+                raise SystemExit(f"{backend} output differs from legacy for {name}")
+            row['ms'][backend] = round(time_encoder(encode, payload, args.runs) * 1000, 3)
+        rows.append(row)
+    return rows
+
+
+def print_report(rows: list):
+    backends = list(rows[0]['ms']) if rows else []
+    print(f"{'payload':<20}{'KB':>8}" + ''.join(f"{b + ' ms':>12}" for b in backends) +
+          ''.join(f"{'x ' + b:>10}" for b in backends[1:]))
+    for row in rows:
+        legacy = row['ms']['legacy']
+        print(f"{row['payload']:<20}{row['bytes'] / 1024:>8.0f}" +
+              ''.join(f"{row['ms'][b]:>12.2f}" for b in backends) +
+              ''.join(f"{legacy / row['ms'][b]:>10.2f}" for b in backends[1:]))
+    if 'orjson' not in backends:
+        print("orjson is not installed - only the stdlib backends were measured")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help='users in the admin user list')
+    parser.add_argument('--devices', type=int, default=1200, help='devices in the admin device list')
+    parser.add_argument('--sessions', type=int, default=100, help='sessions in a history page')
+    parser.add_argument('--readings', type=int, default=1440, help='telemetry readings / trend points')
+    parser.add_argument('--runs', type=int, default=20, help='encodes per payload and backend')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args(argv)
+
+    rows = run(args)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_report(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,461 @@
+"""
+EcoShower - Telemetry replay benchmark
+
+Replays synthetic (or recorded) telemetry through process_telemetry.lambda_handler
+against the in-memory stand-ins in fakes.py and reports throughput, handler
+latency and AWS calls per reading. Exits non-zero when the per-reading call
+counts exceed the budgets, so ingest-path regressions show up before deploy.
+
+    python src/lambda/tools/bench_telemetry.py                    # 200 devices, 10 min each
+    python src/lambda/tools/bench_telemetry.py --batch 25
+    python src/lambda/tools/bench_telemetry.py --devices 2000 --batch 25 --budget big.json
+    python src/lambda/tools/bench_telemetry.py --input readings.jsonl
+    python src/lambda/tools/bench_telemetry.py --initial-status heating
+    python src/lambda/tools/bench_telemetry.py --devices 2000 --batch 25 --save-budget big.json
+    ROLLUPS_MODE=inline python src/lambda/tools/bench_telemetry.py  # over the write budgets
+
+The built-in budgets were measured on the default synthetic stream (200 devices,
+10 minutes at 5s, devices starting 'ready', one reading per event or --batch 25,
+default seed and rollup batching) and are only checked on that stream. Per-reading
+counts depend on the stream's shape - readings per shower, devices per batch,
+stream records per rollup invocation - so for any other stream save a budget
+with --save-budget and check later runs of the same options with --budget.
+
+Recorded input is JSON lines of {"device_id", "temperature", "status", "timestamp"};
+unknown devices are provisioned with an active session automatically.
+
+Devices start in 'ready' - where add_device, STOP_HEATING and the previous
+shower leave them - unless --initial-status says otherwise. Synthetic runs
+also fail when a device that heated up to its target never got OPEN_VALVE.
+
+With ROLLUPS_MODE=stream (the default) the Telemetry/TelemetryChunks stream
+records are fed to process_telemetry.rollup_handler once per --rollup-window of
+replayed time, as the event source mapping's batching window does; those writes
+are reported as rollup_writes and rollup_write_units, apart from the ingest
+counts (operations and tables include both).
+
+Latency numbers include the stand-ins' own overhead and are only meaningful
+relative to another run on the same machine. Call counts are deterministic:
+the module's monotonic clock follows the replayed timestamps.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+sys.path.insert(0, TOOLS_DIR)
+
+# The lambdas build boto3 clients at import; no call ever reaches AWS
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('TRACING_ENABLED', 'false')
+
+from fakes import FakeDynamoDB, FakePublisher, create_project_tables, install  # noqa: E402
+
+# Per-reading budgets for the default synthetic stream (10 minutes at 5s per device);
+# a run fails when a metric exceeds its budget by more than --tolerance
+DEFAULT_BUDGETS = {
+    'single': {
+        'dynamodb_reads': 0.06,
+        'dynamodb_writes': 1.8,
+        'write_units': 1.8,
+        'iot_publishes': 0.0084,
+        'sns_publishes': 0.0084,
+        'rollup_writes': 0.19,
+        'rollup_write_units': 0.19
+    },
+    'batch': {
+        'dynamodb_reads': 0.06,
+        'dynamodb_writes': 0.9,
+        'write_units': 1.8,
+        'iot_publishes': 0.0084,
+        'sns_publishes': 0.0084,
+        'rollup_writes': 0.19,
+        'rollup_write_units': 0.19
+    }
+}
+
+# The stream DEFAULT_BUDGETS were measured on (argparse names and defaults)
+DEFAULT_STREAM = {
+    'devices': 200,
+    'minutes': 10,
+    'interval': 5,
+    'seed': 7,
+    'input': None,
+    'initial_status': 'ready',
+    'rollup_batch': 10000,
+    'rollup_window': 60
+}
+DEFAULT_BATCH_SIZES = (0, 25)
+
+START = datetime(2025, 1, 6, 6, 0, tzinfo=timezone.utc)
+
+
+class ReplayClock:
+    """Drop-in for the time module whose monotonic() follows the replayed readings"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+def iso(moment: datetime) -> str:
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def heating_curve(rng: random.Random, device_id: str, start: datetime, minutes: float,
+                  interval: float, target: float) -> list:
+    """
+    One shower: first-order heating from ambient towards a plateau above target,
+    'heating' until the backend opens the valve, then 'ready' while the water
+    runs and 'idle' while the pipe cools.
+    """
+    ambient = rng.uniform(14, 24)
+    plateau = target + rng.uniform(2, 6)
+    tau = rng.uniform(60, 240)
+    shower_seconds = rng.uniform(240, 600)
+    steps = int(minutes * 60 / interval)
+
+    readings = []
+    ready_at = None
+    temperature = ambient
+    for step in range(steps):
+        elapsed = step * interval
+        if ready_at is None or elapsed < ready_at + shower_seconds:
+            temperature = plateau - (plateau - ambient) * math.exp(-elapsed / tau)
+        else:
+            temperature = max(ambient, temperature - interval * 0.05)
+        temperature += rng.gauss(0, 0.15)
+
+        if ready_at is None and temperature >= target:
+            ready_at = elapsed + interval  # valve opens on the next cycle
+        if ready_at is None or elapsed < ready_at:
+            status = 'heating'
+        elif elapsed < ready_at + shower_seconds:
+            status = 'ready'
+        else:
+            status = 'idle'
+        readings.append({
+            'device_id': device_id,
+            'temperature': round(temperature, 1),
+            'status': status,
+            'timestamp': iso(start + timedelta(seconds=elapsed))
+        })
+    return readings
+
+
+def synthetic_stream(devices: int, minutes: float, interval: float, seed: int) -> tuple:
+    """Readings for `devices` showers with staggered starts, in timestamp order, plus targets"""
+    rng = random.Random(seed)
+    targets = {}
+    readings = []
+    for index in range(devices):
+        device_id = f"bench-{index:05d}"
+        targets[device_id] = rng.choice([36, 37, 38, 39, 40, 42])
+        start = START + timedelta(seconds=rng.uniform(0, 120))
+        readings.extend(heating_curve(rng, device_id, start, minutes, interval, targets[device_id]))
+    readings.sort(key=lambda r: r['timestamp'])
+    return readings, targets
+
+
+def provision(fake: FakeDynamoDB, readings: list, targets: dict, user_count: int,
+              initial_status: str = 'ready'):
+    """Users with SNS topics, and one device with an active session per device_id"""
+    users = fake.Table('EcoShower-Users')
+    devices = fake.Table('EcoShower-Devices')
+    sessions = fake.Table('EcoShower-Sessions')
+
+    first_seen = {}
+    for reading in readings:
+        first_seen.setdefault(reading['device_id'], reading['timestamp'])
+
+    for index in range(user_count):
+        users.put_item(Item={
+            'user_id': f"user-{index:04d}",
+            'sns_topic_arn': f"arn:aws:sns:us-east-1:000000000000:EcoShower-User-{index:04d}",
+            'system': {'language': 'en' if index % 2 else 'he', 'water_price_per_liter': '0.008'},
+            'notifications': {'water_ready_alert': True}
+        })
+
+    for index, (device_id, first_timestamp) in enumerate(sorted(first_seen.items())):
+        user_id = f"user-{index % user_count:04d}"
+        session_id = f"session-{device_id}"
+        start = datetime.fromisoformat(first_timestamp.replace('Z', '+00:00')) - timedelta(seconds=5)
+        devices.put_item(Item={
+            'device_id': device_id,
+            'user_id': user_id,
+            'name': f"Shower {index}",
+            'status': initial_status,
+            'target_temp': Decimal(str(targets.get(device_id, 38))),
+            'active_session_id': session_id,
+            'active_session_start': start.isoformat()
+        })
+        sessions.put_item(Item={
+            'session_id': session_id,
+            'device_id': device_id,
+            'user_id': user_id,
+            'status': 'active',
+            'start_time': start.isoformat(),
+            'target_temp': Decimal(str(targets.get(device_id, 38)))
+        })
+
+
+def expected_ready(readings: list, targets: dict) -> set:
+    """Devices with a 'heating' reading at or above their target - each must get OPEN_VALVE"""
+    return {r['device_id'] for r in readings
+            if r['status'] == 'heating' and r['device_id'] in targets
+            and r['temperature'] >= targets[r['device_id']]}
+
+
+def load_recorded(path: str) -> tuple:
+    readings = []
+    with open(path) as handle:
+        for line in handle:
+            line = line.strip()
+            if line:
+                readings.append(json.loads(line))
+    readings.sort(key=lambda r: r['timestamp'])
+    return readings, {}
+
+
+def epoch(timestamp: str) -> float:
+    return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class StreamDrain:
+    """
+    Plays Lambda's stream event source mapping: every --rollup-window seconds of
+    replayed time the recorded stream records go to rollup_handler in batches of
+    up to --rollup-batch, counting the writes apart from the ingest path's.
+    """
+
+    def __init__(self, pt, fake: FakeDynamoDB, window: float, batch_size: int):
+        self.pt = pt
+        self.fake = fake
+        self.window = window
+        self.batch_size = batch_size
+        self.next_at = window
+        self.invocations = 0
+        self.writes = 0
+        self.write_units = 0.0
+
+    def advance(self, now: float):
+        if now >= self.next_at:
+            self.drain()
+            self.next_at = now + self.window
+
+    def drain(self):
+        writes, units = self.fake.writes, self.fake.stats['write_units']
+        for event in self.fake.stream_events(self.batch_size):
+            self.pt.rollup_handler(event, None)
+            self.invocations += 1
+        self.writes += self.fake.writes - writes
+        self.write_units += self.fake.stats['write_units'] - units
+
+
+def replay(pt, readings: list, batch: int, clock: ReplayClock, verbose: bool,
+           drain: StreamDrain = None) -> list:
+    """Feed readings to the handler; returns per-invocation latencies in seconds"""
+    invocations = ([readings[i:i + batch] for i in range(0, len(readings), batch)]
+                   if batch else readings)
+    base = epoch(readings[0]['timestamp']) if readings else 0.0
+    sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    latencies = []
+    with sink as captured:
+        for event in invocations:
+            last = event[-1] if batch else event
+            clock.now = epoch(last['timestamp']) - base
+            if drain is not None:
+                drain.advance(clock.now)
+            started = time.perf_counter()
+            pt.lambda_handler(event, None)
+            latencies.append(time.perf_counter() - started)
+            if captured is not None:
+                # Keep memory flat - handler output is not inspected
+                captured.seek(0)
+                captured.truncate()
+        if drain is not None:
+            drain.drain()
+    return latencies
+
+
+def run(args) -> dict:
+    import aws_clients
+    import process_telemetry as pt
+
+    fake = create_project_tables(FakeDynamoDB())
+    iot = FakePublisher('iot')
+    sns = FakePublisher('sns')
+    install(pt, fake, {'iot_client': iot, 'sns_client': sns})
+    clock = ReplayClock()
+    # The module's timings and its caches' expiry (aws_clients.TTLCache) follow the replay
+    pt.time = clock
+    aws_clients.time = clock
+
+    if args.input:
+        readings, targets = load_recorded(args.input)
+    else:
+        readings, targets = synthetic_stream(args.devices, args.minutes, args.interval, args.seed)
+    provision(fake, readings, targets, max(1, len(set(r['device_id'] for r in readings)) // 2),
+              args.initial_status)
+    drain = None
+    if pt.ROLLUPS_MODE == 'stream':
+        fake.enable_stream(pt.TELEMETRY_TABLE, pt.TELEMETRY_CHUNKS_TABLE)
+        drain = StreamDrain(pt, fake, args.rollup_window, args.rollup_batch)
+    fake.reset_stats()
+
+    started = time.perf_counter()
+    latencies = replay(pt, readings, args.batch, clock, args.verbose, drain)
+    elapsed = time.perf_counter() - started
+
+    count = max(len(readings), 1)
+    rollup_writes = drain.writes if drain else 0
+    rollup_units = drain.write_units if drain else 0.0
+    per_reading = {
+        'dynamodb_reads': round(fake.reads / count, 4),
+        'dynamodb_writes': round((fake.writes - rollup_writes) / count, 4),
+        'read_units': round(fake.stats['read_units'] / count, 4),
+        'write_units': round((fake.stats['write_units'] - rollup_units) / count, 4),
+        'iot_publishes': round(len(iot.published) / count, 4),
+        'sns_publishes': round(len(sns.published) / count, 4)
+    }
+    if drain is not None:
+        per_reading['rollup_writes'] = round(rollup_writes / count, 4)
+        per_reading['rollup_write_units'] = round(rollup_units / count, 4)
+    opened = {publish['topic'].split('/')[1] for publish in iot.published
+              if json.loads(publish['payload'])['command'] == 'OPEN_VALVE'}
+    return {
+        'mode': 'batch' if args.batch else 'single',
+        'initial_status': args.initial_status,
+        'readings': len(readings),
+        'missed_ready': sorted(expected_ready(readings, targets) - opened),
+        'invocations': len(latencies),
+        'elapsed_seconds': round(elapsed, 3),
+        'readings_per_second': round(len(readings) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(max(latencies, default=0) * 1000, 3)
+        },
+        'rollups': pt.ROLLUPS_MODE,
+        'rollup_invocations': drain.invocations if drain else 0,
+        'per_reading': per_reading,
+        'operations': {op: n for op, n in sorted(fake.stats.items()) if not op.endswith('_units')},
+        'tables': {name: {op: round(n, 2) for op, n in sorted(stats.items())}
+                   for name, stats in fake.table_stats.items() if stats}
+    }
+
+
+def is_default_stream(args) -> bool:
+    """True when the run replays the stream the built-in budgets were measured on"""
+    return (args.batch in DEFAULT_BATCH_SIZES
+            and all(getattr(args, name) == value for name, value in DEFAULT_STREAM.items()))
+
+
+def check_budgets(result: dict, budgets: dict, tolerance: float) -> list:
+    failures = []
+    if result['missed_ready']:
+        failures.append(f"{len(result['missed_ready'])} devices reached their target without OPEN_VALVE")
+    for metric, budget in budgets.get(result['mode'], {}).items():
+        actual = result['per_reading'].get(metric)
+        if actual is not None and actual > budget * (1 + tolerance):
+            failures.append(f"{metric}: {actual} per reading exceeds budget {budget}")
+    return failures
+
+
+def print_report(result: dict):
+    print(f"Mode:             {result['mode']} ({result['invocations']} invocations)")
+    print(f"Devices start:    {result['initial_status']}")
+    print(f"Rollups:          {result['rollups']} ({result['rollup_invocations']} stream invocations)")
+    print(f"Readings:         {result['readings']}")
+    print(f"Throughput:       {result['readings_per_second']} readings/s")
+    latency = result['latency_ms']
+    print(f"Handler latency:  p50 {latency['p50']} ms, p99 {latency['p99']} ms, max {latency['max']} ms")
+    print("Per reading:")
+    for metric, value in result['per_reading'].items():
+        print(f"  {metric:<18}{value}")
+    print("Operations:")
+    for op, n in result['operations'].items():
+        print(f"  {op:<18}{n}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=200, help='synthetic devices (one shower each)')
+    parser.add_argument('--minutes', type=float, default=10, help='minutes of telemetry per device')
+    parser.add_argument('--interval', type=float, default=5, help='seconds between readings')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--input', help='replay recorded readings (JSON lines) instead')
+    parser.add_argument('--initial-status', default='ready', choices=['ready', 'heating', 'idle'],
+                        help='stored device status before the first reading')
+    parser.add_argument('--batch', type=int, default=0, help='readings per invocation (0 = one reading per event)')
+    parser.add_argument('--rollup-batch', type=int, default=10000,
+                        help='most stream records per rollup_handler invocation (ROLLUPS_MODE=stream)')
+    parser.add_argument('--rollup-window', type=float, default=60,
+                        help='replayed seconds between rollup_handler invocations (the batching window)')
+    parser.add_argument('--budget', help='JSON file with per-reading budgets by mode, checked on any stream '
+                                         '(the built-in ones only on the default stream)')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='allowed relative overrun of a budget')
+    parser.add_argument('--save-budget', help='write this run\'s per-reading counts as the budget file')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show handler output')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+    if args.save_budget:
+        budgets = {}
+        if os.path.exists(args.save_budget):
+            with open(args.save_budget) as handle:
+                budgets = json.load(handle)
+        budgets[result['mode']] = {metric: result['per_reading'][metric]
+                                   for metric in DEFAULT_BUDGETS[result['mode']]
+                                   if metric in result['per_reading']}
+        with open(args.save_budget, 'w') as handle:
+            json.dump(budgets, handle, indent=2)
+        print(f"Saved {result['mode']} budget to {args.save_budget}", file=sys.stderr)
+        return 0
+
+    if args.budget:
+        with open(args.budget) as handle:
+            budgets = json.load(handle)
+    elif is_default_stream(args):
+        budgets = DEFAULT_BUDGETS
+    else:
+        budgets = {}
+        print("Built-in budgets not checked - they only apply to the default stream (see --help)",
+              file=sys.stderr)
+    failures = check_budgets(result, budgets, args.tolerance)
+    for failure in failures:
+        print(f"BUDGET EXCEEDED - {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
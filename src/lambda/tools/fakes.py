@@ -0,0 +1,993 @@
+"""
+EcoShower - In-memory AWS stand-ins for local benchmarks and tools
+
+FakeDynamoDB mimics the parts of the boto3 DynamoDB *resource* API the lambdas
+use (Table get/put/update/delete/query/scan/batch_writer, batch_write_item, batch_get_item),
+including a small expression evaluator for Update/Condition/Key/Filter/Projection
+expressions. It enforces the behaviour that tends to bite in production:
+conditional check failures, reserved attribute names, Decimal-only numbers,
+duplicate keys in a batch, 25-item batches, overlapping update paths, missing
+parent maps on nested SET, the 400 KB item limit and 1 MB query/scan pages.
+
+Tables can record DynamoDB Streams records (enable_stream / stream_events) so
+stream consumers such as stats_materializer run against the same writes.
+
+FakePublisher stands in for the IoT data-plane and SNS clients.
+
+Every call is counted (FakeDynamoDB.stats / FakePublisher.published) so the
+benchmarks can report calls and estimated capacity units per reading.
+"""
+
+import copy
+import math
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+from functools import lru_cache
+
+from boto3.dynamodb.conditions import ConditionBase, ConditionExpressionBuilder
+from boto3.dynamodb.types import Binary, TypeSerializer
+from botocore.exceptions import ClientError
+
+MAX_ITEM_BYTES = 400 * 1024
+MAX_PAGE_BYTES = 1024 * 1024
+BATCH_WRITE_LIMIT = 25
+BATCH_GET_LIMIT = 100
+
+# A subset of DynamoDB's reserved words - the ones this project's attribute names
+# are likely to collide with. Using them unescaped fails exactly as in AWS.
+RESERVED_WORDS = {
+    'BUCKET', 'CONNECTION', 'COUNT', 'DATA', 'DATE', 'DAY', 'DURATION', 'HOUR',
+    'KEY', 'LEVEL', 'LIMIT', 'MINUTE', 'MONTH', 'NAME', 'ROLE', 'SEGMENTS',
+    'SESSION', 'SIZE', 'STATUS', 'TIME', 'TIMESTAMP', 'TOTAL', 'TTL', 'TYPE',
+    'USER', 'VALUE', 'VALUES', 'YEAR', 'ZONE'
+}
+
+_MISSING = object()
+
+
+def client_error(code: str, message: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def validation_error(message: str, operation: str) -> ClientError:
+    return client_error('ValidationException', message, operation)
+
+
+# ============= VALUES =============
+
+def to_storage(value):
+    """Convert a Python value the way boto3's TypeSerializer would accept it"""
+    if isinstance(value, bool) or value is None or isinstance(value, (str, Decimal, Binary)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, (bytes, bytearray)):
+        return Binary(bytes(value))
+    if isinstance(value, dict):
+        return {k: to_storage(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_storage(v) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return {to_storage(v) for v in value}
+    raise TypeError(f"Unsupported type {type(value)} for value {value!r}")
+
+
+def value_size(value) -> int:
+    """Approximate DynamoDB attribute size in bytes"""
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, Decimal):
+        return len(value.as_tuple().digits) // 2 + 2
+    if isinstance(value, Binary):
+        return len(value.value)
+    if isinstance(value, dict):
+        return 3 + sum(len(k) + value_size(v) + 1 for k, v in value.items())
+    if isinstance(value, (list, set)):
+        return 3 + sum(value_size(v) + 1 for v in value)
+    return 1
+
+
+def item_size(item: dict) -> int:
+    return sum(len(name.encode('utf-8')) + value_size(value) for name, value in item.items())
+
+
+def read_units(size: int, consistent: bool = False) -> float:
+    units = max(1, math.ceil(size / 4096))
+    return float(units if consistent else units / 2)
+
+
+def write_units(size: int) -> float:
+    return float(max(1, math.ceil(size / 1024)))
+
+
+def _comparable(a, b) -> bool:
+    if isinstance(a, Decimal) and isinstance(b, Decimal):
+        return True
+    return type(a) is type(b) and isinstance(a, (str, Binary))
+
+
+def _sort_value(value):
+    return value.value if isinstance(value, Binary) else value
+
+
+# ============= EXPRESSIONS =============
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<op><>|<=|>=|=|<|>)
+      | (?P<punct>[(),+\-])
+      | (?P<value>:[A-Za-z0-9_]+)
+      | (?P<path>\#?[A-Za-z_][A-Za-z0-9_]*(?:\[\d+\])*(?:\.\#?[A-Za-z_][A-Za-z0-9_]*(?:\[\d+\])*)*)
+    )""", re.VERBOSE)
+
+_KEYWORDS = {'AND', 'OR', 'NOT', 'BETWEEN', 'IN', 'SET', 'REMOVE', 'ADD', 'DELETE'}
+_FUNCTIONS = {'attribute_exists', 'attribute_not_exists', 'attribute_type', 'begins_with',
+              'contains', 'size', 'if_not_exists', 'list_append'}
+
+
+def _tokenize(expression: str) -> list:
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _TOKEN_RE.match(expression, pos)
+        if not match or match.end() == pos:
+            raise ValueError(f"Invalid expression near: {expression[pos:]!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'path' and text.upper() in _KEYWORDS:
+            tokens.append(('kw', text.upper()))
+        elif kind == 'path' and text in _FUNCTIONS and expression[pos:].lstrip().startswith('('):
+            tokens.append(('func', text))
+        else:
+            tokens.append((kind, text))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, expression: str):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def peek(self, offset: int = 0):
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, text=None):
+        token = self.peek()
+        if (kind and token[0] != kind) or (text and token[1] != text):
+            raise ValueError(f"Expected {text or kind}, got {token[1]!r}")
+        self.pos += 1
+        return token
+
+    def accept(self, kind, text=None) -> bool:
+        token = self.peek()
+        if token[0] == kind and (text is None or token[1] == text):
+            self.pos += 1
+            return True
+        return False
+
+    def done(self) -> bool:
+        return self.pos >= len(self.tokens)
+
+    # Conditions: or -> and -> not -> primary
+    def condition(self):
+        node = self.conjunction()
+        while self.accept('kw', 'OR'):
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.accept('kw', 'AND'):
+            node = ('and', node, self.negation())
+        return node
+
+    def negation(self):
+        if self.accept('kw', 'NOT'):
+            return ('not', self.negation())
+        return self.primary()
+
+    def primary(self):
+        if self.accept('punct', '('):
+            node = self.condition()
+            self.take('punct', ')')
+            return node
+        kind, text = self.peek()
+        if kind == 'func' and text != 'size':
+            return self.function()
+        left = self.operand()
+        kind, text = self.peek()
+        if kind == 'op':
+            self.pos += 1
+            return ('cmp', text, left, self.operand())
+        if kind == 'kw' and text == 'BETWEEN':
+            self.pos += 1
+            low = self.operand()
+            self.take('kw', 'AND')
+            return ('between', left, low, self.operand())
+        if kind == 'kw' and text == 'IN':
+            self.pos += 1
+            self.take('punct', '(')
+            options = [self.operand()]
+            while self.accept('punct', ','):
+                options.append(self.operand())
+            self.take('punct', ')')
+            return ('in', left, options)
+        raise ValueError(f"Expected a comparison after {left!r}")
+
+    def function(self):
+        _, name = self.take('func')
+        self.take('punct', '(')
+        args = [self.value_expression()]
+        while self.accept('punct', ','):
+            args.append(self.value_expression())
+        self.take('punct', ')')
+        return ('func', name, args)
+
+    def operand(self):
+        kind, text = self.peek()
+        if kind == 'value':
+            self.pos += 1
+            return ('value', text)
+        if kind == 'path':
+            self.pos += 1
+            return ('path', text)
+        if kind == 'func':
+            return self.function()
+        raise ValueError(f"Expected an operand, got {text!r}")
+
+    def value_expression(self):
+        node = self.operand()
+        while self.peek() in (('punct', '+'), ('punct', '-')):
+            _, op = self.take('punct')
+            node = ('arith', op, node, self.operand())
+        return node
+
+    def update(self):
+        actions = []
+        while not self.done():
+            _, clause = self.take('kw')
+            while True:
+                path = self.take('path')[1]
+                if clause == 'SET':
+                    self.take('op', '=')
+                    actions.append(('SET', path, self.value_expression()))
+                elif clause == 'REMOVE':
+                    actions.append(('REMOVE', path, None))
+                else:
+                    actions.append((clause, path, self.operand()))
+                if not self.accept('punct', ','):
+                    break
+        return actions
+
+
+@lru_cache(maxsize=4096)
+def parse_condition(expression: str):
+    parser = _Parser(expression)
+    node = parser.condition()
+    if not parser.done():
+        raise ValueError(f"Unexpected {parser.peek()[1]!r} in {expression!r}")
+    return node
+
+
+@lru_cache(maxsize=4096)
+def parse_update(expression: str):
+    return _Parser(expression).update()
+
+
+@lru_cache(maxsize=4096)
+def parse_projection(expression: str):
+    return [path.strip() for path in expression.split(',')]
+
+
+class _Context:
+    """Placeholder substitution and path access for one request"""
+
+    def __init__(self, names: dict, values: dict, operation: str):
+        self.names = names or {}
+        self.values = values or {}
+        self.operation = operation
+
+    def resolve(self, path: str) -> list:
+        parts = []
+        for raw in path.split('.'):
+            name, *indexes = raw.split('[')
+            if name.startswith('#'):
+                if name not in self.names:
+                    raise validation_error(f"An expression attribute name used in the document path is not defined; attribute name: {name}", self.operation)
+                name = self.names[name]
+            elif name.upper() in RESERVED_WORDS:
+                raise validation_error(f"Attribute name is a reserved keyword; reserved keyword: {name}", self.operation)
+            parts.append(name)
+            parts.extend(int(index.rstrip(']')) for index in indexes)
+        return parts
+
+    def value(self, placeholder: str):
+        if placeholder not in self.values:
+            raise validation_error(f"An expression attribute value used in expression is not defined; attribute value: {placeholder}", self.operation)
+        return self.values[placeholder]
+
+    @staticmethod
+    def get(item: dict, parts: list):
+        current = item
+        for part in parts:
+            if isinstance(part, int):
+                if not isinstance(current, list) or part >= len(current):
+                    return _MISSING
+                current = current[part]
+            else:
+                if not isinstance(current, dict) or part not in current:
+                    return _MISSING
+                current = current[part]
+        return current
+
+    def evaluate(self, node, item: dict):
+        kind = node[0]
+        if kind == 'and':
+            return self.evaluate(node[1], item) and self.evaluate(node[2], item)
+        if kind == 'or':
+            return self.evaluate(node[1], item) or self.evaluate(node[2], item)
+        if kind == 'not':
+            return not self.evaluate(node[1], item)
+        if kind == 'cmp':
+            left = self.operand(node[2], item)
+            right = self.operand(node[3], item)
+            op = node[1]
+            if left is _MISSING or right is _MISSING:
+                # Comparisons against a missing attribute are false, even <>
+                return False
+            if op == '=':
+                return left == right
+            if op == '<>':
+                return left != right
+            if not _comparable(left, right):
+                return False
+            left, right = _sort_value(left), _sort_value(right)
+            return {'<': left < right, '<=': left <= right,
+                    '>': left > right, '>=': left >= right}[op]
+        if kind == 'between':
+            value = self.operand(node[1], item)
+            low = self.operand(node[2], item)
+            high = self.operand(node[3], item)
+            if value is _MISSING or not (_comparable(value, low) and _comparable(value, high)):
+                return False
+            return _sort_value(low) <= _sort_value(value) <= _sort_value(high)
+        if kind == 'in':
+            value = self.operand(node[1], item)
+            return value is not _MISSING and any(value == self.operand(o, item) for o in node[2])
+        if kind == 'func':
+            return self.function(node, item)
+        raise ValueError(f"Not a condition: {node!r}")
+
+    def function(self, node, item: dict):
+        _, name, args = node
+        if name in ('attribute_exists', 'attribute_not_exists'):
+            exists = self.get(item, self.resolve(args[0][1])) is not _MISSING
+            return exists if name == 'attribute_exists' else not exists
+        if name == 'begins_with':
+            value = self.operand(args[0], item)
+            prefix = self.operand(args[1], item)
+            return isinstance(value, str) and isinstance(prefix, str) and value.startswith(prefix)
+        if name == 'contains':
+            value = self.operand(args[0], item)
+            needle = self.operand(args[1], item)
+            return value is not _MISSING and needle in value
+        if name == 'attribute_type':
+            return False
+        if name == 'size':
+            value = self.operand(args[0], item)
+            if value is _MISSING:
+                return _MISSING
+            if isinstance(value, Binary):
+                return Decimal(len(value.value))
+            if isinstance(value, str):
+                return Decimal(len(value.encode('utf-8')))
+            return Decimal(len(value))
+        if name == 'if_not_exists':
+            existing = self.get(item, self.resolve(args[0][1]))
+            return existing if existing is not _MISSING else self.operand(args[1], item)
+        if name == 'list_append':
+            first = self.operand(args[0], item)
+            second = self.operand(args[1], item)
+            if not isinstance(first, list) or not isinstance(second, list):
+                raise validation_error("Invalid UpdateExpression: Incorrect operand type for operator or function; operator or function: list_append", self.operation)
+            return first + second
+        raise ValueError(f"Unsupported function {name}")
+
+    def operand(self, node, item: dict):
+        kind = node[0]
+        if kind == 'value':
+            return self.value(node[1])
+        if kind == 'path':
+            return self.get(item, self.resolve(node[1]))
+        if kind == 'func':
+            return self.function(node, item)
+        if kind == 'arith':
+            left = self.operand(node[2], item)
+            right = self.operand(node[3], item)
+            if left is _MISSING or right is _MISSING:
+                raise validation_error("The provided expression refers to an attribute that does not exist in the item", self.operation)
+            if not (isinstance(left, Decimal) and isinstance(right, Decimal)):
+                raise validation_error("An operand in the update expression has an incorrect data type", self.operation)
+            return left + right if node[1] == '+' else left - right
+        raise ValueError(f"Not an operand: {node!r}")
+
+    def apply_update(self, actions: list, item: dict, key_names: tuple) -> dict:
+        """Return the updated copy of item (all right-hand sides see the old item)"""
+        resolved = []
+        for clause, path, operand in actions:
+            parts = self.resolve(path)
+            if parts[0] in key_names:
+                raise validation_error(f"One or more parameter values were invalid: Cannot update attribute {parts[0]}. This attribute is part of the key", self.operation)
+            value = None if clause == 'REMOVE' else self.operand(operand, item)
+            resolved.append((clause, parts, value))
+
+        paths = [tuple(parts) for _, parts, _ in resolved]
+        for i, first in enumerate(paths):
+            for second in paths[i + 1:]:
+                shorter = min(len(first), len(second))
+                if first[:shorter] == second[:shorter]:
+                    raise validation_error(f"Invalid UpdateExpression: Two document paths overlap with each other; must remove or rewrite one of these paths; path one: {list(first)}, path two: {list(second)}", self.operation)
+
+        updated = copy.deepcopy(item)
+        for clause, parts, value in resolved:
+            parent = self.get(updated, parts[:-1]) if len(parts) > 1 else updated
+            leaf = parts[-1]
+            if parent is _MISSING or not isinstance(parent, (dict, list)):
+                if clause == 'REMOVE':
+                    continue
+                raise validation_error("The document path provided in the update expression is invalid for update", self.operation)
+            current = parent.get(leaf, _MISSING) if isinstance(parent, dict) else (
+                parent[leaf] if leaf < len(parent) else _MISSING)
+
+            if clause == 'SET':
+                new_value = copy.deepcopy(value)
+            elif clause == 'REMOVE':
+                if current is not _MISSING:
+                    del parent[leaf]
+                continue
+            elif clause == 'ADD':
+                if isinstance(value, Decimal):
+                    if current is not _MISSING and not isinstance(current, Decimal):
+                        raise validation_error("An operand in the update expression has an incorrect data type", self.operation)
+                    new_value = (current if current is not _MISSING else Decimal(0)) + value
+                elif isinstance(value, set):
+                    new_value = (set(current) if current is not _MISSING else set()) | value
+                else:
+                    raise validation_error("Incorrect operand type for operator or function; operator: ADD", self.operation)
+            else:  # DELETE
+                if current is _MISSING:
+                    continue
+                new_value = set(current) - value
+                if not new_value:
+                    del parent[leaf]
+                    continue
+
+            if isinstance(parent, dict):
+                parent[leaf] = new_value
+            elif leaf < len(parent):
+                parent[leaf] = new_value
+            else:
+                parent.append(new_value)
+        return updated
+
+
+def project(item: dict, expression: str, names: dict) -> dict:
+    """Apply a ProjectionExpression (top-level attributes and nested map paths)"""
+    ctx = _Context(names, {}, 'Projection')
+    result = {}
+    for path in parse_projection(expression):
+        parts = ctx.resolve(path)
+        value = ctx.get(item, parts)
+        if value is _MISSING:
+            continue
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = copy.deepcopy(value)
+    return result
+
+
+# ============= TABLES =============
+
+_PLACEHOLDER_RE = re.compile(r'[#:][A-Za-z0-9_]+')
+_EXPRESSION_ARGS = ('UpdateExpression', 'ConditionExpression', 'KeyConditionExpression',
+                    'FilterExpression', 'ProjectionExpression')
+
+
+def check_placeholders(kwargs: dict, operation: str):
+    """DynamoDB rejects ExpressionAttributeNames/Values that no expression uses"""
+    used = set()
+    for arg in _EXPRESSION_ARGS:
+        expression = kwargs.get(arg)
+        if isinstance(expression, str):
+            used.update(_PLACEHOLDER_RE.findall(expression))
+    for arg, kind in (('ExpressionAttributeNames', 'names'), ('ExpressionAttributeValues', 'values')):
+        unused = set(kwargs.get(arg) or {}) - used
+        if unused and not any(isinstance(kwargs.get(a), ConditionBase) for a in _EXPRESSION_ARGS):
+            raise validation_error(f"Value provided in ExpressionAttribute{kind.capitalize()} unused in expressions: keys: {{{', '.join(sorted(unused))}}}", operation)
+
+
+class FakeTable:
+    """One in-memory table with optional global secondary indexes"""
+
+    def __init__(self, resource, name: str, hash_key: str, range_key: str = None,
+                 indexes: dict = None):
+        self.resource = resource
+        self.name = self.table_name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        # index name -> (hash_key, range_key or None)
+        self.indexes = indexes or {}
+        self.items = {}
+        self.lock = threading.RLock()
+        # Stream records (NEW_AND_OLD_IMAGES) when enabled, see FakeDynamoDB.enable_stream
+        self.stream = None
+
+    @property
+    def key_names(self) -> tuple:
+        return (self.hash_key, self.range_key) if self.range_key else (self.hash_key,)
+
+    def _key_of(self, item: dict, operation: str) -> tuple:
+        try:
+            return tuple(item[name] for name in self.key_names)
+        except KeyError:
+            raise validation_error("One or more parameter values were invalid: Missing the key in the item", operation)
+
+    def _check_key(self, key: dict, operation: str) -> tuple:
+        if set(key) != set(self.key_names):
+            raise validation_error("The provided key element does not match the schema", operation)
+        return self._key_of(key, operation)
+
+    def _count(self, operation: str, read: float = 0.0, write: float = 0.0):
+        self.resource.record(self.name, operation, read, write)
+
+    def _emit(self, key: tuple, old: dict, new: dict):
+        """Append a stream record; like DynamoDB, writes that change nothing emit none"""
+        if self.stream is None or old == new:
+            return
+        serializer = TypeSerializer()
+        record = {
+            'eventID': uuid.uuid4().hex,
+            'eventName': 'INSERT' if old is None else 'REMOVE' if new is None else 'MODIFY',
+            'eventSource': 'aws:dynamodb',
+            'eventSourceARN': f"arn:aws:dynamodb:local:000000000000:table/{self.name}/stream/fake",
+            'dynamodb': {
+                'Keys': {name: serializer.serialize(value) for name, value in zip(self.key_names, key)},
+                'SequenceNumber': self.resource.next_sequence_number(),
+                'StreamViewType': 'NEW_AND_OLD_IMAGES'
+            }
+        }
+        if old is not None:
+            record['dynamodb']['OldImage'] = {k: serializer.serialize(v) for k, v in old.items()}
+        if new is not None:
+            record['dynamodb']['NewImage'] = {k: serializer.serialize(v) for k, v in new.items()}
+        self.stream.append(record)
+
+    def _capacity(self, kwargs: dict, units: float, response: dict) -> dict:
+        if kwargs.get('ReturnConsumedCapacity') in ('TOTAL', 'INDEXES'):
+            response['ConsumedCapacity'] = {'TableName': self.name, 'CapacityUnits': units}
+        return response
+
+    def _check_condition(self, kwargs: dict, item: dict, operation: str):
+        expression = kwargs.get('ConditionExpression')
+        if expression is None:
+            return
+        if isinstance(expression, ConditionBase):
+            built = ConditionExpressionBuilder().build_expression(expression)
+            expression = built.condition_expression
+            kwargs = {**kwargs,
+                      'ExpressionAttributeNames': {**kwargs.get('ExpressionAttributeNames', {}), **built.attribute_name_placeholders},
+                      'ExpressionAttributeValues': {**kwargs.get('ExpressionAttributeValues', {}), **built.attribute_value_placeholders}}
+        ctx = _Context(kwargs.get('ExpressionAttributeNames'),
+                       to_storage(kwargs.get('ExpressionAttributeValues', {})), operation)
+        if not ctx.evaluate(parse_condition(expression), item):
+            raise client_error('ConditionalCheckFailedException', 'The conditional request failed', operation)
+
+    def _returned(self, kwargs: dict, old: dict, new: dict) -> dict:
+        mode = kwargs.get('ReturnValues', 'NONE')
+        if mode == 'ALL_OLD' and old:
+            return {'Attributes': copy.deepcopy(old)}
+        if mode in ('ALL_NEW', 'UPDATED_NEW') and new is not None:
+            return {'Attributes': copy.deepcopy(new)}
+        if mode == 'UPDATED_OLD' and old:
+            return {'Attributes': copy.deepcopy(old)}
+        return {}
+
+    def get_item(self, Key, ConsistentRead=False, ProjectionExpression=None,
+                 ExpressionAttributeNames=None, **kwargs):
+        check_placeholders({'ProjectionExpression': ProjectionExpression,
+                            'ExpressionAttributeNames': ExpressionAttributeNames}, 'GetItem')
+        with self.lock:
+            item = self.items.get(self._check_key(Key, 'GetItem'))
+            size = item_size(item) if item else 0
+            self._count('get_item', read=read_units(size, ConsistentRead))
+            response = {}
+            if item is not None:
+                response['Item'] = (project(item, ProjectionExpression, ExpressionAttributeNames)
+                                    if ProjectionExpression else copy.deepcopy(item))
+            return self._capacity(kwargs, read_units(size, ConsistentRead), response)
+
+    def put_item(self, Item, **kwargs):
+        check_placeholders(kwargs, 'PutItem')
+        with self.lock:
+            item = to_storage(Item)
+            key = self._key_of(item, 'PutItem')
+            size = item_size(item)
+            if size > MAX_ITEM_BYTES:
+                raise validation_error("Item size has exceeded the maximum allowed size", 'PutItem')
+            old = self.items.get(key)
+            self._check_condition(kwargs, old or {}, 'PutItem')
+            self.items[key] = item
+            self._emit(key, old, item)
+            units = write_units(max(size, item_size(old) if old else 0))
+            self._count('put_item', write=units)
+            return self._capacity(kwargs, units, self._returned(kwargs, old, None))
+
+    def update_item(self, Key, UpdateExpression=None, **kwargs):
+        check_placeholders({**kwargs, 'UpdateExpression': UpdateExpression}, 'UpdateItem')
+        with self.lock:
+            key = self._check_key(Key, 'UpdateItem')
+            old = self.items.get(key)
+            base = old or to_storage(dict(Key))
+            self._check_condition(kwargs, old or {}, 'UpdateItem')
+            ctx = _Context(kwargs.get('ExpressionAttributeNames'),
+                           to_storage(kwargs.get('ExpressionAttributeValues', {})), 'UpdateItem')
+            new = ctx.apply_update(parse_update(UpdateExpression), base, self.key_names) if UpdateExpression else copy.deepcopy(base)
+            size = item_size(new)
+            if size > MAX_ITEM_BYTES:
+                raise validation_error("Item size to update has exceeded the maximum allowed size", 'UpdateItem')
+            self.items[key] = new
+            self._emit(key, old, new)
+            units = write_units(max(size, item_size(old) if old else 0))
+            self._count('update_item', write=units)
+            return self._capacity(kwargs, units, self._returned(kwargs, old, new))
+
+    def delete_item(self, Key, **kwargs):
+        check_placeholders(kwargs, 'DeleteItem')
+        with self.lock:
+            key = self._check_key(Key, 'DeleteItem')
+            old = self.items.get(key)
+            self._check_condition(kwargs, old or {}, 'DeleteItem')
+            self.items.pop(key, None)
+            if old is not None:
+                self._emit(key, old, None)
+            units = write_units(item_size(old) if old else 0)
+            self._count('delete_item', write=units)
+            return self._capacity(kwargs, units, self._returned(kwargs, old, None))
+
+    def batch_writer(self):
+        """Buffers puts/deletes into 25-item batch_write_item calls, like boto3's BatchWriter"""
+        return _FakeBatchWriter(self)
+
+    def _expressions(self, kwargs: dict, operation: str):
+        """Build string key/filter conditions (boto3 condition objects allowed) and a context"""
+        builder = ConditionExpressionBuilder()
+        names = dict(kwargs.get('ExpressionAttributeNames') or {})
+        values = dict(kwargs.get('ExpressionAttributeValues') or {})
+        built = {}
+        for arg, is_key in (('KeyConditionExpression', True), ('FilterExpression', False)):
+            expression = kwargs.get(arg)
+            if isinstance(expression, ConditionBase):
+                result = builder.build_expression(expression, is_key_condition=is_key)
+                names.update(result.attribute_name_placeholders)
+                values.update(result.attribute_value_placeholders)
+                expression = result.condition_expression
+            built[arg] = parse_condition(expression) if expression else None
+        return built, _Context(names, to_storage(values), operation)
+
+    def _read(self, operation: str, candidates: list, kwargs: dict, ctx: _Context, filter_node,
+              key_names: tuple) -> dict:
+        """Apply ExclusiveStartKey, Limit, filter, projection and Select to sorted candidates"""
+        start_key = kwargs.get('ExclusiveStartKey')
+        if start_key:
+            start = to_storage(start_key)
+            primary = tuple(start[name] for name in self.key_names)
+            for position, item in enumerate(candidates):
+                if tuple(item[name] for name in self.key_names) == primary:
+                    candidates = candidates[position + 1:]
+                    break
+
+        limit = kwargs.get('Limit')
+        scanned = candidates[:limit] if limit else candidates
+        # A page also ends once 1 MB of items has been read
+        page_bytes = 0
+        for position, item in enumerate(scanned):
+            page_bytes += item_size(item)
+            if page_bytes >= MAX_PAGE_BYTES:
+                scanned = scanned[:position + 1]
+                break
+        last_key = None
+        if len(candidates) > len(scanned) and scanned:
+            last_key = {name: scanned[-1][name] for name in key_names if name in scanned[-1]}
+
+        consistent = kwargs.get('ConsistentRead', False)
+        units = read_units(sum(item_size(item) for item in scanned), consistent)
+        self._count(operation, read=units)
+
+        matched = [item for item in scanned if filter_node is None or ctx.evaluate(filter_node, item)]
+        response = {'Count': len(matched), 'ScannedCount': len(scanned)}
+        if kwargs.get('Select') != 'COUNT':
+            projection = kwargs.get('ProjectionExpression')
+            response['Items'] = [
+                project(item, projection, ctx.names) if projection else copy.deepcopy(item)
+                for item in matched
+            ]
+        if last_key:
+            response['LastEvaluatedKey'] = copy.deepcopy(last_key)
+        return self._capacity(kwargs, units, response)
+
+    def query(self, **kwargs):
+        check_placeholders(kwargs, 'Query')
+        with self.lock:
+            nodes, ctx = self._expressions(kwargs, 'Query')
+            index = kwargs.get('IndexName')
+            if index:
+                if index not in self.indexes:
+                    raise validation_error(f"The table does not have the specified index: {index}", 'Query')
+                hash_key, range_key = self.indexes[index]
+            else:
+                hash_key, range_key = self.hash_key, self.range_key
+            if nodes['KeyConditionExpression'] is None:
+                raise validation_error("Either the KeyConditions or KeyConditionExpression parameter must be specified in the request", 'Query')
+
+            candidates = [
+                item for item in self.items.values()
+                if hash_key in item and (not index or not range_key or range_key in item)
+                and ctx.evaluate(nodes['KeyConditionExpression'], item)
+            ]
+            sort_names = ((range_key,) if range_key else ()) + self.key_names
+            candidates.sort(key=lambda item: tuple(_sort_value(item[name]) for name in sort_names),
+                            reverse=not kwargs.get('ScanIndexForward', True))
+            key_names = tuple(dict.fromkeys(self.key_names + (hash_key,) + ((range_key,) if range_key else ())))
+            return self._read('query', candidates, kwargs, ctx, nodes['FilterExpression'], key_names)
+
+    def scan(self, **kwargs):
+        check_placeholders(kwargs, 'Scan')
+        with self.lock:
+            nodes, ctx = self._expressions(kwargs, 'Scan')
+            candidates = sorted(self.items.values(),
+                                key=lambda item: tuple(_sort_value(item[name]) for name in self.key_names))
+            total = kwargs.get('TotalSegments')
+            if total:
+                segment = kwargs.get('Segment', 0)
+                candidates = [item for item in candidates
+                              if hash(str(item[self.hash_key])) % total == segment]
+            return self._read('scan', candidates, kwargs, ctx, nodes['FilterExpression'], self.key_names)
+
+
+class _FakeBatchWriter:
+    def __init__(self, table: FakeTable):
+        self.table = table
+        self.pending = []
+
+    def put_item(self, Item):
+        self.pending.append({'PutRequest': {'Item': Item}})
+        self._flush(BATCH_WRITE_LIMIT)
+
+    def delete_item(self, Key):
+        self.pending.append({'DeleteRequest': {'Key': Key}})
+        self._flush(BATCH_WRITE_LIMIT)
+
+    def _flush(self, at_least: int = 1):
+        while len(self.pending) >= at_least and self.pending:
+            batch, self.pending = self.pending[:BATCH_WRITE_LIMIT], self.pending[BATCH_WRITE_LIMIT:]
+            self.table.resource.batch_write_item(RequestItems={self.table.name: batch})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._flush()
+        return False
+
+
+class FakeDynamoDB:
+    """Stand-in for boto3.resource('dynamodb') holding FakeTables and call counters"""
+
+    def __init__(self):
+        self.tables = {}
+        self.stats = Counter()
+        self.table_stats = {}
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+    def create_table(self, name: str, hash_key: str, range_key: str = None,
+                     indexes: dict = None) -> FakeTable:
+        table = FakeTable(self, name, hash_key, range_key, indexes)
+        self.tables[name] = table
+        self.table_stats[name] = Counter()
+        return table
+
+    def Table(self, name: str) -> FakeTable:
+        if name not in self.tables:
+            raise client_error('ResourceNotFoundException', f"Requested resource not found: Table: {name} not found", 'DescribeTable')
+        return self.tables[name]
+
+    def enable_stream(self, *names: str):
+        """Start recording stream records for these tables"""
+        for name in names:
+            self.Table(name).stream = []
+
+    def next_sequence_number(self) -> str:
+        with self._lock:
+            self._sequence += 1
+            return f"{self._sequence:021d}"
+
+    def stream_events(self, batch_size: int = 100) -> list:
+        """Drain the recorded stream records into Lambda events, one table per batch"""
+        events = []
+        for table in self.tables.values():
+            with table.lock:
+                records, table.stream = table.stream, ([] if table.stream is not None else None)
+            for start in range(0, len(records or []), batch_size):
+                events.append({'Records': records[start:start + batch_size]})
+        return events
+
+    def record(self, table: str, operation: str, read: float = 0.0, write: float = 0.0,
+               calls: int = 1):
+        with self._lock:
+            for counter in (self.stats, self.table_stats.setdefault(table, Counter())):
+                counter[operation] += calls
+                counter['read_units'] += read
+                counter['write_units'] += write
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.clear()
+            for counter in self.table_stats.values():
+                counter.clear()
+
+    @property
+    def reads(self) -> int:
+        return sum(self.stats[op] for op in ('get_item', 'query', 'scan', 'batch_get_item'))
+
+    @property
+    def writes(self) -> int:
+        return sum(self.stats[op] for op in ('put_item', 'update_item', 'delete_item', 'batch_write_item'))
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE', **kwargs):
+        requests = [(name, request) for name, batch in RequestItems.items() for request in batch]
+        if len(requests) > BATCH_WRITE_LIMIT:
+            raise validation_error("Too many items requested for the BatchWriteItem call", 'BatchWriteItem')
+        seen = set()
+        for name, request in requests:
+            table = self.Table(name)
+            body = request.get('PutRequest', {}).get('Item') or request.get('DeleteRequest', {}).get('Key')
+            key = (name, table._key_of(to_storage(body), 'BatchWriteItem'))
+            if key in seen:
+                raise validation_error("Provided list of item keys contains duplicates", 'BatchWriteItem')
+            seen.add(key)
+
+        consumed = Counter()
+        for name, request in requests:
+            table = self.Table(name)
+            with table.lock:
+                if 'PutRequest' in request:
+                    item = to_storage(request['PutRequest']['Item'])
+                    if item_size(item) > MAX_ITEM_BYTES:
+                        raise validation_error("Item size has exceeded the maximum allowed size", 'BatchWriteItem')
+                    key = table._key_of(item, 'BatchWriteItem')
+                    old = table.items.get(key)
+                    table.items[key] = item
+                    table._emit(key, old, item)
+                    units = write_units(max(item_size(item), item_size(old) if old else 0))
+                else:
+                    key = table._check_key(to_storage(request['DeleteRequest']['Key']), 'BatchWriteItem')
+                    old = table.items.pop(key, None)
+                    if old is not None:
+                        table._emit(key, old, None)
+                    units = write_units(item_size(old) if old else 0)
+            consumed[name] += units
+        for name, units in consumed.items():
+            self.record(name, 'batch_write_item', write=units, calls=0)
+        self.record(next(iter(RequestItems), ''), 'batch_write_item', calls=1)
+
+        response = {'UnprocessedItems': {}}
+        if ReturnConsumedCapacity in ('TOTAL', 'INDEXES'):
+            response['ConsumedCapacity'] = [{'TableName': name, 'CapacityUnits': units}
+                                            for name, units in consumed.items()]
+        return response
+
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity='NONE', **kwargs):
+        if sum(len(spec['Keys']) for spec in RequestItems.values()) > BATCH_GET_LIMIT:
+            raise validation_error("Too many items requested for the BatchGetItem call", 'BatchGetItem')
+        responses = {}
+        consumed = Counter()
+        for name, spec in RequestItems.items():
+            table = self.Table(name)
+            found = []
+            with table.lock:
+                for key in spec['Keys']:
+                    item = table.items.get(table._check_key(to_storage(key), 'BatchGetItem'))
+                    consumed[name] += read_units(item_size(item) if item else 0, spec.get('ConsistentRead', False))
+                    if item is None:
+                        continue
+                    projection = spec.get('ProjectionExpression')
+                    found.append(project(item, projection, spec.get('ExpressionAttributeNames'))
+                                 if projection else copy.deepcopy(item))
+            responses[name] = found
+            self.record(name, 'batch_get_item', read=consumed[name], calls=0)
+        self.record(next(iter(RequestItems), ''), 'batch_get_item', calls=1)
+
+        response = {'Responses': responses, 'UnprocessedKeys': {}}
+        if ReturnConsumedCapacity in ('TOTAL', 'INDEXES'):
+            response['ConsumedCapacity'] = [{'TableName': name, 'CapacityUnits': units}
+                                            for name, units in consumed.items()]
+        return response
+
+
+# ============= PUBLISHERS =============
+
+class FakePublisher:
+    """Stand-in for the iot-data and sns clients: records every publish"""
+
+    def __init__(self, service: str, latency_seconds: float = 0.0):
+        self.service = service
+        self.latency_seconds = latency_seconds
+        self.published = []
+        self._lock = threading.Lock()
+
+    def publish(self, **kwargs):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._lock:
+            self.published.append(kwargs)
+        return {'MessageId': str(uuid.uuid4())}
+
+    def reset(self):
+        with self._lock:
+            self.published.clear()
+
+
+# ============= PROJECT SCHEMA =============
+
+def create_project_tables(fake: FakeDynamoDB, names: dict = None) -> FakeDynamoDB:
+    """
+    Create the EcoShower tables with their production keys and indexes.
+    names maps the logical table (e.g. 'DEVICES_TABLE') to a table name override.
+    """
+    names = names or {}
+    schema = {
+        'USERS_TABLE': ('EcoShower-Users', 'user_id', None, {}),
+        'DEVICES_TABLE': ('EcoShower-Devices', 'device_id', None, {'user-index': ('user_id', None)}),
+        'SESSIONS_TABLE': ('EcoShower-Sessions', 'session_id', None, {
+            'device-index': ('device_id', 'start_time'),
+            'user-start-index': ('user_id', 'start_time')
+        }),
+        'TELEMETRY_TABLE': ('EcoShower-Telemetry', 'device_id', 'timestamp', {}),
+        'ROLLUPS_TABLE': ('EcoShower-TelemetryRollups', 'device_id', 'bucket', {}),
+        'TELEMETRY_CHUNKS_TABLE': ('EcoShower-TelemetryChunks', 'device_id', 'chunk_start', {}),
+        'USER_STATS_TABLE': ('EcoShower-UserStats', 'user_id', None, {}),
+        'STATS_TABLE': ('EcoShower-SystemStats', 'pk', 'sk', {}),
+        'JOBS_TABLE': ('EcoShower-Jobs', 'job_id', None, {}),
+    }
+    for logical, (default_name, hash_key, range_key, indexes) in schema.items():
+        fake.create_table(names.get(logical, default_name), hash_key, range_key, indexes)
+    return fake
+
+
+def install(module, fake: FakeDynamoDB, publishers: dict = None):
+    """
+    Point a lambda module at the stand-ins: replaces `dynamodb`, every
+    `<name>_table` global that has a matching table, and the given publishers
+    (e.g. {'iot_client': FakePublisher('iot'), 'sns_client': FakePublisher('sns')}).
+    """
+    module.dynamodb = fake
+    for attr in list(vars(module)):
+        if not attr.endswith('_table'):
+            continue
+        current = getattr(module, attr)
+        name = getattr(current, 'table_name', None)
+        if name in fake.tables:
+            setattr(module, attr, fake.tables[name])
+    for attr, publisher in (publishers or {}).items():
+        setattr(module, attr, publisher)
@@ -0,0 +1,235 @@
+"""
+EcoShower - DynamoDB cost projection
+
+Projects the monthly DynamoDB on-demand request cost at a given number of
+users and devices from measured capacity units rather than estimates:
+
+  API routes   RCU/WCU per request from the API lambda's per-route EMF lines
+               (Route, Requests, rcu, wcu - see instrumentation.RouteMetrics)
+  telemetry    RCU/WCU per reading from the capacity totals lines of
+               process_telemetry and the rollups function (Invocations,
+               TotalReadings, TotalRCU, TotalWCU - see instrumentation.Tracer),
+               or from a `bench_telemetry.py --json` run. Rollup lines
+               (source: stream) add their capacity but not their readings,
+               which ingest already counted
+  stats        stats_materializer's totals lines, per API request: its writes
+               follow the Users/Devices/Sessions changes the API makes, so
+               log it over the same period as the API
+
+These totals count every request and invocation, not a sample (a container's
+last partial interval is lost when Lambda reclaims it). The per-stage
+split under telemetry comes from the sampled trace lines (ReadCapacity,
+WriteCapacity, stage_capacity) and is labelled as a sample; logs without
+totals lines fall back to the sampled traces for the telemetry line too.
+
+    aws logs filter-log-events --log-group-name /aws/lambda/EcoShower-API \\
+        --filter-pattern CloudWatchMetrics --query 'events[].message' --output json > api.json
+    (the same for /aws/lambda/EcoShower-StatsMaterializer > stats.json)
+    python src/lambda/tools/bench_telemetry.py --json > bench.json
+    python src/lambda/tools/project_cost.py --logs api.json stats.json --bench bench.json --users 500 5000
+
+Log files may be JSON lines, a JSON array of messages, or exported log lines
+with a prefix before the JSON. API volume is --requests-per-user-day split by
+the route mix seen in the logs (or --route-mix); telemetry volume follows
+05_Cost_Assumptions: showers per device per day x readings per shower.
+Storage, backups and stream reads are not included.
+"""
+
+import argparse
+import json
+import sys
+
+DAYS_PER_MONTH = 30
+# Capacity totals of this function are projected per API request rather than per reading
+STATS_FUNCTION = 'stats_materializer'
+
+# On-demand prices per million request units, as in 05_Cost_Assumptions.md
+READ_PRICE_PER_MILLION = 0.25
+WRITE_PRICE_PER_MILLION = 1.25
+
+
+def log_records(path: str):
+    """Yield the JSON objects in a log file (EMF lines or anything else that parses)"""
+    with open(path) as handle:
+        text = handle.read()
+    if text.lstrip().startswith('['):
+        messages = json.loads(text)
+    else:
+        messages = text.splitlines()
+    for message in messages:
+        if isinstance(message, dict):
+            yield message
+            continue
+        start = message.find('{')
+        if start < 0:
+            continue
+        try:
+            record = json.loads(message[start:])
+        except ValueError:
+            continue
+        if isinstance(record, dict):
+            yield record
+
+
+def load_logs(paths: list) -> tuple:
+    """(routes, telemetry, stats) capacity totals from the API, telemetry and stats EMF lines"""
+    routes = {}
+    telemetry = {'readings': 0, 'rcu': 0.0, 'wcu': 0.0, 'stages': {}}
+    sampled = {'readings': 0, 'rcu': 0.0, 'wcu': 0.0}
+    stats = {'invocations': 0, 'rcu': 0.0, 'wcu': 0.0}
+    for path in paths:
+        for record in log_records(path):
+            if 'Route' in record and 'traced' in record:
+                totals = routes.setdefault(record['Route'], {'requests': 0, 'rcu': 0.0, 'wcu': 0.0})
+                totals['requests'] += record.get('Requests', 0)
+                totals['rcu'] += record.get('rcu', 0)
+                totals['wcu'] += record.get('wcu', 0)
+            elif 'Invocations' in record and 'TotalRCU' in record:
+                totals = stats if record.get('Function') == STATS_FUNCTION else telemetry
+                if totals is stats:
+                    stats['invocations'] += record['Invocations']
+                elif record.get('source') != 'stream':
+                    telemetry['readings'] += record['TotalReadings']
+                totals['rcu'] += record['TotalRCU']
+                totals['wcu'] += record['TotalWCU']
+            elif 'Readings' in record and 'ReadCapacity' in record:
+                if record.get('Function') == STATS_FUNCTION:
+                    continue
+                if record.get('source') != 'stream':
+                    sampled['readings'] += record['Readings']
+                sampled['rcu'] += record['ReadCapacity']
+                sampled['wcu'] += record['WriteCapacity']
+                for stage, units in record.get('stage_capacity', {}).items():
+                    totals = telemetry['stages'].setdefault(stage, {'rcu': 0.0, 'wcu': 0.0})
+                    totals['rcu'] += units.get('rcu', 0)
+                    totals['wcu'] += units.get('wcu', 0)
+    # The stage split is per sampled reading whatever the telemetry line comes from
+    telemetry['sampled_readings'] = sampled['readings']
+    if not telemetry['readings'] and sampled['readings']:
+        print("warning: no capacity totals lines for telemetry; projecting from the sampled traces",
+              file=sys.stderr)
+        telemetry.update(sampled, sampled_readings=sampled['readings'], sampled=True)
+    return routes, telemetry, stats
+
+
+def load_bench(path: str) -> dict:
+    """Telemetry totals in the same shape as load_logs, from a bench_telemetry --json result"""
+    with open(path) as handle:
+        result = json.load(handle)
+    readings = result['readings']
+    per_reading = result['per_reading']
+    return {
+        'readings': readings,
+        'rcu': per_reading['read_units'] * readings,
+        'wcu': (per_reading['write_units'] + per_reading.get('rollup_write_units', 0)) * readings,
+        'stages': {},
+        'sampled_readings': 0
+    }
+
+
+def cost(rcu: float, wcu: float, read_price: float, write_price: float) -> float:
+    return rcu / 1e6 * read_price + wcu / 1e6 * write_price
+
+
+def project(routes: dict, telemetry: dict, stats: dict, route_mix: dict, users: int, devices: int,
+            args) -> dict:
+    """Monthly requests, units and cost per route, for telemetry and for the stats counters at one scale"""
+    lines = []
+    requests = users * args.requests_per_user_day * DAYS_PER_MONTH
+    mix = route_mix or {route: totals['requests'] for route, totals in routes.items()}
+    weight = sum(mix.values())
+    for route, share in sorted(mix.items()):
+        totals = routes.get(route, {})
+        seen = totals.get('requests', 0)
+        if not seen:
+            print(f"warning: no logged requests for {route}; counted as 0 units", file=sys.stderr)
+        rcu = totals.get('rcu', 0) / seen if seen else 0.0
+        wcu = totals.get('wcu', 0) / seen if seen else 0.0
+        monthly = requests * share / weight if weight else 0
+        lines.append({'name': route, 'volume': round(monthly), 'rcu_each': rcu, 'wcu_each': wcu})
+
+    if telemetry['readings']:
+        readings = devices * args.showers_per_device_day * args.readings_per_shower * DAYS_PER_MONTH
+        per = telemetry['readings']
+        name = 'telemetry (sampled)' if telemetry.get('sampled') else 'telemetry'
+        lines.append({'name': name, 'volume': round(readings),
+                      'rcu_each': telemetry['rcu'] / per, 'wcu_each': telemetry['wcu'] / per})
+        sampled = telemetry['sampled_readings']
+        for stage, units in sorted(telemetry['stages'].items() if sampled else ()):
+            lines.append({'name': f"  {stage} (sampled)", 'volume': round(readings), 'detail': True,
+                          'rcu_each': units['rcu'] / sampled, 'wcu_each': units['wcu'] / sampled})
+
+    logged_requests = sum(totals['requests'] for totals in routes.values())
+    if stats['invocations'] and logged_requests:
+        lines.append({'name': 'stats counters', 'volume': round(requests),
+                      'rcu_each': stats['rcu'] / logged_requests, 'wcu_each': stats['wcu'] / logged_requests})
+    elif routes or route_mix:
+        print(f"warning: no {STATS_FUNCTION} totals lines alongside the API lines; "
+              f"its capacity is not included", file=sys.stderr)
+
+    for line in lines:
+        line['rcu'] = line['volume'] * line['rcu_each']
+        line['wcu'] = line['volume'] * line['wcu_each']
+        line['cost'] = cost(line['rcu'], line['wcu'], args.read_price, args.write_price)
+    counted = [line for line in lines if not line.get('detail')]
+    return {
+        'users': users,
+        'devices': devices,
+        'lines': lines,
+        'rcu': sum(line['rcu'] for line in counted),
+        'wcu': sum(line['wcu'] for line in counted),
+        'cost': sum(line['cost'] for line in counted)
+    }
+
+
+def print_projection(projection: dict):
+    print(f"\n{projection['users']} users, {projection['devices']} devices - per month")
+    print(f"  {'':<32}{'volume':>12}{'RCU each':>10}{'WCU each':>10}{'RCU':>14}{'WCU':>14}{'USD':>10}")
+    for line in projection['lines']:
+        print(f"  {line['name']:<32}{line['volume']:>12}{line['rcu_each']:>10.3f}{line['wcu_each']:>10.3f}"
+              f"{line['rcu']:>14.0f}{line['wcu']:>14.0f}{line['cost']:>10.2f}")
+    print(f"  {'total':<32}{'':>32}{projection['rcu']:>14.0f}{projection['wcu']:>14.0f}"
+          f"{projection['cost']:>10.2f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logs', nargs='*', default=[], help='files with API, telemetry and/or stats EMF lines')
+    parser.add_argument('--bench', help='bench_telemetry.py --json result (replaces telemetry from --logs)')
+    parser.add_argument('--users', type=int, nargs='+', default=[500])
+    parser.add_argument('--devices', type=int, nargs='+',
+                        help='devices for each --users value (default 1.2 per user)')
+    parser.add_argument('--requests-per-user-day', type=float, default=20, help='API requests per user per day')
+    parser.add_argument('--route-mix', help='JSON file {route: weight}; default is the mix seen in the logs')
+    parser.add_argument('--showers-per-device-day', type=float, default=1.67)
+    parser.add_argument('--readings-per-shower', type=float, default=60)
+    parser.add_argument('--read-price', type=float, default=READ_PRICE_PER_MILLION, help='USD per million RRU')
+    parser.add_argument('--write-price', type=float, default=WRITE_PRICE_PER_MILLION, help='USD per million WRU')
+    parser.add_argument('--json', action='store_true', help='print the projections as JSON')
+    args = parser.parse_args(argv)
+
+    if args.devices and len(args.devices) != len(args.users):
+        parser.error('--devices needs one value per --users value')
+    routes, telemetry, stats = load_logs(args.logs)
+    if args.bench:
+        telemetry = load_bench(args.bench)
+    route_mix = None
+    if args.route_mix:
+        with open(args.route_mix) as handle:
+            route_mix = json.load(handle)
+    if not routes and not route_mix and not telemetry['readings']:
+        parser.error('no capacity data - pass --logs with EMF lines and/or --bench')
+
+    devices = args.devices or [round(users * 1.2) for users in args.users]
+    projections = [project(routes, telemetry, stats, route_mix, users, count, args)
+                   for users, count in zip(args.users, devices)]
+    if args.json:
+        print(json.dumps(projections, indent=2))
+    else:
+        for projection in projections:
+            print_projection(projection)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
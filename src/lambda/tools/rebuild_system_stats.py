@@ -0,0 +1,84 @@
+"""
+EcoShower - Rebuild the SystemStats table
+
+Recomputes every SystemStats item from full scans of the Users, Devices and
+Sessions tables, using the same contribution rules as stats_materializer.
+Run it once after enabling the streams (existing data never produces stream
+records), or to repair the counters after a stream outage.
+
+    python src/lambda/tools/rebuild_system_stats.py --dry-run
+    python src/lambda/tools/rebuild_system_stats.py
+
+Writes made while the rebuild runs are counted twice or not at all; run it
+before attaching the stream trigger or during a quiet period.
+"""
+
+import argparse
+import os
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TOOLS_DIR))
+
+import stats_materializer as sm  # noqa: E402
+
+
+def scan_all(table, **kwargs):
+    """Yield every item, following LastEvaluatedKey"""
+    while True:
+        result = table.scan(**kwargs)
+        yield from result.get('Items', [])
+        if 'LastEvaluatedKey' not in result:
+            return
+        kwargs['ExclusiveStartKey'] = result['LastEvaluatedKey']
+
+
+def compute(users_table, devices_table, sessions_table) -> dict:
+    """{(pk, sk): counters} for the current contents of the source tables"""
+    stats = {}
+    sources = (
+        ('users', users_table, 'user_id'),
+        ('devices', devices_table, 'user_id, #s'),
+        ('sessions', sessions_table, 'user_id, #s, start_time, water_saved')
+    )
+    for source, table, projection in sources:
+        kwargs = {'ProjectionExpression': projection}
+        if '#s' in projection:
+            kwargs['ExpressionAttributeNames'] = {'#s': 'status'}
+        for item in scan_all(table, **kwargs):
+            sm.merge_deltas(stats, sm.contributions(source, item))
+    return stats
+
+
+def write(stats_table, stats: dict, dry_run: bool = False) -> int:
+    """Replace the SystemStats items; items without a recomputed value are deleted (record markers are kept)"""
+    existing = {(item['pk'], item['sk']) for item in scan_all(stats_table, ProjectionExpression='pk, sk')
+                if not item['pk'].startswith(sm.RECORD_PREFIX)}
+    if dry_run:
+        return len(stats)
+    with stats_table.batch_writer() as batch:
+        for (pk, sk), counters in stats.items():
+            batch.put_item(Item={'pk': pk, 'sk': sk, **counters})
+        for pk, sk in existing - set(stats):
+            batch.delete_item(Key={'pk': pk, 'sk': sk})
+    return len(stats)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='compute and print the totals without writing')
+    args = parser.parse_args(argv)
+
+    import boto3
+    dynamodb = boto3.resource('dynamodb')
+    stats = compute(dynamodb.Table(sm.USERS_TABLE), dynamodb.Table(sm.DEVICES_TABLE),
+                    dynamodb.Table(sm.SESSIONS_TABLE))
+    totals = stats.get((sm.GLOBAL_PK, sm.TOTALS_SK), {})
+    print("Global totals: " + ', '.join(f"{name}={value}" for name, value in sorted(totals.items())))
+    count = write(dynamodb.Table(sm.STATS_TABLE), stats, dry_run=args.dry_run)
+    print(f"{'Would write' if args.dry_run else 'Wrote'} {count} items to {sm.STATS_TABLE}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())